@@ -16,8 +16,9 @@ setup(
     version=VERSION,
     packages=find_packages(exclude=["tests", "tests.*", "examples", "examples.*"]),
     package_data={f"timetagger.{x}": ["*"] for x in ["client", "images", "static"]},
-    python_requires=">=3.6.0",
+    python_requires=">=3.7.0",
     install_requires=runtime_deps,
+    extras_require={"postgres": ["asyncpg"]},
     license="GPL-3.0",
     description="An open source time tracker - tag your time, and see where it has gone",
     long_description=open("README.md").read(),
@@ -0,0 +1,91 @@
+"""
+A stand-in for an asyncpg connection pool, on top of sqlite, to test the
+PostgreSQL storage backend without a database server. Only the subset
+of the asyncpg API (and of SQL) that the backend uses is supported.
+
+To test against a real PostgreSQL server instead, set the
+TIMETAGGER_TEST_POSTGRES environment variable to its dsn (needs asyncpg).
+"""
+
+import os
+import re
+import asyncio
+import sqlite3
+import contextlib
+
+
+async def create_pool(filename):
+    """Create a pool for the given sqlite database file."""
+    return SqlitePool(filename)
+
+
+def get_create_pool(filename):
+    """Get a function that creates a pool, for PostgresStorage."""
+    dsn = os.getenv("TIMETAGGER_TEST_POSTGRES", "")
+    if dsn:
+        import asyncpg
+
+        return lambda: asyncpg.create_pool(dsn)
+    return lambda: create_pool(filename)
+
+
+class SqlitePool:
+    """A pool with a single sqlite connection. Connections are acquired
+    one at a time, so that a transaction never has to wait for a lock
+    of sqlite (which would block the event loop).
+    """
+
+    def __init__(self, filename):
+        conn = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+        self._conn = SqliteConnection(conn)
+        self._lock = asyncio.Lock()
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        async with self._lock:
+            yield self._conn
+
+    def get_size(self):
+        return 1
+
+    async def close(self):
+        self._conn._conn.close()
+
+
+class SqliteConnection:
+    """A connection with the API of an asyncpg connection."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def _execute(self, query, args):
+        # Positional parameters are $n in PostgreSQL, and ?n in sqlite
+        return self._conn.execute(re.sub(r"\$(\d+)", r"?\1", query), args)
+
+    async def fetch(self, query, *args):
+        return self._execute(query, args).fetchall()
+
+    async def fetchrow(self, query, *args):
+        return self._execute(query, args).fetchone()
+
+    async def fetchval(self, query, *args):
+        row = self._execute(query, args).fetchone()
+        return None if row is None else row[0]
+
+    async def execute(self, query, *args):
+        self._execute(query, args)
+
+    async def executemany(self, query, args):
+        for row_args in args:
+            self._execute(query, row_args)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        else:
+            self._conn.execute("COMMIT")
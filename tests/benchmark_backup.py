@@ -0,0 +1,77 @@
+"""
+Benchmark for backups. Creates a directory of user databases, and
+measures the throughput of full and incremental backups, for different
+numbers of threads.
+
+Run with: python tests/benchmark_backup.py [nusers]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from timetagger.server import _utils
+from timetagger.server import _apiserver as apiserver
+from timetagger.server._backup import backup
+
+
+def create_dbs(nusers, nrecords=50):
+    users = [f"user{i:05d}@example.com" for i in range(nusers)]
+    for user in users:
+        records = []
+        for i in range(nrecords):
+            t1 = 1_600_000_000 + i * 3600
+            records.append(
+                dict(key=f"r{i:04d}", mt=time.time(), t1=t1, t2=t1 + 1800, ds="#foo")
+            )
+        apiserver._push_many(user, [("records", records)])
+    apiserver.db_pool.clear()
+    return users
+
+
+def run_backup(users, backup_dir, jobs, force):
+    t0 = time.perf_counter()
+    results = list(backup(users, backup_dir, jobs, force))
+    etime = time.perf_counter() - t0
+    size = sum(r["size"] for r in results)
+    return len(results), etime, size
+
+
+def main():
+    nusers = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    root = tempfile.mkdtemp()
+    backup_dir = os.path.join(root, "backups")
+    ori_root_user_dir = _utils.ROOT_USER_DIR
+    _utils.ROOT_USER_DIR = root
+
+    try:
+        print(f"Creating {nusers} databases ...")
+        users = create_dbs(nusers)
+
+        for jobs in (1, 4, 8, 16):
+            n, etime, size = run_backup(users, backup_dir, jobs, True)
+            print(
+                f"Full backup, {jobs:2d} threads: {n / etime:7.0f} dbs/s, "
+                f"{size / etime / 2 ** 20:6.1f} MiB/s"
+            )
+
+        n, etime, size = run_backup(users, backup_dir, 8, False)
+        print(f"Incremental backup, no changes: {nusers / etime:7.0f} dbs/s checked")
+
+        time.sleep(0.01)
+        for user in users[::10]:
+            record = dict(key="r0000", mt=time.time(), t1=1, t2=2)
+            apiserver._push_many(user, [("records", [record])])
+        apiserver.db_pool.clear()
+        n, etime, size = run_backup(users, backup_dir, 8, False)
+        print(f"Incremental backup, 10% changed: {n} dbs in {etime:0.2f}s")
+
+    finally:
+        _utils.ROOT_USER_DIR = ori_root_user_dir
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Benchmark for the sqlite profiles. Measures the throughput of pushes
+and of updates, and of updates while another thread is pushing.
+
+Run with: python tests/benchmark_sqlite.py [npushes]
+"""
+
+import os
+import sys
+import time
+import threading
+
+from timetagger.server import _apiserver as apiserver
+from timetagger.server._dbpool import SQLITE_PROFILES
+
+
+USER = "benchmark_sqlite"
+
+
+def remove_db():
+    filename = apiserver.user2filename(USER)
+    for fname in (filename, filename + "-wal", filename + "-shm"):
+        if os.path.isfile(fname):
+            os.remove(fname)
+    apiserver.db_pool.notify_write(filename)
+
+
+def push(i0, n=10):
+    records = []
+    for i in range(i0, i0 + n):
+        t1 = 1_600_000_000 + i * 3600
+        records.append(dict(key=f"r{i:08d}", mt=time.time(), t1=t1, t2=t1 + 1800))
+    apiserver._push_many(USER, [("records", records)])
+
+
+def pull(since):
+    return apiserver._get_updates(USER, since, 100)
+
+
+def run_profile(profile, npushes):
+    remove_db()
+    apiserver.configure_sqlite(profile)
+
+    # Pushes
+    t0 = time.perf_counter()
+    for i in range(npushes):
+        push(i * 10)
+    push_rate = npushes / (time.perf_counter() - t0)
+
+    # Updates (that are not answered early, and include some records)
+    since = time.time() - 0.1
+    t0 = time.perf_counter()
+    for i in range(npushes):
+        pull(since)
+    pull_rate = npushes / (time.perf_counter() - t0)
+
+    # Updates while another thread is pushing
+    done = []
+
+    def pusher():
+        i = npushes * 10
+        while not done:
+            push(i)
+            i += 10
+
+    t = threading.Thread(target=pusher)
+    t.start()
+    try:
+        t0 = time.perf_counter()
+        for i in range(npushes):
+            pull(since)
+        mixed_rate = npushes / (time.perf_counter() - t0)
+    finally:
+        done.append(True)
+        t.join()
+
+    print(
+        f"{profile:>10}: {push_rate:7.0f} pushes/s, {pull_rate:7.0f} updates/s, "
+        f"{mixed_rate:7.0f} updates/s while pushing"
+    )
+
+
+def main():
+    npushes = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    try:
+        for profile in SQLITE_PROFILES:
+            run_profile(profile, npushes)
+    finally:
+        apiserver.configure_sqlite()
+        remove_db()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Benchmark for the storage backends. Creates many users, each with some
+records, and then measures the throughput of polls and pushes for
+random users, with a database per user and with a shared database.
+
+Run with: python tests/benchmark_storage.py [nusers]
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+from timetagger.server import _utils
+from timetagger.server import _apiserver as apiserver
+
+
+NRECORDS = 20
+
+
+def get_open_files():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except FileNotFoundError:
+        return -1
+
+
+def create_users(users):
+    for user in users:
+        records = []
+        for i in range(NRECORDS):
+            t1 = 1_600_000_000 + i * 3600
+            records.append(
+                dict(key=f"r{i:04d}", mt=time.time(), t1=t1, t2=t1 + 1800, ds="#foo")
+            )
+        apiserver._push_many(user, [("records", records)])
+
+
+def poll(user):
+    # A poll that gets all records, i.e. not an early exit
+    return apiserver._get_updates(user, 0)
+
+
+def push(user):
+    record = dict(key="r0000", mt=time.time(), t1=1, t2=2, ds="#bar")
+    return apiserver._push_many(user, [("records", [record])])
+
+
+def measure(name, func, users, n):
+    t0 = time.perf_counter()
+    for i in range(n):
+        func(random.choice(users))
+    etime = time.perf_counter() - t0
+    print(f"  {name:<28} {n / etime:8.0f} per second")
+
+
+def run_backend(backend, root, users, n):
+    print(f"Backend {backend!r}:")
+    apiserver.configure_storage(backend, os.path.join(root, "_shared.db"))
+    try:
+        t0 = time.perf_counter()
+        create_users(users)
+        etime = time.perf_counter() - t0
+        print(f"  Created {len(users)} users in {etime:0.1f}s")
+        measure("polls", poll, users, n)
+        measure("polls (10 active users)", poll, users[:10], n)
+        measure("pushes", push, users, n)
+        print(f"  Open files: {get_open_files()}")
+        size = sum(
+            os.path.getsize(os.path.join(dir, fname))
+            for dir, _, fnames in os.walk(root)
+            for fname in fnames
+        )
+        print(f"  Size on disk: {size / 2 ** 20:0.1f} MiB")
+    finally:
+        apiserver.get_storage().clear()
+        apiserver.configure_storage("files")
+
+
+def main():
+    nusers = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    n = min(10_000, 2 * nusers)
+    users = [f"user{i:05d}@example.com" for i in range(nusers)]
+    ori_root_user_dir = _utils.ROOT_USER_DIR
+    for backend in ("files", "shared"):
+        root = tempfile.mkdtemp()
+        _utils.ROOT_USER_DIR = root
+        try:
+            run_backend(backend, root, users, n)
+        finally:
+            _utils.ROOT_USER_DIR = ori_root_user_dir
+            shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
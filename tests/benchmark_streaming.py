@@ -0,0 +1,98 @@
+"""
+Benchmark for streaming responses of GET updates. Compares the peak
+memory and the time to first byte for a normal and a streamed response
+for a user with many records. Each mode runs in a subprocess, so that
+the peak memory can be measured independently.
+
+Run with: python tests/benchmark_streaming.py [nrecords]
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import subprocess
+
+from timetagger.server import _apiserver as apiserver
+from timetagger.server._utils import swait
+
+
+USER = "benchmark_streaming"
+
+
+class FakeRequest:
+    def __init__(self, querydict):
+        self.method = "GET"
+        self.querydict = querydict
+        self.headers = {}
+
+
+def create_db(n):
+    filename = apiserver.user2filename(USER)
+    if os.path.isfile(filename):
+        os.remove(filename)
+    db, _ = apiserver.get_user_db(USER)
+    t0 = time.time() - n * 3600
+    with db:
+        for i0 in range(0, n, 10000):
+            records = []
+            for i in range(i0, min(i0 + 10000, n)):
+                t1 = t0 + i * 3600
+                ds = f"#project{i % 20} working on item {i}"
+                r = dict(key=f"r{i:08d}", mt=t1, st=t1, t1=t1, t2=t1 + 1800, ds=ds)
+                records.append(r)
+            db.put("records", *records)
+
+
+def get_maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KiB on Linux
+
+
+async def run_mode(mode):
+    query = {"since": "0"}
+    if mode == "stream":
+        query["stream"] = "1"
+    rss0 = get_maxrss()
+    t0 = time.perf_counter()
+    ttfb = None
+    nbytes = 0
+    body = await apiserver.api_handler(FakeRequest(query), "updates", USER)
+    if isinstance(body, tuple):
+        status, headers, body = body
+        assert status == 200
+    if isinstance(body, dict):
+        # Like asgineer does it (api_handler already encodes most responses)
+        body = json.dumps(body).encode()
+    if isinstance(body, bytes):
+        ttfb = time.perf_counter() - t0
+        nbytes = len(body)
+    else:
+        async for chunk in body:
+            if ttfb is None:
+                ttfb = time.perf_counter() - t0
+            nbytes += len(chunk.encode())
+    total = time.perf_counter() - t0
+    rss1 = get_maxrss()
+    print(
+        f"{mode:>7}: {nbytes / 2**20:6.1f} MiB, first byte {ttfb:6.3f}s, "
+        f"total {total:6.3f}s, peak memory +{(rss1 - rss0) / 1024:6.1f} MiB"
+    )
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    print(f"Creating db with {n} records ...")
+    create_db(n)
+    try:
+        for mode in ("normal", "stream"):
+            subprocess.run([sys.executable, __file__, "--run", mode], check=True)
+    finally:
+        os.remove(apiserver.user2filename(USER))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--run"]:
+        swait(run_mode(sys.argv[2]))
+    else:
+        main()
@@ -0,0 +1,49 @@
+"""
+Micro-benchmark for the per-request overhead of finding and opening
+a user database, with and without the memoization and the stat cache.
+
+Run with: python tests/benchmark_user2filename.py [ncalls]
+"""
+
+import sys
+import time
+
+from timetagger.server import _utils as utils
+from timetagger.server import _apiserver as apiserver
+from timetagger.server._dbpool import DBPool
+
+
+USER = "john.do+benchmark@somedo.main.co.uk"
+
+
+def measure(name, func, n):
+    t0 = time.perf_counter()
+    for i in range(n):
+        func()
+    etime = time.perf_counter() - t0
+    print(f"{name:<40} {etime / n * 1e6:6.2f} us per call")
+
+
+def user2filename_uncached():
+    utils._get_user_filenames.cache_clear()
+    utils.stat_cache.clear()
+    return utils.user2filename(USER)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    filename = utils.user2filename(USER)
+    apiserver.get_user_db(USER)  # make sure the db exists
+    uncached_pool = DBPool()
+
+    measure("user2basename", lambda: utils.user2basename(USER), n)
+    measure("get_user_filenames (memoized)", lambda: utils.get_user_filenames(USER), n)
+    measure("user2filename (uncached)", user2filename_uncached, n)
+    measure("user2filename (cached)", lambda: utils.user2filename(USER), n)
+    measure("DBPool.get (without stat cache)", lambda: uncached_pool.get(filename), n)
+    measure("DBPool.get (with stat cache)", lambda: apiserver.db_pool.get(filename), n)
+    measure("get_user_db", lambda: apiserver.get_user_db(USER), n)
+
+
+if __name__ == "__main__":
+    main()
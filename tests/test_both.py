@@ -37,5 +37,30 @@ def test_matching_specs_and_reqs():
     assert server_lines == client_lines
 
 
+def test_matching_tags():
+    """Ensure that the server gets the same tags from a record's
+    description as the client, so that the server-side stats match.
+    """
+    from timetagger.client.utils import get_tags_and_parts_from_string
+    from timetagger.server._stats import get_tags_from_string
+
+    texts = [
+        "",
+        "hello world",
+        "#foo",
+        "#Foo bar #baz",
+        "#foo#bar",
+        "# foo #",
+        "#a/b-c_d #a/b-c_d",
+        "#hë #h(a) #h.a",
+        "text #1337, #x!",
+        "##foo ###bar",
+    ]
+    for text in texts:
+        tags1, _ = get_tags_and_parts_from_string(text)
+        tags2 = get_tags_from_string(text)
+        assert tags1 == tags2
+
+
 if __name__ == "__main__":
     run_tests(globals())
@@ -44,5 +44,29 @@ def test_demo_record_store():
     print(stats)
 
 
+def test_columns():
+    items = [
+        dict(key="a", mt=1, t1=10, t2=20, ds="foo"),
+        dict(key="b", mt=2, t1=30, t2=40),
+    ]
+    ob = stores.to_columns(items)
+    assert ob["count"] == 2
+    assert ob["columns"]["key"] == ["a", "b"]
+    assert ob["columns"]["ds"] == ["foo", None]
+    assert stores.from_columns(ob) == items
+
+    assert stores.from_columns(stores.to_columns([])) == []
+
+    # A null value is not a missing field
+    items = [dict(key="a", mt=1, value=None), dict(key="b", mt=2, value=3)]
+    ob = stores.to_columns(items)
+    assert ob["missing"] == {}
+    assert stores.from_columns(ob) == items
+
+    # Without "missing" (an older server), null means missing
+    ob = {"count": 2, "columns": {"key": ["a", "b"], "ds": [None, "x"]}}
+    assert stores.from_columns(ob) == [dict(key="a"), dict(key="b", ds="x")]
+
+
 if __name__ == "__main__":
     run_tests(globals())
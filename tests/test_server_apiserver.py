@@ -1,10 +1,19 @@
 import os
+import gzip
 import json
+import time
+import asyncio
 
 from asgineer.testutils import MockTestServer
+from asgineer import DisconnectedError
+from asgineer.utils import normalize_response
+from pytest import raises
 
 from _common import run_tests
 from timetagger.server import _apiserver as apiserver
+from timetagger.server._utils import swait, scheduler
+from timetagger.server._stats import get_bin_edges, get_tagz
+from timetagger.server._dbpool import PooledItemDB
 from itemdb import ItemDB
 
 
@@ -13,8 +22,10 @@ USER = "test"
 
 def clear_test_db():
     filename = apiserver.user2filename(USER)
-    if os.path.isfile(filename):
-        os.remove(filename)
+    for fname in (filename, filename + "-wal", filename + "-shm"):
+        if os.path.isfile(fname):
+            os.remove(fname)
+    apiserver.db_pool.notify_write(filename)
 
 
 def get_from_db(what):
@@ -41,6 +52,48 @@ def test_auth():
         assert r.status == 200
 
 
+def test_schema_version():
+    clear_test_db()
+
+    with MockTestServer(our_api_handler) as p:
+        r = p.get("/api/v1/updates?since=0")
+        assert r.status == 200
+
+    # The tables have been created, and the schema version is stored
+    items = get_from_db("userinfo")
+    versions = [x["value"] for x in items if x["key"] == "schema_version"]
+    assert versions == [apiserver.SCHEMA_VERSION]
+
+    # A db with an outdated schema version gets its tables ensured
+    db = PooledItemDB(apiserver.user2filename(USER))
+    with db:
+        db.delete_table("settings")
+        db.put_one("userinfo", key="schema_version", st=0, mt=0, value=0)
+    apiserver.ensure_schema(db)
+    assert "settings" in db.get_table_names()
+    assert db.select_one("userinfo", "key == 'schema_version'")["value"] > 0
+
+
+def test_configure_sqlite():
+    clear_test_db()
+
+    try:
+        apiserver.configure_sqlite("compat")
+        db, _ = apiserver.get_user_db(USER)
+        assert db._conn.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+
+        apiserver.configure_sqlite("production", cache_size=-500)
+        db, _ = apiserver.get_user_db(USER)
+        assert db._conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert db._conn.execute("PRAGMA cache_size").fetchone()[0] == -500
+
+        with raises(ValueError):
+            apiserver.configure_sqlite("foo")
+
+    finally:
+        apiserver.configure_sqlite()
+
+
 def test_fails():
 
     with MockTestServer(our_api_handler) as p:
@@ -58,14 +111,20 @@ def test_fails():
         assert r.status == 405
         r = p.post("http://localhost/api/v1/updates?since=0")
         assert r.status == 405
-        # Can only PUT records
+        # Can only PUT or GET records (GET needs a timerange)
         r = p.get("http://localhost/api/v1/records")
-        assert r.status == 405
+        assert r.status == 400
         r = p.post("http://localhost/api/v1/records")
         assert r.status == 405
         # Get only GET or PUT settings
         r = p.post("http://localhost/api/v1/settings")
         assert r.status == 405
+        # Can only GET events
+        r = p.put("http://localhost/api/v1/events")
+        assert r.status == 405
+        # Can only GET stats
+        r = p.put("http://localhost/api/v1/stats?t1=0&t2=10")
+        assert r.status == 405
         # ...
         r = p.post("http://localhost/api/v1/forcereset")
         assert r.status == 405
@@ -313,6 +372,45 @@ def test_records():
         assert len(d["records"]) == 6
 
 
+def test_records_bulk():
+    clear_test_db()
+
+    with MockTestServer(our_api_handler) as p:
+
+        # Add more records than fit in a single lookup query
+        records = [dict(key=f"r{i}", mt=110, t1=i, t2=i + 1) for i in range(1200)]
+        r = p.put("http://localhost/api/v1/records", json.dumps(records).encode())
+        assert r.status == 200
+        assert len(dejsonize(r)["accepted"]) == 1200
+        assert len(get_from_db("records")) == 1200
+
+        # Update some, in a batch with duplicate keys and an outdated record
+        records = [
+            dict(key="r1", mt=120, t1=1, t2=5),
+            dict(key="r1", mt=130, t1=1, t2=6),
+            dict(key="r1", mt=125, t1=1, t2=7),
+            dict(key="r999", mt=100, t1=1, t2=7),
+            dict(key="r1100", mt=130, t1="xx", t2=7),
+            dict(key="new", mt=130, t1=1, t2=7),
+        ]
+        r = p.put("http://localhost/api/v1/records", json.dumps(records).encode())
+        assert r.status == 200
+        d = dejsonize(r)
+        assert d["accepted"] == ["r1", "r1", "r1", "r999", "new"]
+        assert d["fail"] == ["r1100"]
+
+        records = {x["key"]: x for x in get_from_db("records")}
+        assert len(records) == 1201
+        assert records["r1"]["mt"] == 130 and records["r1"]["t2"] == 6
+        assert records["r999"]["mt"] == 110
+        assert records["r1100"]["t1"] == 1100
+        # The st is updated for all touched records, and never equal
+        st0 = records["r0"]["st"]
+        assert records["r1"]["st"] > st0 + 0.0002
+        assert records["r999"]["st"] > st0
+        assert records["r1100"]["st"] > st0
+
+
 def test_updates():
     clear_test_db()
 
@@ -406,6 +504,20 @@ def test_updates():
         d = dejsonize(r)
         assert d["reset"] == 0 and d["reset"] is not False  #
 
+        # If the registry knows that nothing has changed, the db is not used
+        def fail(user):
+            raise RuntimeError("db should not be touched")
+
+        ori_get_user_db = apiserver.get_user_db
+        apiserver.get_user_db = fail
+        try:
+            r = p.get("http://localhost/api/v1/updates?since=" + str(st3 + 1))
+        finally:
+            apiserver.get_user_db = ori_get_user_db
+        assert r.status == 200
+        d = dejsonize(r)
+        assert d["reset"] == 0 and d["reset"] is not False
+
         # -- fails
 
         # Get updates wrong
@@ -418,5 +530,1012 @@ def test_updates():
         assert "updates needs float" in r.body.decode() and "since" in r.body.decode()
 
 
+class FakeRequest:
+    def __init__(self, querydict=None, body=None):
+        self.querydict = querydict or {}
+        self.headers = {}
+        self._body = body
+
+    async def get_json(self, limit):
+        return self._body
+
+
+def test_updates_write_by_other_process():
+    clear_test_db()
+
+    with MockTestServer(our_api_handler) as p:
+
+        records = [dict(key="r1", mt=110, t1=100, t2=110)]
+        r = p.put("http://localhost/api/v1/records", json.dumps(records).encode())
+        assert r.status == 200
+        time.sleep(0.3)
+        r = p.get("http://localhost/api/v1/updates?since=0")
+        since = dejsonize(r)["server_time"]
+
+        # Another process writes a record. The registry of this process
+        # does not know, so the poll exits early, but must not move the
+        # client past the new record.
+        db = PooledItemDB(apiserver.user2filename(USER))
+        with db:
+            st = time.time()
+            db.put_one("records", key="r2", mt=st, t1=st, t2=st, st=st)
+        db.close()
+        r = p.get(f"http://localhost/api/v1/updates?since={since}")
+        d = dejsonize(r)
+        assert d["reset"] == 0 and d["records"] == []
+        assert d["server_time"] <= since
+
+        # Once the registry knows, the record is received
+        apiserver.version_registry.clear()
+        apiserver.notify_write(USER)
+        r = p.get(f"http://localhost/api/v1/updates?since={d['server_time']}")
+        assert [x["key"] for x in dejsonize(r)["records"]] == ["r2"]
+
+
+def test_updates_write_by_other_process_stat_cache():
+    clear_test_db()
+    ori_ttl = apiserver.version_registry.ttl
+    apiserver.version_registry.ttl = 0
+
+    with MockTestServer(our_api_handler) as p:
+
+        records = [dict(key="r1", mt=110, t1=100, t2=110)]
+        r = p.put("http://localhost/api/v1/records", json.dumps(records).encode())
+        assert r.status == 200
+        time.sleep(0.3)
+        r = p.get("http://localhost/api/v1/updates?since=0")
+        since = dejsonize(r)["server_time"]
+
+        # Another process writes a record. The mtime of the db is cached,
+        # so the poll exits early, but must not move the client past it.
+        try:
+            db = PooledItemDB(apiserver.user2filename(USER))
+            with db:
+                st = time.time()
+                db.put_one("records", key="r2", mt=st, t1=st, t2=st, st=st)
+            db.close()
+            r = p.get(f"http://localhost/api/v1/updates?since={since}")
+            d = dejsonize(r)
+            assert d["reset"] == 0 and d["records"] == []
+            assert d["server_time"] <= since
+        finally:
+            apiserver.version_registry.ttl = ori_ttl
+
+        # Once the cached mtime expires, the record is received
+        time.sleep(apiserver.stat_cache.ttl)
+        r = p.get(f"http://localhost/api/v1/updates?since={d['server_time']}")
+        assert [x["key"] for x in dejsonize(r)["records"]] == ["r2"]
+
+
+def test_updates_paginated():
+    clear_test_db()
+
+    with MockTestServer(our_api_handler) as p:
+
+        # Add 25 records in three pushes
+        for i0, i1 in [(0, 5), (5, 15), (15, 25)]:
+            records = [
+                dict(key=f"r{i:02d}", mt=110, t1=i, t2=i + 1) for i in range(i0, i1)
+            ]
+            r = p.put("http://localhost/api/v1/records", json.dumps(records).encode())
+            assert r.status == 200
+        settings = [dict(key="pref1", mt=110, value="xx")]
+        r = p.put("http://localhost/api/v1/settings", json.dumps(settings).encode())
+        assert r.status == 200
+
+        # Force a reset
+        r = p.put("http://localhost/api/v1/forcereset")
+        assert r.status == 200
+
+        # The first page
+        r = p.get("http://localhost/api/v1/updates?since=1&limit=7")
+        assert r.status == 200
+        d = dejsonize(r)
+        assert d["reset"] is True
+        assert len(d["records"]) == 7
+        assert len(d["settings"]) == 1
+        assert d["next"]
+        keys = [x["key"] for x in d["records"]]
+        server_time = d["server_time"]
+
+        # Meanwhile, a record is updated
+        records = [dict(key="r02", mt=120, t1=2, t2=3)]
+        r = p.put("http://localhost/api/v1/records", json.dumps(records).encode())
+        assert r.status == 200
+
+        # Get the other pages
+        while d["next"]:
+            r = p.get("http://localhost/api/v1/updates?limit=7&cursor=" + d["next"])
+            assert r.status == 200
+            d = dejsonize(r)
+            assert d["reset"] is False
+            assert d["settings"] == []
+            assert len(d["records"]) <= 7
+            keys += [x["key"] for x in d["records"]]
+
+        # We got all records, and the updated record twice
+        assert len(keys) == 26
+        assert keys.count("r02") == 2
+        assert set(keys) == {f"r{i:02d}" for i in range(25)}
+
+        # The pages are sorted by (st, key)
+        records = get_from_db("records")
+        records.sort(key=lambda x: (x["st"], x["key"]))
+        assert [x["key"] for x in records] == [k for k in keys if k != "r02"] + ["r02"]
+
+        # Without reset, we get the records since the given time
+        r = p.get(f"http://localhost/api/v1/updates?since={server_time}&limit=7")
+        assert r.status == 200
+        d = dejsonize(r)
+        assert d["reset"] is False
+        assert [x["key"] for x in d["records"]] == ["r02"]
+        assert d["next"] is None
+
+        # Fails
+        r = p.get("http://localhost/api/v1/updates?since=1&limit=foo")
+        assert r.status == 400
+        r = p.get("http://localhost/api/v1/updates?limit=7&cursor=foo")
+        assert r.status == 400
+
+
+def test_streaming():
+    clear_test_db()
+
+    # Use small chunks, so that we get multiple
+    chunk_size = apiserver.STREAM_CHUNK_SIZE
+    apiserver.STREAM_CHUNK_SIZE = 7
+
+    try:
+        with MockTestServer(our_api_handler) as p:
+
+            # Nothing there yet
+            r = p.get("http://localhost/api/v1/updates?since=0&stream=1")
+            assert r.status == 200
+            assert dejsonize(r)["records"] == []
+            r = p.get("http://localhost/api/v1/settings?stream=1")
+            assert r.status == 200
+            assert dejsonize(r)["settings"] == []
+
+            # Add records and settings
+            records = [dict(key=f"r{i:02d}", mt=110, t1=i, t2=i + 1) for i in range(25)]
+            r = p.put("http://localhost/api/v1/records", json.dumps(records).encode())
+            assert r.status == 200
+            settings = [dict(key=f"pref{i}", mt=110, value="xx") for i in range(9)]
+            r = p.put("http://localhost/api/v1/settings", json.dumps(settings).encode())
+            assert r.status == 200
+
+            # The streamed response is the same as the normal response
+            for url in [
+                "http://localhost/api/v1/updates?since=0",
+                "http://localhost/api/v1/settings",
+            ]:
+                r1 = p.get(url)
+                r2 = p.get(url + ("&" if "?" in url else "?") + "stream=1")
+                assert r1.status == 200 and r2.status == 200
+                assert r2.headers["content-type"] == "application/json"
+                d1, d2 = dejsonize(r1), dejsonize(r2)
+                d1.pop("server_time")
+                d2.pop("server_time")
+                for what in ("records", "settings"):
+                    if what in d1:
+                        d1[what].sort(key=lambda x: x["key"])
+                        d2[what].sort(key=lambda x: x["key"])
+                assert d1 == d2
+
+            # Streamed records are sorted by st
+            r = p.get("http://localhost/api/v1/updates?since=0&stream=1")
+            d = dejsonize(r)
+            assert len(d["records"]) == 25
+            sts = [x["st"] for x in d["records"]]
+            assert sts == sorted(sts)
+
+            # Streaming also works when nothing changed
+            since = d["server_time"] + 1
+            r = p.get(f"http://localhost/api/v1/updates?since={since}&stream=1")
+            assert r.status == 200
+            assert dejsonize(r)["records"] == []
+
+    finally:
+        apiserver.STREAM_CHUNK_SIZE = chunk_size
+
+
+def test_columns():
+    clear_test_db()
+
+    with MockTestServer(our_api_handler) as p:
+
+        # Push records in the columnar format
+        records = [
+            dict(key="r1", mt=110, t1=100, t2=110, ds="foo"),
+            dict(key="r2", mt=110, t1=120, t2=130),
+        ]
+        body = json.dumps(apiserver._to_columns(records)).encode()
+        r = p.put("http://localhost/api/v1/records", body)
+        assert r.status == 200
+        assert dejsonize(r)["accepted"] == ["r1", "r2"]
+
+        # The null ds was omitted
+        records2 = sorted(get_from_db("records"), key=lambda x: x["key"])
+        assert [x["key"] for x in records2] == ["r1", "r2"]
+        assert records2[0]["ds"] == "foo"
+        assert "ds" not in records2[1]
+
+        # Get updates in the columnar format
+        r = p.get("http://localhost/api/v1/updates?since=0&format=columns")
+        assert r.status == 200
+        d = dejsonize(r)
+        assert d["records"]["count"] == 2
+        assert d["settings"] == {"count": 0, "columns": {}, "missing": {}}
+        records3 = sorted(apiserver._from_columns(d["records"]), key=lambda x: x["key"])
+        assert records3 == records2
+
+        # Also in pages
+        r = p.get("http://localhost/api/v1/updates?since=0&format=columns&limit=1")
+        assert r.status == 200
+        d = dejsonize(r)
+        assert d["records"]["count"] == 1
+        url = "http://localhost/api/v1/updates?format=columns&limit=1&cursor="
+        r = p.get(url + d["next"])
+        assert r.status == 200
+        assert dejsonize(r)["records"]["count"] == 1
+
+        # A null value is not a missing field
+        settings = [dict(key="s1", mt=110, value=None), dict(key="s2", mt=110, value=2)]
+        body = json.dumps(apiserver._to_columns(settings)).encode()
+        r = p.put("http://localhost/api/v1/settings", body)
+        assert dejsonize(r)["accepted"] == ["s1", "s2"]
+        r = p.get("http://localhost/api/v1/updates?since=0&format=columns")
+        settings2 = apiserver._from_columns(dejsonize(r)["settings"])
+        settings2 = sorted(settings2, key=lambda x: x["key"])
+        assert [x["value"] for x in settings2] == [None, 2]
+
+        # Without "missing" (older clients), null means missing
+        ob = {"count": 2, "columns": {"key": ["r1", "r2"], "ds": ["foo", None]}}
+        assert apiserver._from_columns(ob) == [dict(key="r1", ds="foo"), dict(key="r2")]
+
+        # Fails
+        r = p.get("http://localhost/api/v1/updates?since=0&format=foo")
+        assert r.status == 400
+        r = p.get("http://localhost/api/v1/updates?since=0&format=columns&stream=1")
+        assert r.status == 400
+        for ob in [
+            {"count": 2, "columns": {"key": ["r1"]}},
+            {"count": 2, "columns": {}},
+            {"count": "2", "columns": {"key": ["r1", "r2"]}},
+            {"columns": {"key": ["r1", "r2"]}},
+            {"count": 2, "columns": {"key": ["r1", "r2"]}, "missing": []},
+            {"count": 2, "columns": {"key": ["r1", "r2"]}, "missing": {"key": [2]}},
+        ]:
+            with raises(TypeError):
+                apiserver._from_columns(ob)
+
+
+def test_compression():
+    clear_test_db()
+    apiserver.updates_cache.clear()
+    headers = {"accept-encoding": "gzip"}
+
+    with MockTestServer(our_api_handler) as p:
+
+        # Small responses are not compressed
+        r = p.get("http://localhost/api/v1/updates?since=0", headers=headers)
+        assert r.status == 200
+        assert "content-encoding" not in r.headers
+
+        # Add records
+        records = [dict(key=f"r{i:03d}", mt=110, t1=i, t2=i + 1) for i in range(100)]
+        r = p.put("http://localhost/api/v1/records", json.dumps(records).encode())
+        assert r.status == 200
+
+        # Larger responses are, if the client accepts it
+        r1 = p.get("http://localhost/api/v1/updates?since=0", headers=headers)
+        assert r1.status == 200
+        assert r1.headers["content-encoding"] == "gzip"
+        assert len(json.loads(gzip.decompress(r1.body))["records"]) == 100
+        r = p.get("http://localhost/api/v1/updates?since=0")
+        assert r.status == 200
+        assert "content-encoding" not in r.headers
+        assert len(dejsonize(r)["records"]) == 100
+
+        # A response with all items is cached
+        r2 = p.get("http://localhost/api/v1/updates?since=0", headers=headers)
+        assert r2.body == r1.body
+
+        # Also after a reset
+        r = p.put("http://localhost/api/v1/forcereset")
+        r1 = p.get("http://localhost/api/v1/updates?since=5", headers=headers)
+        r2 = p.get("http://localhost/api/v1/updates?since=7", headers=headers)
+        assert r1.status == 200 and r2.status == 200
+        assert r2.body == r1.body
+        d = json.loads(gzip.decompress(r2.body))
+        assert d["reset"] is True
+        assert len(d["records"]) == 100
+
+        # Including the pages
+        url = "http://localhost/api/v1/updates?since=5&limit=60"
+        r1 = p.get(url, headers=headers)
+        d = json.loads(gzip.decompress(r1.body))
+        url = "http://localhost/api/v1/updates?limit=60&cursor=" + d["next"]
+        r1 = p.get(url, headers=headers)
+        r2 = p.get(url, headers=headers)
+        assert r2.body == r1.body
+        assert len(json.loads(gzip.decompress(r2.body))["records"]) == 40
+
+        # The cache is invalidated by a write
+        records = [dict(key="r000", mt=time.time() + 1, t1=0, t2=2)]
+        r = p.put("http://localhost/api/v1/records", json.dumps(records).encode())
+        assert r.status == 200
+        r3 = p.get("http://localhost/api/v1/updates?since=7", headers=headers)
+        assert r3.body != r2.body
+        d = json.loads(gzip.decompress(r3.body))
+        assert [x for x in d["records"] if x["key"] == "r000"][0]["t2"] == 2
+
+        # Updates since a given time are not cached
+        since = d["server_time"] - 0.5
+        n = len(apiserver.updates_cache._entries)
+        r = p.get(f"http://localhost/api/v1/updates?since={since}", headers=headers)
+        assert r.status == 200
+        assert len(apiserver.updates_cache._entries) == n
+
+
+def test_compression_thread_use():
+    request = FakeRequest()
+    request.headers["accept-encoding"] = "gzip"
+    calls = []
+    ori_asyncthis = apiserver.asyncthis
+
+    async def asyncthis(func, *args, **kwargs):
+        calls.append(func.__name__)
+        return await ori_asyncthis(func, *args, **kwargs)
+
+    apiserver.asyncthis = asyncthis
+    try:
+        # Small responses are encoded inline, without a thread
+        status, headers, body = swait(apiserver._encode_response(request, {"a": 1}))
+        assert calls == []
+        assert "content-encoding" not in headers
+        assert json.loads(body.decode()) == {"a": 1}
+        # Larger responses are compressed in a thread
+        response = {"a": "x" * apiserver.API_MIN_COMPRESS_SIZE}
+        status, headers, body = swait(apiserver._encode_response(request, response))
+        assert calls == ["_compress_response_timed"]
+        assert headers["content-encoding"] == "gzip"
+        assert json.loads(gzip.decompress(body).decode()) == response
+    finally:
+        apiserver.asyncthis = ori_asyncthis
+
+
+def test_etag():
+    clear_test_db()
+
+    with MockTestServer(our_api_handler) as p:
+
+        settings = [dict(key="pref1", mt=110, value="xx")]
+        r = p.put("http://localhost/api/v1/settings", json.dumps(settings).encode())
+        assert r.status == 200
+
+        # Settings have an ETag
+        r = p.get("http://localhost/api/v1/settings")
+        assert r.status == 200
+        etag = r.headers["etag"]
+        assert etag.startswith('"') and etag.endswith('"')
+        assert r.headers["cache-control"] == "no-cache"
+
+        # Which is used to tell the client that nothing has changed
+        r = p.get("http://localhost/api/v1/settings", headers={"if-none-match": etag})
+        assert r.status == 304
+        assert r.body == b""
+        assert r.headers["etag"] == etag
+
+        # Until something changes
+        settings = [dict(key="pref2", mt=110, value="yy")]
+        r = p.put("http://localhost/api/v1/settings", json.dumps(settings).encode())
+        assert r.status == 200
+        r = p.get("http://localhost/api/v1/settings", headers={"if-none-match": etag})
+        assert r.status == 200
+        assert r.headers["etag"] != etag
+        assert len(dejsonize(r)["settings"]) == 2
+
+        # Same for updates
+        r = p.get("http://localhost/api/v1/updates?since=0")
+        assert r.status == 200
+        etag = r.headers["etag"]
+        since = dejsonize(r)["server_time"]
+        url = f"http://localhost/api/v1/updates?since={since}"
+        r = p.get(url, headers={"if-none-match": etag})
+        assert r.status == 304
+        assert r.body == b""
+
+        # Also with long-polling
+        t0 = time.perf_counter()
+        r = p.get(url + "&wait=0.5", headers={"if-none-match": etag})
+        assert r.status == 304
+        assert time.perf_counter() - t0 > 0.49
+
+        # A change
+        records = [dict(key="r1", mt=110, t1=100, t2=110)]
+        r = p.put("http://localhost/api/v1/records", json.dumps(records).encode())
+        assert r.status == 200
+        r = p.get(url, headers={"if-none-match": etag})
+        assert r.status == 200
+        assert r.headers["etag"] != etag
+        assert [x["key"] for x in dejsonize(r)["records"]] == ["r1"]
+
+        # A reset is never "not modified", even if the ETag matches
+        r = p.put("http://localhost/api/v1/forcereset")
+        assert r.status == 200
+        r = p.get("http://localhost/api/v1/updates?since=0")
+        etag = r.headers["etag"]
+        since = dejsonize(r)["server_time"]
+        db, _ = apiserver.get_user_db(USER)
+        with db:
+            ob = db.select_one("userinfo", "key == 'reset_time'")
+            ob["value"] = since + 1
+            db.put("userinfo", ob)
+        url = f"http://localhost/api/v1/updates?since={since}"
+        r = p.get(url, headers={"if-none-match": etag})
+        assert r.status == 200
+        assert r.headers["etag"] == etag
+        assert dejsonize(r)["reset"] is True
+
+
+def test_busy():
+    clear_test_db()
+
+    # Make the write lane look full
+    lane = scheduler.get_lane("write")
+    max_queue = lane.max_queue
+    lane.max_queue = 0
+
+    try:
+        with MockTestServer(our_api_handler) as p:
+
+            # Writes are rejected, so the client will try again later
+            records = [dict(key="r1", mt=110, t1=100, t2=110)]
+            r = p.put("http://localhost/api/v1/records", json.dumps(records).encode())
+            assert r.status == 503
+            assert "retry-after" in r.headers
+
+            # But reads still work
+            r = p.get("http://localhost/api/v1/updates?since=0")
+            assert r.status == 200
+
+    finally:
+        lane.max_queue = max_queue
+
+
+def test_group_commit():
+    clear_test_db()
+    calls = []
+    push_many = apiserver._push_many
+
+    def push_many_and_count(user, pushes):
+        calls.append(len(pushes))
+        return push_many(user, pushes)
+
+    async def push(what, items):
+        request = FakeRequest(body=items)
+        return await apiserver.put_items_handler(request, USER, what)
+
+    async def push_concurrently():
+        return await asyncio.gather(
+            push("records", [dict(key="r1", mt=110, t1=100, t2=110)]),
+            push("settings", [dict(key="pref1", mt=110, value="xx")]),
+            push("records", [dict(key="r1", mt=120, t1=100, t2=120), {"mt": 3}]),
+        )
+
+    # Pushes that arrive together are applied in one transaction
+    apiserver._push_many = push_many_and_count
+    try:
+        results = swait(push_concurrently())
+    finally:
+        apiserver._push_many = push_many
+    assert calls == [3]
+
+    # But each gets its own result
+    assert [r[2]["accepted"] for r in results] == [["r1"], ["pref1"], ["r1"]]
+    assert [len(r[2]["errors"]) for r in results] == [0, 0, 1]
+
+    # And they're applied in order
+    records = get_from_db("records")
+    assert len(records) == 1 and records[0]["t2"] == 120
+    assert len(get_from_db("settings")) == 1
+
+
+def test_stats():
+    clear_test_db()
+
+    def get_stats(p, t1, t2, bin="", tz=0):
+        url = f"http://localhost/api/v1/stats?t1={t1}&t2={t2}&bin={bin}&tz={tz}"
+        r = p.get(url)
+        assert r.status == 200, r.body.decode()
+        return [(b["t1"], b["t2"], b["stats"]) for b in dejsonize(r)["bins"]]
+
+    def get_expected_stats(t1, t2, bin="", tz=0):
+        # Brute force, like RecordStore.get_stats() in the client
+        edges = get_bin_edges(t1, t2, bin, tz)
+        records = get_from_db("records")
+        bins = []
+        for bin_t1, bin_t2 in zip(edges[:-1], edges[1:]):
+            stats = {}
+            for r in records:
+                tagz = get_tagz(r)
+                r_t2 = time.time() if r["t1"] == r["t2"] else r["t2"]
+                t = min(bin_t2, r_t2) - max(bin_t1, r["t1"])
+                if tagz and t > 0:
+                    stats[tagz] = stats.get(tagz, 0) + t
+            bins.append((bin_t1, bin_t2, stats))
+        return bins
+
+    def check_stats(p, t1, t2, bin="", tz=0):
+        bins1 = get_stats(p, t1, t2, bin, tz)
+        bins2 = get_expected_stats(t1, t2, bin, tz)
+        assert len(bins1) == len(bins2)
+        for (a1, a2, stats1), (b1, b2, stats2) in zip(bins1, bins2):
+            assert a1 == b1 and a2 == b2
+            assert stats1.keys() == stats2.keys()
+            for tagz in stats1:
+                assert abs(stats1[tagz] - stats2[tagz]) < 2  # running records
+        return bins1
+
+    day = 86400
+    t0 = 1614556800  # monday 1 March 2021, UTC
+    records = []
+    for i in range(60):
+        t1 = t0 + i * 37 * 3600 + i * 97  # spread over ~3 months
+        ds = ["#work #code", "#work", "lunch", "#Code #work meeting"][i % 4]
+        records.append(dict(key=f"r{i}", mt=110, t1=t1, t2=t1 + 2000 + i * 500, ds=ds))
+    records.append(dict(key="long", mt=110, t1=t0 + 5, t2=t0 + 30 * day, ds="#long"))
+
+    with MockTestServer(our_api_handler) as p:
+
+        # Empty
+        assert get_stats(p, t0, t0 + day) == [(t0, t0 + day, {})]
+
+        r = p.put("http://localhost/api/v1/records", json.dumps(records).encode())
+        assert r.status == 200
+
+        # Totals, and per day, week and month, in different timezones
+        bins = check_stats(p, t0, t0 + 7 * day)
+        assert set(bins[0][2].keys()) == {"#code #work", "#work", "#untagged", "#long"}
+        assert len(check_stats(p, t0, t0 + 7 * day, "day")) == 7
+        assert len(check_stats(p, t0 + 1234, t0 + 7 * day - 56, "day", 330)) == 8
+        assert len(check_stats(p, t0 - 3 * day, t0 + 30 * day, "week", -60)) == 6
+        assert len(check_stats(p, t0, t0 + 90 * day, "month", 60)) == 3
+        assert len(check_stats(p, t0 + 600, t0 + 3000)) == 1
+
+        # Edits, hidden records, and running records are reflected
+        records = [
+            dict(key="r0", mt=120, t1=t0 + 100, t2=t0 + 9000, ds="#other"),
+            dict(key="r1", mt=120, t1=t0 + 200, t2=t0 + 300, ds="HIDDEN #work"),
+            dict(key="r2", mt=120, t1=t0, t2=t0, ds="#running"),
+            dict(key="long", mt=120, t1=t0 + 5, t2=t0 + 6, ds="#long"),
+        ]
+        r = p.put("http://localhost/api/v1/records", json.dumps(records).encode())
+        assert r.status == 200
+        bins = check_stats(p, t0, t0 + 7 * day, "day")
+        assert "#other" in bins[0][2] and "#running" in bins[6][2]
+        check_stats(p, t0, time.time() + day, "month")
+
+        # Invalid requests
+        for query in [
+            "",
+            "t1=0",
+            "t1=x&t2=10",
+            "t1=10&t2=0",
+            "t1=0&t2=10&bin=year",
+            "t1=0&t2=10&tz=x",
+            "t1=0&t2=10&tz=9999",
+            f"t1=0&t2={t0}&bin=day",
+        ]:
+            r = p.get("http://localhost/api/v1/stats?" + query)
+            assert r.status == 400, query
+
+    # The stats are rebuilt when the schema changes
+    db = ItemDB(apiserver.user2filename(USER))
+    with db:
+        db.put_one("userinfo", key="schema_version", value=0)
+        db.put_one("stats", key="0/#foo", bin=0, tagz="#foo", t=100)
+    apiserver.db_pool.invalidate(apiserver.user2filename(USER))
+    with MockTestServer(our_api_handler) as p:
+        bins = check_stats(p, 0, t0 + 7 * day)
+        assert "#foo" not in bins[0][2]
+
+
+def test_get_records():
+    clear_test_db()
+
+    day = 86400
+    t0 = 1614556800
+    records = [
+        dict(key="r1", mt=110, t1=t0 - 100, t2=t0 + 100, ds="#foo"),
+        dict(key="r2", mt=110, t1=t0 + 200, t2=t0 + 300, ds="#foo #Bar"),
+        dict(key="r3", mt=110, t1=t0 + day, t2=t0 + day + 100, ds="#bar"),
+        dict(key="r4", mt=110, t1=t0 + 400, t2=t0 + 500, ds="HIDDEN #foo"),
+        dict(key="r5", mt=110, t1=t0 - 20 * day, t2=t0 + 20 * day, ds="long"),
+        dict(key="r6", mt=110, t1=t0 + 600, t2=t0 + 600, ds="#running"),
+        dict(key="r7", mt=110, t1=t0 - 6 * day, t2=t0 - 5 * day, ds="#foo"),
+    ]
+
+    def get_keys(p, query):
+        r = p.get("http://localhost/api/v1/records?" + query)
+        assert r.status == 200, r.body.decode()
+        return [record["key"] for record in dejsonize(r)["records"]]
+
+    with MockTestServer(our_api_handler) as p:
+
+        assert get_keys(p, f"timerange={t0}-{t0 + day}") == []
+
+        r = p.put("http://localhost/api/v1/records", json.dumps(records).encode())
+        assert r.status == 200
+
+        # Overlapping records, including long and running ones, sorted by t1
+        assert get_keys(p, f"timerange={t0}-{t0 + day}") == ["r5", "r1", "r2", "r6"]
+        assert get_keys(p, f"timerange={t0 + 150}-{t0 + 250}") == ["r5", "r2"]
+        assert get_keys(p, f"timerange={t0 + 700}-{t0 + 800}") == ["r5", "r6"]
+        assert get_keys(p, f"timerange={t0 - 7 * day}-{t0 - 6 * day}") == ["r5"]
+        assert get_keys(p, f"timerange={t0 - 7 * day}-{t0 - 5 * day}") == ["r5", "r7"]
+        assert get_keys(p, f"timerange={t0 + 30 * day}-{t0 + 31 * day}") == ["r6"]
+
+        # Filter by tags
+        query = f"timerange={t0 - day}-{t0 + 2 * day}"
+        assert get_keys(p, query + "&tags=foo") == ["r1", "r2"]
+        assert get_keys(p, query + "&tags=%23bar") == ["r2", "r3"]
+        assert get_keys(p, query + "&tags=foo,bar") == ["r2"]
+        assert get_keys(p, query + "&tags=Foo,spam") == []
+
+        # Changes are reflected
+        records = [
+            dict(key="r5", mt=120, t1=t0 - 20 * day, t2=t0 - 19 * day, ds="long"),
+            dict(key="r6", mt=120, t1=t0 + 600, t2=t0 + 700, ds="#running"),
+        ]
+        r = p.put("http://localhost/api/v1/records", json.dumps(records).encode())
+        assert r.status == 200
+        assert get_keys(p, f"timerange={t0}-{t0 + day}") == ["r1", "r2", "r6"]
+        assert get_keys(p, f"timerange={t0 + 30 * day}-{t0 + 31 * day}") == []
+
+        # Columns
+        query = f"timerange={t0}-{t0 + 250}&format=columns"
+        r = p.get("http://localhost/api/v1/records?" + query)
+        assert r.status == 200
+        assert dejsonize(r)["records"]["columns"]["key"] == ["r1", "r2"]
+
+        # Invalid requests
+        for query in ["", "timerange=5", "timerange=a-b", "timerange=5-1"]:
+            r = p.get("http://localhost/api/v1/records?" + query)
+            assert r.status == 400, query
+        r = p.get("http://localhost/api/v1/records?timerange=0-1&format=xml")
+        assert r.status == 400
+
+
+def test_tags():
+    clear_test_db()
+
+    t0 = 1614556800
+    records = [
+        dict(key="r1", mt=110, t1=t0, t2=t0 + 100, ds="#foo"),
+        dict(key="r2", mt=110, t1=t0 + 200, t2=t0 + 300, ds="#foo #Bar"),
+        dict(key="r3", mt=110, t1=t0 + 400, t2=t0 + 450, ds="no tags"),
+        dict(key="r4", mt=110, t1=t0 + 500, t2=t0 + 600, ds="HIDDEN #foo"),
+    ]
+
+    def get_tags(p):
+        r = p.get("http://localhost/api/v1/tags")
+        assert r.status == 200
+        return dejsonize(r)["tags"]
+
+    def get_keys(p, tags):
+        url = f"http://localhost/api/v1/records?timerange={t0}-{t0 + 1000}&tags={tags}"
+        r = p.get(url)
+        assert r.status == 200
+        return [record["key"] for record in dejsonize(r)["records"]]
+
+    with MockTestServer(our_api_handler) as p:
+
+        assert get_tags(p) == {}
+
+        r = p.put("http://localhost/api/v1/records", json.dumps(records).encode())
+        assert r.status == 200
+        assert get_tags(p) == {
+            "#foo": dict(count=2, t=200),
+            "#bar": dict(count=1, t=100),
+            "#untagged": dict(count=1, t=50),
+        }
+
+        # Tag filters use the index when the tag has few records
+        max_tag_lookup = apiserver.MAX_TAG_LOOKUP
+        try:
+            for apiserver.MAX_TAG_LOOKUP in (0, 1000):
+                assert get_keys(p, "foo") == ["r1", "r2"]
+                assert get_keys(p, "foo,bar") == ["r2"]
+                assert get_keys(p, "untagged") == ["r3"]
+                assert get_keys(p, "spam") == []
+        finally:
+            apiserver.MAX_TAG_LOOKUP = max_tag_lookup
+
+        # Edit and hide records, e.g. rename a tag
+        records = [
+            dict(key="r1", mt=120, t1=t0, t2=t0 + 100, ds="#spam"),
+            dict(key="r2", mt=120, t1=t0 + 200, t2=t0 + 310, ds="#spam #bar"),
+            dict(key="r3", mt=120, t1=t0 + 400, t2=t0 + 450, ds="HIDDEN no tags"),
+        ]
+        r = p.put("http://localhost/api/v1/records", json.dumps(records).encode())
+        assert r.status == 200
+        assert get_tags(p) == {
+            "#spam": dict(count=2, t=210),
+            "#bar": dict(count=1, t=110),
+        }
+        assert get_keys(p, "foo") == []
+        assert get_keys(p, "spam") == ["r1", "r2"]
+
+        r = p.put("http://localhost/api/v1/tags")
+        assert r.status == 405
+
+
+def test_metrics():
+    clear_test_db()
+    requests_total = apiserver.requests_total
+    updates_total = apiserver.updates_total
+    pushed_items = apiserver.pushed_items
+
+    n_get = requests_total.get("updates", "GET", 200)
+    n_put = requests_total.get("records", "PUT", 200)
+    n_queried = updates_total.get("queried")
+    n_early = updates_total.get("registry") + updates_total.get("mtime")
+    n_accepted = pushed_items.get("records", "accepted")
+    n_failed = pushed_items.get("records", "failed")
+
+    with MockTestServer(our_api_handler) as p:
+
+        records = [dict(key="r1", mt=110, t1=100, t2=110), dict(key="r2", mt=110)]
+        r = p.put("http://localhost/api/v1/records", json.dumps(records).encode())
+        assert r.status == 200
+
+        r = p.get("http://localhost/api/v1/updates?since=0")
+        assert r.status == 200
+        since = time.time() + 10
+        r = p.get(f"http://localhost/api/v1/updates?since={since}")
+        assert r.status == 200
+
+        r = p.get("http://localhost/api/v1/foo")
+        assert r.status == 404
+
+    assert requests_total.get("records", "PUT", 200) == n_put + 1
+    assert requests_total.get("updates", "GET", 200) == n_get + 2
+    assert requests_total.get("other", "GET", 404) >= 1
+    assert apiserver.request_duration.get("updates", "GET")[1] >= 2
+    assert pushed_items.get("records", "accepted") == n_accepted + 1
+    assert pushed_items.get("records", "failed") == n_failed + 1
+
+    # The second update exits early, either via the registry or the mtime
+    assert updates_total.get("queried") == n_queried + 1
+    n_early2 = updates_total.get("registry") + updates_total.get("mtime")
+    assert n_early2 == n_early + 1
+
+    # The metrics are rendered, including the scheduler and db pool stats
+    text = apiserver.registry.render()
+    assert 'timetagger_requests_total{route="updates",method="GET"' in text
+    assert 'timetagger_scheduler_completed{lane="write"}' in text
+    assert "timetagger_dbpool_open " in text
+
+
+def test_tracing():
+    clear_test_db()
+    tracer = apiserver.tracer
+    tracer.configure(slow_threshold=0, sample_rate=1)
+
+    try:
+        with MockTestServer(our_api_handler) as p:
+            records = [dict(key="r1", mt=110, t1=100, t2=110)]
+            r = p.put("http://localhost/api/v1/records", json.dumps(records).encode())
+            assert r.status == 200
+            r = p.get("http://localhost/api/v1/updates?since=0")
+            assert r.status == 200
+        traces = tracer.dump(clear=True)
+    finally:
+        tracer.configure(enabled=False)
+
+    assert [t["name"] for t in traces] == ["PUT records", "GET updates"]
+    assert [t["status"] for t in traces] == [200, 200]
+    names1 = [s["name"] for s in traces[0]["spans"]]
+    names2 = [s["name"] for s in traces[1]["spans"]]
+    assert "queue_wait:write" in names1 and "query:push_many" in names1
+    assert "db_open" in names1 and "ensure_schema" in names1
+    assert "queue_wait:read" in names2 and "query:get_updates" in names2
+    assert "serialize" in names2
+
+
+def test_updates_wait():
+    clear_test_db()
+
+    with MockTestServer(our_api_handler) as p:
+
+        # Post a record
+        records = [dict(key="r1", mt=110, t1=100, t2=110, ds="A record 1!")]
+        r = p.put("http://localhost/api/v1/records", json.dumps(records).encode())
+        assert r.status == 200
+
+        # If there are updates, the response is immediate
+        t0 = time.perf_counter()
+        r = p.get("http://localhost/api/v1/updates?since=0&wait=2")
+        assert r.status == 200
+        assert time.perf_counter() - t0 < 1
+        d = dejsonize(r)
+        assert len(d["records"]) == 1
+        st1 = d["server_time"]
+
+        # Otherwise it waits for the given time
+        t0 = time.perf_counter()
+        r = p.get(f"http://localhost/api/v1/updates?since={st1}&wait=0.5")
+        assert r.status == 200
+        assert time.perf_counter() - t0 > 0.49
+        assert dejsonize(r)["records"] == []
+
+        # Wait must be a (finite) number
+        for wait in ("foo", "nan", "inf", "-inf"):
+            r = p.get(f"http://localhost/api/v1/updates?since={st1}&wait={wait}")
+            assert r.status == 400
+
+        # Negative is no wait
+        t0 = time.perf_counter()
+        r = p.get(f"http://localhost/api/v1/updates?since={st1}&wait=-5")
+        assert r.status == 200
+        assert time.perf_counter() - t0 < 0.5
+
+    # A push wakes up a waiting request
+    async def poll():
+        request = FakeRequest(dict(since=str(st1), wait="10"))
+        return await apiserver.get_updates_handler(request, USER)
+
+    async def push():
+        await asyncio.sleep(0.5)
+        records = [dict(key="r2", mt=110, t1=200, t2=210, ds="A record 2!")]
+        request = FakeRequest(body=records)
+        await apiserver.put_items_handler(request, USER, "records")
+
+    async def poll_and_push():
+        return await asyncio.gather(poll(), push())
+
+    t0 = time.perf_counter()
+    response, _ = swait(poll_and_push())
+    status, headers, d = normalize_response(response)
+    assert 0.49 < time.perf_counter() - t0 < 5
+    assert [x["key"] for x in d["records"]] == ["r2"]
+    assert apiserver.change_notifier.count() == 0
+
+
+class FakeStreamRequest:
+    """A request for an event stream, that the client can disconnect."""
+
+    def __init__(self):
+        self.disconnected = False
+        self._wakeup_event = None
+
+    async def sleep_while_connected(self, seconds):
+        if self.disconnected:
+            raise IOError("Cannot wait for connection that already disconnected.")
+        self._wakeup_event = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._wakeup_event.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        if self.disconnected:
+            raise DisconnectedError()
+
+    async def wakeup(self):
+        if self._wakeup_event is not None:
+            self._wakeup_event.set()
+
+    async def disconnect(self):
+        self.disconnected = True
+        await self.wakeup()
+
+
+def test_events():
+    clear_test_db()
+
+    async def listen():
+        chunks = []
+        stream = apiserver._event_stream(FakeStreamRequest(), USER)
+        async for chunk in stream:
+            chunks.append(chunk)
+            if len(chunks) == 2:
+                break
+        await stream.aclose()
+        return chunks
+
+    async def push():
+        await asyncio.sleep(0.3)
+        records = [dict(key="r1", mt=110, t1=100, t2=110, ds="A record 1!")]
+        request = FakeRequest(body=records)
+        await apiserver.put_items_handler(request, USER, "records")
+
+    async def listen_and_push():
+        return await asyncio.gather(listen(), push())
+
+    t0 = time.perf_counter()
+    chunks, _ = swait(listen_and_push())
+    assert time.perf_counter() - t0 < 2
+    assert chunks[0].startswith("event: ready\n")
+    assert chunks[1].startswith("event: changed\n")
+    assert chunks[1].endswith("\n\n")
+    data = json.loads(chunks[1].split("data: ")[1])
+    assert data["server_time"] > 0
+    assert apiserver.change_notifier.count() == 0
+
+
+def test_events_write_by_other_process():
+    clear_test_db()
+    records = [dict(key="r1", mt=110, t1=100, t2=110)]
+    swait(apiserver.put_items_handler(FakeRequest(body=records), USER, "records"))
+
+    async def listen():
+        chunks = []
+        stream = apiserver._event_stream(FakeStreamRequest(), USER)
+        async for chunk in stream:
+            chunks.append(chunk)
+            if len(chunks) == 2:
+                break
+        await stream.aclose()
+        return chunks
+
+    async def write():
+        # Another process writes a record. This process is not notified.
+        await asyncio.sleep(0.3)
+        db = PooledItemDB(apiserver.user2filename(USER))
+        with db:
+            st = time.time()
+            db.put_one("records", key="r2", mt=st, t1=st, t2=st, st=st)
+        db.close()
+
+    async def listen_and_write():
+        return await asyncio.gather(listen(), write())
+
+    ori_interval = apiserver.EVENTS_CHECK_INTERVAL
+    apiserver.EVENTS_CHECK_INTERVAL = 0.1
+    try:
+        t0 = time.perf_counter()
+        chunks, _ = swait(listen_and_write())
+    finally:
+        apiserver.EVENTS_CHECK_INTERVAL = ori_interval
+
+    # The stream sees the new mtime (the stat may be cached for a second)
+    assert chunks[1].startswith("event: changed\n")
+    assert time.perf_counter() - t0 < 3
+    assert apiserver.change_notifier.count() == 0
+
+
+def test_events_disconnect():
+    clear_test_db()
+    request = FakeStreamRequest()
+
+    async def listen():
+        chunks = []
+        async for chunk in apiserver._event_stream(request, USER):
+            chunks.append(chunk)
+        return chunks
+
+    async def disconnect():
+        await asyncio.sleep(0.3)
+        assert apiserver.change_notifier.count() == 1
+        await request.disconnect()
+
+    async def listen_and_disconnect():
+        return await asyncio.gather(listen(), disconnect())
+
+    # The stream ends soon after the client disconnects (not at the next
+    # write or keepalive), and no longer waits for changes.
+    t0 = time.perf_counter()
+    chunks, _ = swait(listen_and_disconnect())
+    assert time.perf_counter() - t0 < 2
+    assert len(chunks) == 1 and chunks[0].startswith("event: ready\n")
+    assert apiserver.change_notifier.count() == 0
+
+    # A client that already disconnected
+    chunks = swait(listen())
+    assert len(chunks) == 1
+    assert apiserver.change_notifier.count() == 0
+
+
 if __name__ == "__main__":
     run_tests(globals())
@@ -1,10 +1,12 @@
 import time
 import asyncio
+import threading
 
 from pytest import raises
 
 from _common import run_tests
 from timetagger.server._utils import swait, swait_multiple, asyncify, asyncthis
+from timetagger.server._scheduler import Scheduler, QueueFullError
 
 
 # %% Helpers
@@ -117,5 +119,74 @@ def test_asyncify():
     assert (t1 - t0) < 2
 
 
+def test_scheduler_lanes():
+    scheduler = Scheduler({"read": (4, 100), "write": (4, 100)})
+    spans = []
+
+    def work(key):
+        t0 = time.perf_counter()
+        time.sleep(0.2)
+        spans.append((key, t0, time.perf_counter()))
+        return key
+
+    # Tasks with the same key run one at a time, other keys run in parallel
+    t0 = time.perf_counter()
+    cos = [scheduler.run("write", key, work, key) for key in "aabb"]
+    swait(asyncio.gather(*cos))
+    assert 0.39 < time.perf_counter() - t0 < 0.6
+    for key in "ab":
+        (_, t1, t2), (_, t3, t4) = sorted(x for x in spans if x[0] == key)
+        assert t3 >= t2
+
+    # Lanes have their own threads, so a busy write lane does not block reads
+    spans.clear()
+    t0 = time.perf_counter()
+    cos = [scheduler.run("write", None, work, "w") for i in range(8)]
+    cos.append(scheduler.run("read", None, work, "r"))
+    swait(asyncio.gather(*cos))
+    assert [x for x in spans if x[0] == "r"][0][2] - t0 < 0.3
+
+    stats = scheduler.get_stats()
+    assert stats["write"]["completed"] == 12
+    assert stats["read"]["completed"] == 1
+    assert stats["write"]["waiting"] == stats["write"]["running"] == 0
+    assert stats["write"]["wait_time_max"] > 0.15
+
+
+def test_scheduler_backpressure():
+    scheduler = Scheduler({"write": (1, 2)})
+
+    async def run_many(n):
+        cos = [scheduler.run("write", None, time.sleep, 0.1) for i in range(n)]
+        return await asyncio.gather(*cos, return_exceptions=True)
+
+    # The queue holds at most two waiting tasks
+    results = swait(run_many(2))
+    assert results == [None, None]
+    results = swait(run_many(4))
+    assert results[:2] == [None, None]
+    assert all(isinstance(x, QueueFullError) for x in results[2:])
+    stats = scheduler.get_stats()["write"]
+    assert stats["rejected"] == 2
+    assert stats["completed"] == 4
+    assert stats["waiting"] == 0
+
+
+def test_scheduler_task_callbacks():
+    scheduler = Scheduler({"read": (2, 100), "write": (1, 100)})
+    calls = []
+    scheduler.add_task_callback(lambda: calls.append(threading.get_ident()))
+
+    # Called in the thread of the task, also when the task fails
+    def fail():
+        raise ZeroDivisionError()
+
+    ident = swait(scheduler.run("write", None, threading.get_ident))
+    assert calls == [ident]
+    with raises(ZeroDivisionError):
+        swait(scheduler.run("read", None, fail))
+    assert len(calls) == 2
+
+
 if __name__ == "__main__":
     run_tests(globals())
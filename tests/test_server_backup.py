@@ -0,0 +1,146 @@
+import io
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import threading
+import contextlib
+
+from _common import run_tests
+from itemdb import ItemDB
+from timetagger.server import _apiserver as apiserver
+from timetagger.server._backup import snapshot, backup, restore, get_last_backup
+from timetagger.server.__main__ import main
+
+
+USER = "test_backup"
+
+
+def clear_test_db():
+    filename = apiserver.user2filename(USER)
+    for fname in (filename, filename + "-wal", filename + "-shm"):
+        if os.path.isfile(fname):
+            os.remove(fname)
+    apiserver.db_pool.notify_write(filename)
+
+
+def push_records(*keys, mt=100):
+    records = [dict(key=key, mt=mt, t1=100, t2=200) for key in keys]
+    apiserver._push_many(USER, [("records", records)])
+
+
+def get_keys(filename=None):
+    if filename is None:
+        db, mtime = apiserver.get_user_db(USER)
+        return sorted(r["key"] for r in db.select_all("records"))
+    con = sqlite3.connect(filename)
+    try:
+        return sorted(row[0] for row in con.execute("SELECT key FROM records"))
+    finally:
+        con.close()
+
+
+def test_snapshot_while_writing():
+    clear_test_db()
+    push_records(*[f"a{i}" for i in range(2000)])
+    backup_dir = tempfile.mkdtemp()
+    dst = os.path.join(backup_dir, "snapshot.db")
+
+    done = []
+
+    def writer():
+        i = 0
+        while not done:
+            push_records(f"b{i}")
+            i += 1
+
+    t = threading.Thread(target=writer)
+    t.start()
+    try:
+        # Small steps, so that there are writes in between
+        time.sleep(0.01)
+        snapshot(apiserver.user2filename(USER), dst, pages=2, sleep=0.001)
+        n_written = len(get_keys())
+    finally:
+        done.append(True)
+        t.join()
+
+    try:
+        # The snapshot is consistent, and contains all records at some point
+        keys = get_keys(dst)
+        assert 2000 <= len(keys) <= n_written
+        db = ItemDB(dst)
+        for what in apiserver.INDICES:
+            db.select_all(what)
+        db.close()
+    finally:
+        shutil.rmtree(backup_dir)
+
+
+def test_backup_and_restore():
+    clear_test_db()
+    push_records("r1")
+    backup_dir = tempfile.mkdtemp()
+
+    try:
+        # First backup
+        assert get_last_backup(backup_dir, USER) is None
+        results = list(backup([USER, "test_backup_nonexistent"], backup_dir))
+        assert [r["key"] for r in results] == [USER]
+        last = get_last_backup(backup_dir, USER)
+        assert last["time"] == results[0]["time"]
+        assert last["size"] > 0
+
+        # Backups are incremental: only databases that changed
+        assert list(backup([USER], backup_dir)) == []
+        assert len(list(backup([USER], backup_dir, force=True))) == 1
+        time.sleep(0.01)
+        push_records("r2")
+        assert len(list(backup([USER], backup_dir))) == 1
+        assert get_last_backup(backup_dir, USER)["time"] > last["time"]
+
+        # Restore, while the db is open
+        time.sleep(0.01)
+        push_records("r3", mt=110)
+        assert get_keys() == ["r1", "r2", "r3"]
+        t0 = time.time()
+        restore(USER, backup_dir)
+        assert get_keys() == ["r1", "r2"]
+
+        # Clients do a full reset
+        assert apiserver.version_registry.get(USER) >= t0
+        result = apiserver._get_updates(USER, t0 - 10)
+        assert result[2]["reset"] is True
+
+    finally:
+        shutil.rmtree(backup_dir)
+
+
+def test_backup_cli():
+    clear_test_db()
+    push_records("r1")
+    backup_dir = tempfile.mkdtemp()
+
+    def run_main(*args):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            assert main(list(args)) == 0
+        return out.getvalue()
+
+    try:
+        out = run_main("backup", backup_dir, USER, "--jobs", "2")
+        assert f"Backed up {USER!r}" in out
+        assert "Backed up 1 of 1 databases" in out
+
+        push_records("r2", mt=110)
+        out = run_main("restore", backup_dir, USER)
+        assert f"Restored {USER!r}" in out
+        assert get_keys() == ["r1"]
+
+    finally:
+        shutil.rmtree(backup_dir)
+
+
+if __name__ == "__main__":
+    run_tests(globals())
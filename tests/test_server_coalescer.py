@@ -0,0 +1,101 @@
+import time
+import asyncio
+
+from _common import run_tests
+from timetagger.server._utils import swait
+from timetagger.server._scheduler import QueueFullError
+from timetagger.server._coalescer import WriteCoalescer
+
+
+def test_coalescer_batches():
+    calls = []
+
+    async def func(key, requests):
+        calls.append((key, list(requests)))
+        await asyncio.sleep(0.01)
+        return [request * 2 for request in requests]
+
+    coalescer = WriteCoalescer(func, max_batch=3)
+
+    async def submit_many():
+        cos = [coalescer.submit(key, i) for i, key in enumerate("aabaa")]
+        return await asyncio.gather(*cos)
+
+    # Requests for the same key are batched, each gets its own result
+    results = swait(submit_many())
+    assert results == [0, 2, 4, 6, 8]
+    assert sorted(calls) == [("a", [0, 1, 3]), ("a", [4]), ("b", [2])]
+
+    # Requests that come later are not batched
+    calls.clear()
+    assert swait(coalescer.submit("a", 5)) == 10
+    assert swait(coalescer.submit("a", 6)) == 12
+    assert calls == [("a", [5]), ("a", [6])]
+
+    # Requests that come in while a call is in flight are combined
+    async def submit_during_call():
+        first = asyncio.ensure_future(coalescer.submit("a", 0))
+        await asyncio.sleep(0.005)
+        cos = [coalescer.submit("a", i) for i in (1, 2)]
+        return await asyncio.gather(first, *cos)
+
+    calls.clear()
+    assert swait(submit_during_call()) == [0, 2, 4]
+    assert calls == [("a", [0]), ("a", [1, 2])]
+
+
+def test_coalescer_no_delay():
+    async def func(key, requests):
+        return requests
+
+    coalescer = WriteCoalescer(func)
+
+    # A request is flushed right away when nothing is in flight
+    async def submit_many():
+        for i in range(100):
+            assert await coalescer.submit("a", i) == i
+
+    t0 = time.perf_counter()
+    swait(submit_many())
+    assert time.perf_counter() - t0 < 0.1
+
+
+def test_coalescer_errors():
+    calls = []
+
+    async def func(key, requests):
+        calls.append(list(requests))
+        if "bad" in requests:
+            raise ValueError("bad request")
+        return requests
+
+    coalescer = WriteCoalescer(func)
+
+    async def submit_many(requests):
+        cos = [coalescer.submit("a", request) for request in requests]
+        return await asyncio.gather(*cos, return_exceptions=True)
+
+    # A bad request does not fail the others
+    results = swait(submit_many(["x", "bad", "y"]))
+    assert results[0] == "x" and results[2] == "y"
+    assert isinstance(results[1], ValueError)
+    assert calls == [["x", "bad", "y"], ["x"], ["bad"], ["y"]]
+
+    # Also on its own
+    results = swait(submit_many(["bad"]))
+    assert isinstance(results[0], ValueError)
+
+    # When the server is busy, the requests are not retried
+    async def busy_func(key, requests):
+        calls.append(list(requests))
+        raise QueueFullError("busy")
+
+    coalescer = WriteCoalescer(busy_func)
+    calls.clear()
+    results = swait(submit_many(["x", "y", "z"]))
+    assert all(isinstance(x, QueueFullError) for x in results)
+    assert calls == [["x", "y", "z"]]
+
+
+if __name__ == "__main__":
+    run_tests(globals())
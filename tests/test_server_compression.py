@@ -0,0 +1,88 @@
+import gzip
+import json
+
+from _common import run_tests
+from timetagger.server import _compression as compression
+from timetagger.server._compression import (
+    choose_encoding,
+    encode_response,
+    compress_response,
+    ResponseCache,
+)
+
+
+def test_choose_encoding():
+    assert choose_encoding("") == ""
+    assert choose_encoding("deflate") == ""
+    assert choose_encoding("gzip") == "gzip"
+    assert choose_encoding("deflate, gzip;q=1.0, *;q=0.5") == "gzip"
+    if compression.brotli is None:
+        assert choose_encoding("gzip, br") == "gzip"
+    else:
+        assert choose_encoding("gzip, br") == "br"
+
+
+def test_encode_response():
+    body = {"records": [{"key": str(i)} for i in range(100)]}
+
+    # Large enough to compress
+    status, headers, data = encode_response(body, "gzip", 100)
+    assert status == 200
+    assert headers["content-type"] == "application/json"
+    assert headers["content-encoding"] == "gzip"
+    assert json.loads(gzip.decompress(data).decode()) == body
+
+    # Too small to compress
+    status, headers, data = encode_response((201, {}, body), "gzip", 10000)
+    assert status == 201
+    assert "content-encoding" not in headers
+    assert json.loads(data.decode()) == body
+
+    # Not a dict body
+    response = 400, {}, "foo"
+    assert encode_response(response, "gzip", 0) is response
+
+
+def test_compress_response():
+    data = json.dumps({"records": [{"key": str(i)} for i in range(100)]}).encode()
+
+    status, headers, body = compress_response((200, {}, data), "gzip", 100)
+    assert headers["content-encoding"] == "gzip"
+    assert gzip.decompress(body) == data
+
+    status, headers, body = compress_response((200, {}, data), "gzip", 10000)
+    assert headers == {} and body == data
+    status, headers, body = compress_response((200, {}, data), "", 0)
+    assert headers == {} and body == data
+
+
+def test_response_cache():
+    cache = ResponseCache(max_size=1000)
+
+    cache.put("a", 1, (200, {}, b"x" * 100))
+    assert cache.get("a", 1) == (200, {}, b"x" * 100)
+    assert cache.get("a", 2) is None
+    assert cache.get("b", 1) is None
+
+    # Headers are copied, so they can be changed by the caller
+    cache.get("a", 1)[1]["foo"] = "bar"
+    assert cache.get("a", 1)[1] == {}
+
+    # Too large bodies are not stored
+    cache.put("b", 1, (200, {}, b"x" * 300))
+    assert cache.get("b", 1) is None
+
+    # LRU eviction when full
+    for key in "bcdefghijk":
+        cache.put(key, 1, (200, {}, b"x" * 200))
+        cache.get("a", 1)
+    assert cache.get("a", 1) is not None
+    assert cache.get("b", 1) is None
+    assert cache.get("k", 1) is not None
+
+    cache.clear()
+    assert cache.get("a", 1) is None
+
+
+if __name__ == "__main__":
+    run_tests(globals())
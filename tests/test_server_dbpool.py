@@ -0,0 +1,203 @@
+import os
+import time
+import tempfile
+import threading
+
+from pytest import raises
+
+from _common import run_tests
+from timetagger.server._dbpool import DBPool, SQLITE_PROFILES
+from timetagger.server._utils import StatCache
+
+
+def get_filenames(n):
+    dirname = tempfile.mkdtemp()
+    return [os.path.join(dirname, f"user{i}.db") for i in range(n)]
+
+
+def test_dbpool_reuse():
+    pool = DBPool()
+    filename = get_filenames(1)[0]
+
+    # The first get opens the db (and creates the file)
+    db1, mtime = pool.get(filename)
+    assert mtime == -1
+    assert os.path.isfile(filename)
+    assert pool.get_stats()["misses"] == 1
+
+    # The second get re-uses the db
+    db2, mtime = pool.get(filename)
+    assert db2 is db1
+    assert mtime > 0
+    assert pool.get_stats()["hits"] == 1
+    assert pool.get_stats()["open"] == 1
+
+    # Another thread gets its own db
+    result = []
+    t = threading.Thread(target=lambda: result.append(pool.get(filename)[0]))
+    t.start()
+    t.join()
+    assert result[0] is not db1
+    assert pool.get_stats()["open"] == 2
+
+    # When the file is removed, a fresh db is opened
+    db1.ensure_table("items", "!key")
+    os.remove(filename)
+    db3, mtime = pool.get(filename)
+    assert db3 is not db1
+    assert mtime == -1
+    assert db3.get_table_names() == []
+
+    # Clear
+    pool.clear()
+    db4, mtime = pool.get(filename)
+    assert db4 is not db3
+
+
+def test_dbpool_eviction():
+    pool = DBPool(max_per_thread=3, idle_timeout=0.2)
+    filenames = get_filenames(5)
+
+    # LRU eviction
+    for filename in filenames:
+        pool.get(filename)
+    stats = pool.get_stats()
+    assert stats["misses"] == 5
+    assert stats["evictions"] == 2
+    assert stats["open"] == 3
+
+    # The most recent ones are still open
+    pool.get(filenames[-1])
+    assert pool.get_stats()["hits"] == 1
+
+    # Idle timeout
+    time.sleep(0.3)
+    pool.get(filenames[0])
+    stats = pool.get_stats()
+    assert stats["expired"] == 3
+    assert stats["open"] == 1
+
+
+def run_in_thread(func):
+    t = threading.Thread(target=func)
+    t.start()
+    t.join()
+
+
+def test_dbpool_max_open():
+    pool = DBPool(max_open=4)
+    filenames = get_filenames(7)
+
+    def work(names):
+        for name in names:
+            pool.get(name)
+        pool.release()
+
+    # Threads that are done release their dbs
+    run_in_thread(lambda: work(filenames[0:2]))
+    run_in_thread(lambda: work(filenames[2:4]))
+    assert pool.get_stats()["open"] == 4
+
+    # When there are too many open, those of idle threads are closed
+    run_in_thread(lambda: work(filenames[4:6]))
+    stats = pool.get_stats()
+    assert stats["open"] == 4
+    assert stats["evictions"] == 2
+
+    # But not those of busy threads (this one did not release)
+    db, _ = pool.get(filenames[6])
+    db2, _ = pool.get(filenames[0])
+    assert pool.get_stats()["open"] == 4
+    assert db.get_table_names() == []
+    pool.release()
+
+
+def test_dbpool_idle_threads():
+    pool = DBPool(idle_timeout=0.1)
+    pool.sweep_interval = 0
+    filename = get_filenames(1)[0]
+
+    # The dbs of a thread that does not call get() again are closed too
+    run_in_thread(lambda: (pool.get(filename), pool.release()))
+    assert pool.get_stats()["open"] == 1
+    time.sleep(0.2)
+    pool.release()
+    stats = pool.get_stats()
+    assert stats["open"] == 0
+    assert stats["expired"] == 1
+
+
+def test_dbpool_initializer():
+    initialized = []
+    pool = DBPool(initializer=lambda db: initialized.append(db))
+    filename = get_filenames(1)[0]
+
+    # Initialized once per db, not once per connection
+    db1, _ = pool.get(filename)
+    assert initialized == [db1]
+    pool.get(filename)
+    pool.clear()
+    pool.get(filename)
+    assert initialized == [db1]
+
+    # But again when the db file is replaced
+    os.remove(filename)
+    db2, _ = pool.get(filename)
+    assert initialized == [db1, db2]
+
+
+def test_dbpool_pragmas():
+    pool = DBPool(pragmas=SQLITE_PROFILES["production"])
+    filename = get_filenames(1)[0]
+
+    # The pragmas are applied
+    db, _ = pool.get(filename)
+    assert db._conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert db._conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+    assert db._conn.execute("PRAGMA temp_store").fetchone()[0] == 2  # MEMORY
+
+    # In WAL mode, the mtime includes writes in the -wal file
+    with db:
+        db.ensure_table("items", "!key")
+    time.sleep(0.05)
+    with db:
+        db.put_one("items", key="x")
+    _, mtime = pool.get(filename)
+    assert os.path.isfile(filename + "-wal")
+    assert mtime == os.stat(filename + "-wal").st_mtime
+
+    # Invalid pragmas
+    with raises(ValueError):
+        DBPool(pragmas={"journal_mode; DROP": "WAL"})
+    with raises(ValueError):
+        DBPool(pragmas={"journal_mode": "WAL; DROP"})
+
+
+def test_dbpool_stat_cache():
+    stat_cache = StatCache(ttl=10)
+    pool = DBPool(stat_cache=stat_cache)
+    filename = get_filenames(1)[0]
+
+    db, mtime1 = pool.get(filename)
+    assert mtime1 == -1
+    # The creation of the file is noticed
+    db, mtime2 = pool.get(filename)
+    assert mtime2 > 0
+
+    # A write is only seen after notify_write()
+    time.sleep(0.02)
+    with db:
+        db.ensure_table("items", "!key")
+        db.put_one("items", key="a")
+    db, mtime3 = pool.get(filename)
+    assert mtime3 == mtime2
+    pool.notify_write(filename)
+    db, mtime4 = pool.get(filename)
+    assert mtime4 > mtime2
+
+    # Without a stat cache, notify_write() is a no-op
+    DBPool().notify_write(filename)
+
+
+if __name__ == "__main__":
+    run_tests(globals())
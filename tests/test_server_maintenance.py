@@ -0,0 +1,253 @@
+import io
+import os
+import time
+import sqlite3
+import threading
+import contextlib
+
+from _common import run_tests
+from timetagger.server import _apiserver as apiserver
+from timetagger.server import _utils as utils
+from timetagger.server._maintenance import get_all_users, get_db_size, compact
+from timetagger.server._maintenance import migrate
+from timetagger.server.__main__ import main
+
+
+USER = "test_maintenance@example.com"
+
+
+def clear_test_db():
+    for filename in utils.get_user_filenames(USER):
+        for fname in (filename, filename + "-wal", filename + "-shm"):
+            if os.path.isfile(fname):
+                os.remove(fname)
+        apiserver.db_pool.notify_write(filename)
+
+
+def push_records(records):
+    for record in records:
+        record.setdefault("mt", 100)
+    return apiserver._push_many(USER, [("records", records)])
+
+
+def test_get_all_users():
+    clear_test_db()
+    assert USER not in get_all_users()
+    apiserver.get_user_db(USER)
+    assert USER in get_all_users()
+
+
+def run_main(*args):
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        assert main(list(args)) == 0
+    return out.getvalue()
+
+
+def test_rebuild():
+    clear_test_db()
+    push_records(
+        [
+            dict(key="r1", t1=100, t2=200, ds="#foo #bar"),
+            dict(key="r2", t1=300, t2=350, ds="#foo"),
+            dict(key="r3", t1=400, t2=400, ds="HIDDEN #foo"),
+        ]
+    )
+
+    def get_derived():
+        db, mtime = apiserver.get_user_db(USER)
+        return [
+            sorted(item["key"] for item in db.select_all(what))
+            for what in ("stats", "record_tags", "tag_totals")
+        ]
+
+    expected = get_derived()
+    assert expected[1] == ["#bar r1", "#foo r1", "#foo r2"]
+    assert expected[2] == ["#bar", "#foo"]
+
+    # Mess up the derived tables
+    db, mtime = apiserver.get_user_db(USER)
+    with db:
+        for what in ("stats", "record_tags", "tag_totals"):
+            apiserver._delete_by_keys(db, what, None)
+        db.put_one("tag_totals", key="#spam", count=3, t=10)
+    assert get_derived() == [[], [], ["#spam"]]
+
+    # Rebuild
+    out = run_main("rebuild", USER)
+    assert get_derived() == expected
+    assert f"Rebuilt {USER!r} (3 records)" in out
+
+
+def get_reset_time():
+    db, mtime = apiserver.get_user_db(USER)
+    ob = db.select_one("userinfo", "key == 'reset_time'")
+    return ob["value"] if ob else None
+
+
+def test_compact():
+    clear_test_db()
+    push_records([dict(key=f"r{i}", t1=100, t2=200, ds="x" * 100) for i in range(1000)])
+    push_records(
+        [
+            dict(key=f"r{i}", t1=100, t2=200, ds="HIDDEN #foo", mt=200)
+            for i in range(0, 1000, 2)
+        ]
+    )
+    assert get_reset_time() is None
+
+    # Nothing is old enough to be purged
+    result = compact(USER, retention_days=1, vacuum=False)
+    assert result["purged"] == 0
+    assert get_reset_time() is None
+
+    # Purge all hidden records
+    t0 = time.time()
+    result = compact(USER, retention_days=0)
+    assert result["purged"] == 500
+    assert result["size_after"] < result["size_before"]
+    assert result["size_after"] == get_db_size(USER)
+    db, mtime = apiserver.get_user_db(USER)
+    assert db.count_all("records") == 500
+    assert db.select_one("records", "key == 'r0'") is None
+
+    # Clients will do a reset
+    assert get_reset_time() >= t0
+    assert apiserver.version_registry.get(USER) >= t0
+    result = apiserver._get_updates(USER, t0 - 10)
+    assert result[2]["reset"] is True
+    assert len(result[2]["records"]) == 500
+
+
+def test_compact_cli():
+    clear_test_db()
+    push_records([dict(key="r1", t1=100, t2=200, ds="HIDDEN")])
+
+    # Using a process pool
+    out = run_main("compact", USER, "--retention-days", "0", "--jobs", "2")
+    assert f"Compacted {USER!r}: purged 1 records" in out
+    assert "in total" in out
+    db, mtime = apiserver.get_user_db(USER)
+    assert db.count_all("records") == 0
+
+
+def create_flat_db(records):
+    # Create a db in the sharded layout, and move it to the flat layout
+    clear_test_db()
+    push_records(records)
+    apiserver.db_pool.clear()  # closing the last connection removes the WAL
+    sharded, flat = utils.get_user_filenames(USER)
+    os.replace(sharded, flat)
+    utils.stat_cache.invalidate(sharded, flat)
+    assert apiserver.user2filename(USER) == flat
+    return sharded, flat
+
+
+def get_record_keys():
+    db, mtime = apiserver.get_user_db(USER)
+    return sorted(record["key"] for record in db.select_all("records"))
+
+
+def test_migrate():
+    sharded, flat = create_flat_db(
+        [dict(key="r1", t1=100, t2=200, ds="#foo"), dict(key="r2", t1=300, t2=350)]
+    )
+    assert get_all_users().count(USER) == 1
+    assert get_record_keys() == ["r1", "r2"]
+    stale_db, mtime = apiserver.get_user_db(USER)
+
+    out = run_main("migrate", USER)
+    assert f"Migrated {USER!r}" in out
+    assert "Migrated 1 of 1" in out
+
+    assert not os.path.isfile(flat)
+    assert apiserver.user2filename(USER) == sharded
+    assert get_all_users().count(USER) == 1
+    assert get_record_keys() == ["r1", "r2"]
+
+    # A connection that was opened before the migration cannot write
+    try:
+        with stale_db:
+            stale_db.put_one("records", key="r3", mt=100, t1=1, t2=2)
+    except (KeyError, sqlite3.OperationalError):
+        pass  # no such table
+    else:
+        assert False, "expected the write to the old db to fail"
+
+    # Migrating again is a no-op
+    assert not migrate(USER)
+    assert "Migrated 0 of 1" in run_main("migrate", USER)
+
+    # If a db exists in both layouts, the flat one is removed
+    open(flat, "wb").close()
+    assert migrate(USER)
+    assert not os.path.isfile(flat)
+    assert get_record_keys() == ["r1", "r2"]
+
+    clear_test_db()
+
+
+def test_migrate_by_other_process():
+    sharded, flat = create_flat_db([dict(key="r1", t1=100, t2=200)])
+    assert apiserver.user2filename(USER) == flat
+    assert get_record_keys() == ["r1"]
+
+    # Migrate like the CLI would: our stat cache is not invalidated
+    ori_invalidate = utils.stat_cache.invalidate
+    utils.stat_cache.invalidate = lambda *filenames: None
+    try:
+        assert migrate(USER)
+    finally:
+        utils.stat_cache.invalidate = ori_invalidate
+
+    # The server uses the sharded db right away
+    assert apiserver.user2filename(USER) == sharded
+    assert get_record_keys() == ["r1"]
+    assert not os.path.isfile(flat)
+
+    clear_test_db()
+
+
+def test_migrate_while_writing():
+    create_flat_db([dict(key="r0", t1=100, t2=200)])
+
+    # Push records in a thread, like the server would, during the migration
+    pushed = []
+    stop = False
+
+    def writer():
+        i = 0
+        while not stop:
+            i += 1
+            key = f"w{i}"
+            try:
+                push_records([dict(key=key, t1=100, t2=200)])
+            except Exception:
+                pass  # a write that races the move may fail, and be retried
+            else:
+                pushed.append(key)
+        apiserver.db_pool.clear()
+
+    t = threading.Thread(target=writer)
+    t.start()
+    try:
+        while len(pushed) < 20:
+            time.sleep(0.001)
+        assert migrate(USER)
+        n = len(pushed)
+        while len(pushed) < n + 20:
+            time.sleep(0.001)
+    finally:
+        stop = True
+        t.join()
+
+    # No successful write got lost
+    keys = set(get_record_keys())
+    assert keys == set(["r0"] + pushed)
+    assert not os.path.isfile(utils.get_user_filenames(USER)[1])
+
+    clear_test_db()
+
+
+if __name__ == "__main__":
+    run_tests(globals())
@@ -0,0 +1,112 @@
+from pytest import raises
+
+from _common import run_tests
+from timetagger.server._utils import swait
+from timetagger.server._metrics import Registry, timed, metrics_handler
+
+
+class FakeRequest:
+    def __init__(self, method):
+        self.method = method
+
+
+def test_counter_and_gauge():
+    registry = Registry()
+    counter = registry.counter("test_total", "A counter.", ["route"])
+    gauge = registry.gauge("test_value", "A gauge.")
+
+    counter.inc("a")
+    counter.inc("a", amount=2)
+    counter.inc("b")
+    gauge.set(value=7)
+    assert counter.get("a") == 3
+    assert counter.get("c") == 0
+    assert gauge.get() == 7
+
+    # Labels must match
+    with raises(ValueError):
+        counter.inc()
+    with raises(ValueError):
+        counter.inc("a", "b")
+
+    # Names must be unique
+    with raises(ValueError):
+        registry.counter("test_total", "Again.")
+
+    lines = registry.render().splitlines()
+    assert lines == [
+        "# HELP test_total A counter.",
+        "# TYPE test_total counter",
+        'test_total{route="a"} 3',
+        'test_total{route="b"} 1',
+        "# HELP test_value A gauge.",
+        "# TYPE test_value gauge",
+        "test_value 7",
+    ]
+
+
+def test_histogram():
+    registry = Registry()
+    histogram = registry.histogram("test_seconds", "A histogram.", ["x"], (1, 10))
+
+    histogram.observe("a", value=0.5)
+    histogram.observe("a", value=5)
+    histogram.observe("a", value=50)
+    assert histogram.get("a") == (55.5, 3)
+    assert histogram.get("b") == (0, 0)
+
+    with raises(TypeError):
+        histogram.set("a", value=3)
+
+    lines = registry.render().splitlines()
+    assert lines[2:] == [
+        'test_seconds_bucket{x="a",le="1"} 1',
+        'test_seconds_bucket{x="a",le="10"} 2',
+        'test_seconds_bucket{x="a",le="+Inf"} 3',
+        'test_seconds_sum{x="a"} 55.5',
+        'test_seconds_count{x="a"} 3',
+    ]
+
+
+def test_timed_and_collector():
+    registry = Registry()
+    histogram = registry.histogram("test_seconds", "A histogram.", ["func"])
+    gauge = registry.gauge("test_value", "A gauge.", ["lane"])
+
+    @timed(histogram, "foo")
+    def foo(x):
+        """Foo!"""
+        if x < 0:
+            raise ValueError()
+        return x * 2
+
+    assert foo.__name__ == "foo" and foo.__doc__ == "Foo!"
+    assert foo(3) == 6
+    with raises(ValueError):
+        foo(-1)
+    assert histogram.get("foo")[1] == 2
+
+    # Collectors are called on each render
+    values = {"read": 1}
+    registry.add_collector(lambda: gauge.set("read", value=values["read"]))
+    assert 'test_value{lane="read"} 1' in registry.render()
+    values["read"] = 4
+    assert 'test_value{lane="read"} 4' in registry.render()
+
+    # Label values are escaped
+    gauge.set('a"b', value=0)
+    assert 'test_value{lane="a\\"b"} 0' in registry.render()
+
+
+def test_metrics_handler():
+    status, headers, body = swait(metrics_handler(FakeRequest("GET")))
+    assert status == 200
+    assert headers["content-type"].startswith("text/plain")
+    assert isinstance(body, str)
+
+    status, headers, body = swait(metrics_handler(FakeRequest("PUT")))
+    assert status == 405
+
+
+if __name__ == "__main__":
+    run_tests(globals())
@@ -0,0 +1,357 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import tempfile
+
+from asgineer.testutils import MockTestServer
+from pytest import raises
+
+from _common import run_tests
+from _pgshim import get_create_pool
+from timetagger.server import _apiserver as apiserver
+from timetagger.server._pgstorage import PostgresStorage, _translate
+from timetagger.server._utils import swait
+
+
+INDICES = {"items": ("!key", "st"), "other": ("!key",)}
+
+
+def get_storage(indices=INDICES):
+    filename = os.path.join(tempfile.mkdtemp(), "pg.db")
+    return PostgresStorage(indices=indices, create_pool=get_create_pool(filename))
+
+
+def get_user():
+    # Unique, in case the tests run against a real database
+    return "test_pg_" + uuid.uuid4().hex[:8]
+
+
+def test_translate():
+    assert _translate("key == ?", 2) == "key = $2"
+    assert _translate("st > ? AND key IN (?, ?)", 2) == "st > $2 AND key IN ($3, $4)"
+    assert _translate("1 = 1", 1) == "1 = 1"
+
+
+def test_postgres_storage_init():
+    with raises(ValueError):
+        PostgresStorage(indices={"items": ("key", "st")}, create_pool=lambda: None)
+    with raises(ValueError):
+        PostgresStorage(indices={"items": ("!key", "!id")}, create_pool=lambda: None)
+
+
+def test_async_user_db():
+    storage = get_storage()
+    user1, user2 = get_user(), get_user()
+
+    async def main():
+        db1, mtime1 = await storage.get_async_user_db(user1)
+        db2, mtime2 = await storage.get_async_user_db(user2)
+        assert mtime1 == mtime2 == -1
+
+        async with db1.transaction():
+            await db1.put("items", dict(key="a", st=1), dict(key="b", st=2))
+        async with db2.transaction():
+            await db2.put_one("items", key="a", st=3, foo="bar")
+
+        # Each user has its own items, with the same keys
+        assert sorted(x["key"] for x in await db1.select_all("items")) == ["a", "b"]
+        assert await db2.select_all("items") == [dict(key="a", st=3, foo="bar")]
+        assert await db1.count_all("items") == 2
+        assert (await db1.select_one("items", "key == ?", "a"))["st"] == 1
+        assert await db1.select("items", "st > ? OR key == 'a' ORDER BY st", 1) == [
+            dict(key="a", st=1),
+            dict(key="b", st=2),
+        ]
+        query = "st >= ? ORDER BY st DESC LIMIT ?"
+        assert await db1.select("items", query, 0, 1) == [dict(key="b", st=2)]
+        assert len(await db1.select("items", query, 0, -1)) == 2
+
+        # Put replaces the item
+        async with db1.transaction():
+            await db1.put_one("items", key="a", st=5)
+        assert (await db1.select_one("items", "key == 'a'"))["st"] == 5
+        assert await db1.count_all("items") == 2
+
+        # Deleting only affects the user's own items
+        async with db1.transaction():
+            await db1.delete("items", "key == 'a' OR 1 = 1")
+            await db1.put_one("items", key="c", st=4)
+        assert [x["key"] for x in await db1.select_all("items")] == ["c"]
+        assert await db2.count_all("items") == 1
+
+        # The mtime is the time of the last write of the user
+        db1, mtime1 = await storage.get_async_user_db(user1)
+        assert time.time() - 5 < mtime1 <= time.time()
+
+        # A failed transaction is rolled back
+        with raises(ZeroDivisionError):
+            async with db1.transaction():
+                await db1.put_one("items", key="d", st=6)
+                1 / 0
+        assert await db1.count_all("items") == 1
+        assert (await storage.get_async_user_db(user1))[1] == mtime1
+
+        # Errors like an ItemDB
+        with raises(KeyError):
+            await db1.select_all("nope")
+        with raises(IOError):
+            await db1.put_one("items", key="d")
+        with raises(IOError):
+            await db1.delete("items", "1 = 1")
+        with raises(IndexError):
+            async with db1.transaction():
+                await db1.put_one("items", st=5)
+        with raises(IOError):
+            async with db1.transaction():
+                async with db1.transaction():
+                    pass
+
+    swait(main())
+
+
+def test_sync_user_db():
+    storage = get_storage()
+    user = get_user()
+
+    def work():
+        db, mtime = storage.get_user_db(user)
+        assert mtime == -1
+        db.ensure_table("items", "!key", "st")
+        with raises(IndexError):
+            db.ensure_table("items", "!key", "foo")
+        with db:
+            db.put_one("items", key="a", st=1)
+            db.put_one("other", key="b")
+        with raises(ZeroDivisionError):
+            with db:
+                db.delete("items", "1 = 1")
+                1 / 0
+        assert db.select("items", "st > ?", 0) == [dict(key="a", st=1)]
+        assert db.select_one("other", "key == 'b'") == dict(key="b")
+        assert db.count_all("items") == 1
+        return storage.get_users(), storage.get_size(user)
+
+    async def main():
+        # The sync API can only be used from another thread
+        await storage.open()
+        with raises(RuntimeError):
+            storage.get_user_db(user)
+        users, size = await asyncio.get_running_loop().run_in_executor(None, work)
+        assert user in users
+        assert size > 10
+
+    swait(main())
+
+
+def test_api_with_postgres():
+    filename = os.path.join(tempfile.mkdtemp(), "pg.db")
+    user = get_user()
+
+    async def our_api_handler(request):
+        apipath = request.path[len("/api/v1/") :]
+        return await apiserver.api_handler(request, apipath, user)
+
+    # Track the use of threads
+    thread_calls = []
+    ori_asyncthis = apiserver.asyncthis
+
+    async def asyncthis(func, *args, **kwargs):
+        thread_calls.append(func.__name__)
+        return await ori_asyncthis(func, *args, **kwargs)
+
+    apiserver.configure_storage("postgres", create_pool=get_create_pool(filename))
+    apiserver.asyncthis = asyncthis
+    try:
+        assert apiserver.get_storage().is_async
+        with MockTestServer(our_api_handler) as p:
+            _check_api_with_postgres(p)
+        # No threads are used for the updates, pushes and settings
+        assert thread_calls == ["_get_stats", "_get_tags"]
+    finally:
+        apiserver.asyncthis = ori_asyncthis
+        apiserver.configure_storage("files")
+
+
+def _check_api_with_postgres(p):
+
+    # Initially empty
+    r = p.get("/api/v1/updates?since=0")
+    assert r.status == 200
+    assert json.loads(r.body.decode())["records"] == []
+    r = p.get("/api/v1/settings")
+    assert json.loads(r.body.decode())["settings"] == []
+
+    # Push records
+    t = int(time.time())
+    records = [
+        dict(key=f"r{i}", mt=t, t1=t - 100 * i, t2=t - 100 * i + 50, ds="#foo")
+        for i in range(5)
+    ]
+    records.append(dict(key="bad", mt=t))
+    r = p.put("/api/v1/records", json.dumps(records).encode())
+    assert r.status == 200
+    body = json.loads(r.body.decode())
+    assert body["accepted"] == [f"r{i}" for i in range(5)]
+    assert body["fail"] == ["bad"]
+
+    # Get all updates
+    r = p.get("/api/v1/updates?since=0")
+    body = json.loads(r.body.decode())
+    assert len(body["records"]) == 5
+    sts = sorted(record["st"] for record in body["records"])
+    server_time = body["server_time"]
+    etag = r.headers["etag"]
+    r = p.get("/api/v1/updates?since=0", headers={"if-none-match": etag})
+    assert r.status == 304
+
+    # The encoded response with all items is cached, like for the other backends
+    n_cached = apiserver.updates_total.get("cached")
+    r = p.get("/api/v1/updates?since=0")
+    assert len(json.loads(r.body.decode())["records"]) == 5
+    assert apiserver.updates_total.get("cached") == n_cached + 1
+
+    # Paginated and streamed
+    r = p.get("/api/v1/updates?since=0&limit=3")
+    body = json.loads(r.body.decode())
+    keys = [record["key"] for record in body["records"]]
+    r = p.get(f"/api/v1/updates?cursor={body['next']}&limit=3")
+    body = json.loads(r.body.decode())
+    keys += [record["key"] for record in body["records"]]
+    assert sorted(keys) == [f"r{i}" for i in range(5)]
+    assert body["next"] is None
+    r = p.get("/api/v1/updates?since=0&stream=1")
+    body = json.loads(r.body.decode())
+    assert len(body["records"]) == 5
+
+    # The server time is unique and increasing; an older mt does not win
+    time.sleep(0.01)
+    records = [
+        dict(key="r0", mt=t + 1, t1=t, t2=t + 60, ds="#foo #bar"),
+        dict(key="r1", mt=t - 1, t1=t, t2=t + 60, ds="#old"),
+    ]
+    r = p.put("/api/v1/records", json.dumps(records).encode())
+    assert json.loads(r.body.decode())["accepted"] == ["r0", "r1"]
+    r = p.get(f"/api/v1/updates?since={server_time}")
+    body = json.loads(r.body.decode())
+    updated = {record["key"]: record for record in body["records"]}
+    assert updated["r0"]["ds"] == "#foo #bar"
+    assert updated["r1"]["ds"] == "#foo"
+    assert updated["r0"]["st"] > sts[-1]
+    assert updated["r1"]["st"] > sts[-1]
+
+    # Settings
+    settings = [dict(key="s1", mt=t, value="x")]
+    r = p.put("/api/v1/settings", json.dumps(settings).encode())
+    assert r.status == 200
+    r = p.get("/api/v1/settings")
+    assert [x["value"] for x in json.loads(r.body.decode())["settings"]] == ["x"]
+    etag = r.headers["etag"]
+    r = p.get("/api/v1/settings", headers={"if-none-match": etag})
+    assert r.status == 304
+
+    # The derived tables (via the sync functions, in a thread)
+    r = p.get(f"/api/v1/stats?t1={t - 1000}&t2={t + 1000}")
+    stats = json.loads(r.body.decode())["bins"][0]["stats"]
+    assert stats == {"#foo": 200, "#bar #foo": 60}
+    r = p.get("/api/v1/tags")
+    tags = json.loads(r.body.decode())["tags"]
+    assert tags["#foo"]["count"] == 5
+    assert tags["#bar"]["count"] == 1
+
+    # Force a reset
+    r = p.put("/api/v1/forcereset", b"")
+    assert r.status == 200
+    r = p.get(f"/api/v1/updates?since={server_time}")
+    body = json.loads(r.body.decode())
+    assert body["reset"] is True
+    assert len(body["records"]) == 5
+
+
+def test_sync_and_async_queries_match():
+    # The async backend has its own implementation of the queries for
+    # updates and pushes. Check that it has the same effect as the sync one.
+    t = int(time.time())
+    pushes = [
+        (
+            "records",
+            [
+                dict(key="r1", mt=t, t1=t - 3600, t2=t - 1800, ds="#foo #bar"),
+                dict(key="r2", mt=t, t1=t - 100, t2=t - 100, ds="#foo"),
+                dict(key="r3", mt=t, t1=t - 9000, t2=t - 7200, ds="#baz"),
+                dict(key="bad", mt=t),
+            ],
+        ),
+        ("settings", [dict(key="s1", mt=t, value="x")]),
+    ]
+    edits = [
+        (
+            "records",
+            [
+                dict(key="r1", mt=t + 1, t1=t - 3600, t2=t - 1000, ds="#foo"),
+                dict(key="r2", mt=t - 1, t1=t - 100, t2=t - 50, ds="#old"),
+                dict(key="r3", mt=t + 1, t1=t - 9000, t2=t - 7200, ds="no tags"),
+            ],
+        ),
+    ]
+
+    def sync_path(user):
+        results = [apiserver._push_many(user, pushes)]
+        results.append(apiserver._push_many(user, edits))
+        results.append(apiserver._get_updates(user, 0))
+        results.append(apiserver._get_updates(user, 0, 2))
+        results.append(apiserver._force_reset(user))
+        results.append(apiserver._get_items(user, "settings"))
+        db, mtime = apiserver.get_user_db(user)
+        return results, {what: db.select_all(what) for what in apiserver.INDICES}
+
+    async def async_path(user):
+        results = [await apiserver._apush_many(user, pushes)]
+        results.append(await apiserver._apush_many(user, edits))
+        results.append(await apiserver._aget_updates(user, 0))
+        results.append(await apiserver._aget_updates(user, 0, 2))
+        results.append(await apiserver._aforce_reset(user))
+        results.append(await apiserver._aget_items(user, "settings"))
+        db, mtime = await apiserver.aget_user_db(user)
+        return results, {what: await db.select_all(what) for what in apiserver.INDICES}
+
+    try:
+        filename = os.path.join(tempfile.mkdtemp(), "shared.db")
+        apiserver.configure_storage("shared", filename)
+        results1, tables1 = sync_path(get_user())
+        filename = os.path.join(tempfile.mkdtemp(), "pg.db")
+        apiserver.configure_storage("postgres", create_pool=get_create_pool(filename))
+        results2, tables2 = swait(async_path(get_user()))
+    finally:
+        apiserver.configure_storage("files")
+
+    # The sqlite backends also have the schema version in the userinfo
+    for tables in (tables1, tables2):
+        userinfo = tables["userinfo"]
+        tables["userinfo"] = [x["key"] for x in userinfo if x["key"] != "schema_version"]
+    assert tables1["userinfo"] == ["reset_time"]
+
+    assert _without_times(results1) == _without_times(results2)
+    assert _without_times(tables1) == _without_times(tables2)
+    assert len(tables1["stats"]) > 0 and len(tables1["tag_totals"]) > 0
+
+
+def _without_times(ob):
+    # The server times and etags differ between the runs
+    if isinstance(ob, dict):
+        return {
+            key: _without_times(val)
+            for key, val in ob.items()
+            if key not in ("st", "server_time", "etag", "value", "next")
+        }
+    elif isinstance(ob, (list, tuple)):
+        items = [_without_times(x) for x in ob]
+        if all(isinstance(x, dict) and "key" in x for x in items):
+            items.sort(key=lambda x: x["key"])
+        return items
+    return ob
+
+
+if __name__ == "__main__":
+    run_tests(globals())
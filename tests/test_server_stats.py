@@ -0,0 +1,112 @@
+import datetime
+
+from _common import run_tests
+from timetagger.server._stats import (
+    get_tagz,
+    iter_record_stats,
+    get_stats_deltas,
+    get_bin_edges,
+    EXACT_BIN,
+)
+
+
+def test_get_tagz():
+    assert get_tagz(dict(ds="")) == "#untagged"
+    assert get_tagz(dict()) == "#untagged"
+    assert get_tagz(dict(ds="no tags")) == "#untagged"
+    assert get_tagz(dict(ds="#foo #Bar stuff")) == "#bar #foo"
+    assert get_tagz(dict(ds="HIDDEN #foo")) is None
+
+
+def test_iter_record_stats():
+    record = dict(t1=3000, t2=7300, ds="#foo")
+    assert list(iter_record_stats(record)) == [
+        (0, "#foo", 600),
+        (3600, "#foo", 3600),
+        (7200, "#foo", 100),
+    ]
+    record = dict(t1=3600, t2=7200, ds="#foo")
+    assert list(iter_record_stats(record)) == [(3600, "#foo", 3600)]
+    record = dict(t1=3600, t2=7200, ds="HIDDEN #foo")
+    assert list(iter_record_stats(record)) == []
+
+
+def test_get_stats_deltas():
+    r1 = dict(key="r1", t1=0, t2=100, ds="#foo")
+    r2 = dict(key="r2", t1=3500, t2=3700, ds="#bar")
+    deltas, exact = get_stats_deltas({}, {"r1": r1, "r2": r2})
+    assert deltas == {
+        "0/#foo": (0, "#foo", 100),
+        "0/#bar": (0, "#bar", 100),
+        "3600/#bar": (3600, "#bar", 100),
+    }
+    assert exact == {}
+
+    # Changing a record changes the aggregates
+    r1b = dict(key="r1", t1=0, t2=50, ds="#bar")
+    deltas, exact = get_stats_deltas({"r1": r1}, {"r1": r1b})
+    assert deltas == {"0/#foo": (0, "#foo", -100), "0/#bar": (0, "#bar", 50)}
+
+    # Running records are not aggregated
+    r1c = dict(key="r1", t1=70, t2=70, ds="#bar")
+    deltas, exact = get_stats_deltas({"r1": r1b}, {"r1": r1c})
+    assert deltas == {"0/#bar": (0, "#bar", -50)}
+    assert exact == {"record/r1": dict(bin=EXACT_BIN, tagz="#bar", t1=70, t2=70)}
+
+    # Neither are very long records
+    r1d = dict(key="r1", t1=0, t2=10**9, ds="#bar")
+    deltas, exact = get_stats_deltas({"r1": r1c}, {"r1": r1d})
+    assert deltas == {}
+    assert exact == {"record/r1": dict(bin=EXACT_BIN, tagz="#bar", t1=0, t2=10**9)}
+
+    # When these stop or are hidden, their item is removed
+    r1e = dict(key="r1", t1=0, t2=10**9, ds="HIDDEN #bar")
+    deltas, exact = get_stats_deltas({"r1": r1d}, {"r1": r1e})
+    assert deltas == {} and exact == {"record/r1": None}
+    deltas, exact = get_stats_deltas({"r1": r1c}, {"r1": r1b})
+    assert deltas == {"0/#bar": (0, "#bar", 50)} and exact == {"record/r1": None}
+
+
+def test_get_bin_edges():
+    def ts(*args, tz=0):
+        tzinfo = datetime.timezone(datetime.timedelta(minutes=tz))
+        return datetime.datetime(*args, tzinfo=tzinfo).timestamp()
+
+    t1, t2 = ts(2021, 3, 3, 12), ts(2021, 3, 5, 12)
+    assert get_bin_edges(t1, t2) == [t1, t2]
+
+    # Days, in UTC and in another timezone
+    assert get_bin_edges(t1, t2, "day") == [
+        t1,
+        ts(2021, 3, 4),
+        ts(2021, 3, 5),
+        t2,
+    ]
+    assert get_bin_edges(t1, t2, "day", 330) == [
+        t1,
+        ts(2021, 3, 4, tz=330),
+        ts(2021, 3, 5, tz=330),
+        t2,
+    ]
+
+    # Weeks start on monday (march 1 and 8 are mondays)
+    t1, t2 = ts(2021, 2, 24, tz=60), ts(2021, 3, 10, tz=60)
+    assert get_bin_edges(t1, t2, "week", 60) == [
+        t1,
+        ts(2021, 3, 1, tz=60),
+        ts(2021, 3, 8, tz=60),
+        t2,
+    ]
+
+    # Months, also when the range starts at the start of a month
+    t1, t2 = ts(2020, 12, 1, tz=-300), ts(2021, 2, 15, tz=-300)
+    assert get_bin_edges(t1, t2, "month", -300) == [
+        t1,
+        ts(2021, 1, 1, tz=-300),
+        ts(2021, 2, 1, tz=-300),
+        t2,
+    ]
+
+
+if __name__ == "__main__":
+    run_tests(globals())
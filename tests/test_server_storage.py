@@ -0,0 +1,176 @@
+import os
+import time
+import tempfile
+
+from asgineer.utils import normalize_response
+from pytest import raises
+
+from _common import run_tests
+from timetagger.server import _apiserver as apiserver
+from timetagger.server._storage import SharedStorage, FileStorage, _split_query
+
+
+def get_storage(initializer=None):
+    filename = os.path.join(tempfile.mkdtemp(), "shared.db")
+    return SharedStorage(filename, initializer=initializer)
+
+
+def test_split_query():
+    assert _split_query("st > ?") == ("st > ?", "")
+    assert _split_query("st > ? ORDER BY st LIMIT 1") == (
+        "st > ? ",
+        "ORDER BY st LIMIT 1",
+    )
+    assert _split_query("st > ? limit ?") == ("st > ? ", "limit ?")
+
+
+def test_shared_storage_isolation():
+    storage = get_storage()
+    db1, mtime1 = storage.get_user_db("user1")
+    db2, mtime2 = storage.get_user_db("user2")
+    assert mtime1 == mtime2 == -1
+
+    db1.ensure_table("items", "!key", "st")
+    db2.ensure_table("items", "!key", "st")
+    with db1:
+        db1.put("items", dict(key="a", st=1), dict(key="b", st=2))
+    with db2:
+        db2.put_one("items", key="a", st=3, foo="bar")
+
+    # Each user has its own items, with the same keys
+    assert sorted(x["key"] for x in db1.select_all("items")) == ["a", "b"]
+    assert db2.select_all("items") == [dict(key="a", st=3, foo="bar")]
+    assert db1.count_all("items") == 2
+    assert db2.count_all("items") == 1
+    assert db1.select_one("items", "key == ?", "a")["st"] == 1
+    assert db1.select("items", "st > ? OR key == 'a'", 1) == [
+        dict(key="a", st=1),
+        dict(key="b", st=2),
+    ]
+    assert db1.select("items", "st > 0 ORDER BY st DESC LIMIT 1") == [
+        dict(key="b", st=2)
+    ]
+
+    # Deleting only affects the user's own items
+    with db1:
+        db1.delete("items", "key == 'a' OR 1 = 1")
+        db1.put_one("items", key="c", st=4)  # the transaction is still usable
+    assert [x["key"] for x in db1.select_all("items")] == ["c"]
+    assert db2.count_all("items") == 1
+
+    # The mtime is the time of the last write of the user
+    db1, mtime1 = storage.get_user_db("user1")
+    assert time.time() - 5 < mtime1 <= time.time()
+    assert storage.get_users() == ["user1", "user2"]
+    assert 0 < storage.get_size("user2") < 100
+
+    # Errors like an ItemDB
+    with raises(KeyError):
+        db1.select_all("nope")
+    with raises(IOError):
+        db1.put_one("items", key="d")
+    with raises(IndexError):
+        with db1:
+            db1.put_one("items", st=5)
+    with raises(IndexError):
+        db1.select("items", "foo == 'bar'")
+    with raises(IndexError):
+        db1.ensure_table("items", "_user")
+
+
+def test_shared_storage_rollback():
+    storage = get_storage()
+    db, mtime = storage.get_user_db("user1")
+    db.ensure_table("items", "!key")
+
+    with raises(ZeroDivisionError):
+        with db:
+            db.put_one("items", key="a")
+            1 / 0
+    assert db.count_all("items") == 0
+    assert storage.get_user_db("user1")[1] == -1
+
+
+def test_shared_storage_new_index():
+    storage = get_storage()
+    db1, _ = storage.get_user_db("user1")
+    db2, _ = storage.get_user_db("user2")
+    db1.ensure_table("items", "!key")
+    with db1:
+        db1.put_one("items", key="a", x=1)
+    with db2:
+        db2.put_one("items", key="a", x=2)
+
+    # Adding an index fills the column for all users
+    db1.ensure_table("items", "!key", "x")
+    assert db1.get_indices("items") == {"!key", "x"}
+    assert db1.select("items", "x == 1") == [dict(key="a", x=1)]
+    assert db2.select("items", "x == 2") == [dict(key="a", x=2)]
+    assert db2.select("items", "x == 1") == []
+
+    # The indices start with the user
+    sql = db1._conn.execute(
+        "SELECT sql FROM sqlite_master WHERE name = 'idx_items_x'"
+    ).fetchone()[0]
+    assert "(_user, x)" in sql
+
+
+def test_shared_storage_initializer():
+    calls = []
+
+    def initializer(db):
+        calls.append(db._user)
+        db.ensure_table("items", "!key")
+
+    storage = get_storage(initializer)
+    storage.get_user_db("user1")
+    storage.get_user_db("user1")
+    storage.get_user_db("user2")
+    assert calls == ["user1", "user2"]
+    storage.invalidate("user1")
+    storage.get_user_db("user1")
+    assert calls == ["user1", "user2", "user1"]
+
+
+def get_updates(user, since):
+    return normalize_response(apiserver._get_updates(user, since))[2]
+
+
+def test_configure_storage():
+    assert isinstance(apiserver.get_storage(), FileStorage)
+    filename = os.path.join(tempfile.mkdtemp(), "shared.db")
+    user = "test_storage@example.com"
+
+    try:
+        apiserver.configure_storage("shared", filename)
+        assert isinstance(apiserver.get_storage(), SharedStorage)
+
+        # Push, get updates, and force a reset
+        record = dict(key="r1", mt=100, t1=100, t2=200, ds="#foo")
+        apiserver._push_many(user, [("records", [record])])
+        result = get_updates(user, 0)
+        assert [x["key"] for x in result["records"]] == ["r1"]
+        assert apiserver._get_tags(user)["tags"]["#foo"]["count"] == 1
+
+        # Not modified since
+        result = get_updates(user, time.time() + 1)
+        assert result["reset"] == 0
+
+        apiserver._force_reset(user)
+        assert get_updates(user, time.time() - 1)["reset"] is True
+
+        # The data is in the shared db, not in a per-user db
+        assert not os.path.isfile(apiserver.user2filename(user))
+        assert os.path.isfile(filename)
+        assert apiserver.get_storage().get_users() == [user]
+
+    finally:
+        apiserver.configure_storage("files")
+
+    assert isinstance(apiserver.get_storage(), FileStorage)
+    with raises(ValueError):
+        apiserver.configure_storage("nope")
+
+
+if __name__ == "__main__":
+    run_tests(globals())
@@ -0,0 +1,107 @@
+import time
+import logging
+
+from pytest import raises
+
+from _common import run_tests
+from timetagger.server._utils import swait, asyncthis
+from timetagger.server._tracing import Tracer, span, traced, current_trace
+
+
+def test_tracer_disabled():
+    tracer = Tracer()
+    assert tracer.start("GET foo") is None
+    tracer.finish(None, 200)
+    assert tracer.dump() == []
+
+    # Spans are ignored when there's no trace
+    with span("foo"):
+        pass
+    assert current_trace.get() is None
+
+
+def test_tracer_spans():
+    tracer = Tracer()
+    tracer.configure(slow_threshold=10, sample_rate=1)
+
+    @traced("work")
+    def work(x):
+        time.sleep(0.01)
+        return x + 1
+
+    async def request():
+        trace = tracer.start("GET foo", "user1")
+        try:
+            with span("parse"):
+                pass
+            # Spans in functions that run in a thread are recorded too
+            assert await asyncthis(work, 1) == 2
+        finally:
+            tracer.finish(trace, 200)
+        return trace
+
+    trace = swait(request())
+    assert current_trace.get() is None
+    names = [name for name, start, duration in trace.spans]
+    assert names == ["parse", "queue_wait:read", "work"]
+    assert trace.spans[2][2] >= 0.01
+    assert trace.duration >= 0.01
+
+    # With sample_rate 1, all traces are kept
+    traces = tracer.dump()
+    assert len(traces) == 1
+    assert traces[0]["name"] == "GET foo" and traces[0]["status"] == 200
+    assert [s["name"] for s in traces[0]["spans"]] == names
+    assert len(tracer.dump(clear=True)) == 1
+    assert tracer.dump() == []
+
+
+class LogCapture(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def __enter__(self):
+        logging.getLogger("asgineer").addHandler(self)
+        return self
+
+    def __exit__(self, *args):
+        logging.getLogger("asgineer").removeHandler(self)
+
+
+def test_tracer_slow():
+    tracer = Tracer()
+    tracer.configure(slow_threshold=0.01, sample_rate=0, buffer_size=2)
+    assert tracer.buffer_size == 2
+
+    with raises(ValueError):
+        tracer.configure(sample_rate=2)
+
+    def request(duration):
+        trace = tracer.start("PUT records", "user1")
+        with span("query"):
+            time.sleep(duration)
+        tracer.finish(trace, 200)
+
+    # Fast requests are not logged (or kept, with sample_rate 0)
+    with LogCapture() as log:
+        request(0)
+    assert not log.records
+    assert tracer.dump() == []
+
+    # Slow requests are logged with their breakdown, and kept
+    with LogCapture() as log:
+        for i in range(3):
+            request(0.02)
+    assert len(log.records) == 3
+    message = log.records[0].getMessage()
+    assert message.startswith("Slow request: PUT records for 'user1' took")
+    assert "query 0.0" in message
+    assert len(tracer.dump()) == 2
+
+
+if __name__ == "__main__":
+    run_tests(globals())
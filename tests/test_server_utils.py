@@ -1,4 +1,7 @@
 import os
+import time
+import shutil
+import tempfile
 
 from _common import run_tests
 from timetagger.server import _utils as utils
@@ -33,5 +36,108 @@ def test_user2filename_and_filename2user():
         assert utils.filename2user(filename) == email
 
 
+def test_sharded_layout():
+    root = tempfile.mkdtemp()
+    try:
+        users = ["foo@bar.com", "spam@eggs.com", "unicode€éö ?@grr.com"]
+        for user in users:
+            sharded, flat = utils.get_user_filenames(user, root)
+            assert os.path.basename(sharded) == os.path.basename(flat)
+            assert os.path.dirname(flat) == root
+            shards = os.path.relpath(os.path.dirname(sharded), root).split(os.sep)
+            assert len(shards) == utils.SHARD_LEVELS
+            assert all(len(shard) == utils.SHARD_WIDTH for shard in shards)
+            # The user can be recovered from both forms
+            assert utils.filename2user(sharded) == user
+            assert utils.filename2user(flat) == user
+            # Deterministic
+            assert utils.get_user_filenames(user, root) == (sharded, flat)
+
+        # Put the first user in the flat layout, and the others sharded
+        expected = []
+        for i, user in enumerate(users):
+            filename = utils.get_user_filenames(user, root)[i == 0]
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            open(filename, "wb").close()
+            open(filename + "-wal", "wb").close()
+            expected.append(filename)
+        open(os.path.join(root, "not_a_user.db"), "wb").close()
+
+        assert sorted(utils.iter_user_filenames(root)) == sorted(expected)
+        assert list(utils.iter_user_filenames(os.path.join(root, "nope"))) == []
+    finally:
+        shutil.rmtree(root)
+
+
+def test_user2filename_resolves_layout():
+    user = "test_layout@example.com"
+    sharded, flat = utils.get_user_filenames(user)
+    for fname in (sharded, flat):
+        if os.path.isfile(fname):
+            os.remove(fname)
+
+    utils.stat_cache.invalidate(sharded, flat)
+
+    # New users get the sharded layout
+    assert utils.user2filename(user) == sharded
+    # Existing dbs in the flat layout are found
+    open(flat, "wb").close()
+    utils.stat_cache.invalidate(flat)
+    assert utils.user2filename(user) == flat
+    # But the sharded db takes precedence
+    os.makedirs(os.path.dirname(sharded), exist_ok=True)
+    open(sharded, "wb").close()
+    utils.stat_cache.invalidate(sharded)
+    assert utils.user2filename(user) == sharded
+
+    os.remove(flat)
+    os.remove(sharded)
+    utils.stat_cache.invalidate(sharded, flat)
+
+
+def test_stat_cache():
+    filename = os.path.join(tempfile.mkdtemp(), "foo.db")
+    cache = utils.StatCache(ttl=0.1, max_size=2)
+
+    assert cache.stat(filename) is None
+    assert not cache.isfile(filename)
+    assert not cache.isfile(os.path.dirname(filename))
+
+    # A new file is not seen until the entry expires or is invalidated
+    with open(filename, "wb") as f:
+        f.write(b"x")
+    assert not cache.isfile(filename)
+    cache.invalidate(filename)
+    assert cache.isfile(filename)
+    assert cache.stat(filename).st_size == 1
+
+    os.remove(filename)
+    assert cache.isfile(filename)
+    time.sleep(0.11)
+    assert not cache.isfile(filename)
+
+    # Bounded, least recently used entries are evicted
+    for name in ("a", "b", "c"):
+        cache.stat(os.path.join(os.path.dirname(filename), name))
+    assert len(cache._cache) == 2
+    cache.clear()
+    assert len(cache._cache) == 0
+
+    os.rmdir(os.path.dirname(filename))
+
+
+def test_get_user_filenames_is_memoized():
+    user = "test_memo@example.com"
+    info1 = utils._get_user_filenames.cache_info()
+    filenames = utils.get_user_filenames(user)
+    assert utils.get_user_filenames(user) is filenames
+    info2 = utils._get_user_filenames.cache_info()
+    assert info2.hits > info1.hits
+    # The root dir is part of the key
+    assert utils.get_user_filenames(user, "/foo")[1] == os.path.join(
+        "/foo", utils.user2basename(user)
+    )
+
+
 if __name__ == "__main__":
     run_tests(globals())
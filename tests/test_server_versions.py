@@ -0,0 +1,66 @@
+import os
+import time
+import tempfile
+
+from _common import run_tests
+from timetagger.server._versions import VersionRegistry, SharedVersionTable
+
+
+def test_version_registry():
+    registry = VersionRegistry(ttl=0.2, max_users=3)
+
+    assert registry.get("foo") is None
+
+    # Bump, versions only increase
+    registry.bump("foo", 10)
+    assert registry.get("foo") == 10
+    registry.bump("foo", 20)
+    assert registry.get("foo") == 20
+    registry.bump("foo", 15)
+    assert registry.get("foo") == 20
+
+    # Entries expire
+    time.sleep(0.3)
+    assert registry.get("foo") is None
+
+    # The number of users is bounded
+    for user in ["a", "b", "c", "d"]:
+        registry.bump(user, 10)
+    assert registry.get("a") is None
+    assert registry.get("d") == 10
+
+
+def test_shared_version_table():
+    filename = os.path.join(tempfile.mkdtemp(), "versions")
+
+    # Two tables for the same file, as if in different processes
+    table1 = SharedVersionTable(filename, nslots=64)
+    table2 = SharedVersionTable(filename, nslots=64)
+    registry1 = VersionRegistry(table=table1)
+    registry2 = VersionRegistry(table=table2)
+
+    assert registry1.get("foo") is None
+    registry1.bump("foo", 10)
+    assert registry2.get("foo") == 10
+    registry2.bump("foo", 5)
+    assert registry1.get("foo") == 10
+
+    # Data is persistent
+    table1.close()
+    table3 = SharedVersionTable(filename, nslots=64)
+    assert table3.get("foo") == 10
+
+    # But the number of slots must match
+    try:
+        SharedVersionTable(filename, nslots=32)
+    except ValueError:
+        pass
+    else:
+        assert False, "Expected ValueError"
+
+    table2.close()
+    table3.close()
+
+
+if __name__ == "__main__":
+    run_tests(globals())
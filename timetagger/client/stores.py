@@ -173,6 +173,54 @@ def make_hidden(item):
     item.ds = "HIDDEN " + item.get("ds", "").split("HIDDEN")[-1].strip()
 
 
+def to_columns(items):
+    """Convert a list of items to the columnar format: a dict with a
+    list of values for each field. Fields that an item does not have
+    are null, and "missing" has the indices of these items per field
+    (null is also a valid value). This is more compact than a list of dicts.
+    """
+    fields = []
+    for item in items:
+        for field in item.keys():
+            if field not in fields:
+                fields.append(field)
+    columns = {}
+    missing = {}
+    for field in fields:
+        values = []
+        indices = []
+        for i in range(len(items)):
+            if field in items[i]:
+                values.append(items[i][field])
+            else:
+                values.append(None)
+                indices.append(i)
+        columns[field] = values
+        if len(indices) > 0:
+            missing[field] = indices
+    return {"count": len(items), "columns": columns, "missing": missing}
+
+
+def from_columns(ob):
+    """Convert items in the columnar format to a list of items. Without
+    "missing" (an older server), null values are omitted.
+    """
+    items = [{} for i in range(ob["count"])]
+    missing = ob.get("missing", None)
+    for field, values in ob["columns"].items():
+        present = [True for i in range(len(values))]
+        if missing is None:
+            for i in range(len(values)):
+                present[i] = values[i] is not None
+        else:
+            for i in missing.get(field, []):
+                present[i] = False
+        for i in range(len(values)):
+            if present[i]:
+                items[i][field] = values[i]
+    return items
+
+
 def sleepms(ms):
     global RawJS
     return RawJS("new Promise(resolve => setTimeout(resolve, ms))")
@@ -702,7 +750,8 @@ class BaseDataStore:
                 window.canvas.update()
         finally:
             if self._sync_timeout is None and not window.document.hidden:
-                self.sync_soon()  # Post a sync to keep getting updates
+                if not self._is_subscribed():
+                    self.sync_soon()  # Post a sync to keep getting updates
         # Reset state, leave current state shown for a bit if _sync() set it.
         if self.state == "sync":
             self._set_state("", 0.25)
@@ -712,13 +761,27 @@ class BaseDataStore:
     async def _sync(self):
         pass
 
+    def _is_subscribed(self):
+        """Whether we get notified of changes, so we don't have to poll."""
+        return False
+
 
 class ConnectedDataStore(BaseDataStore):
     """A data store that communicates with the server."""
 
+    def __init__(self):
+        self._long_poll_wait = 20  # seconds
+        self._pull_page_size = 5000
+        self._long_polling = False
+        self._stream_state = ""  # "", "connecting", "connected"
+        self._stream_last_time = 0  # time of last message from the stream
+        self._stream_retry_time = 0
+        super().__init__()
+
     def reset(self):
         super().reset()
         self._server_time = 0
+        self._etag = ""
         self._last_auth_get = 0
         self._pull_statuses = [0, 0, 0, 0, 0]
         self._auth = window.auth.get_auth_info()
@@ -793,9 +856,94 @@ class ConnectedDataStore(BaseDataStore):
         # Push to server, then pull
         for kind in ["settings", "records"]:
             await self._push(kind, auth.token)
-        await self._pull(auth.token)
+        # Pull using a long-poll if we can, so that we get updates soon,
+        # without polling all the time. Only one long-poll at a time; a
+        # sync triggered by a local change does a normal pull meanwhile.
+        # When subscribed to the event stream, we only pull when notified.
+        if (
+            self._server_time > 0
+            and not self._long_polling
+            and not self._is_subscribed()
+            and not window.document.hidden
+        ):
+            self._long_polling = True
+            self.sync_time = dt.now(), dt.now() + self._long_poll_wait
+            if self.state == "sync":
+                self._set_state("")  # don't show a spinner while we wait
+            try:
+                await self._pull(auth.token, self._long_poll_wait)
+            finally:
+                self._long_polling = False
+            # Start the next long-poll right away (if all is well)
+            if self._pull_statuses[-1] in (200, 304) and not window.document.hidden:
+                self.sync_soon(0.1)
+        else:
+            await self._pull(auth.token)
         # Save to local cache
         await self._save_to_cache()
+        # Subscribe to the event stream if we can
+        if (
+            self._stream_state == ""
+            and self._pull_statuses[-1] in (200, 304)
+            and dt.now() > self._stream_retry_time
+        ):
+            self._stream_state = "connecting"
+            window.setTimeout(self._subscribe, 0)
+
+    def _is_subscribed(self):
+        return self._stream_state == "connected"
+
+    async def _subscribe(self):
+        """Subscribe to the server's stream of change events. Runs until
+        the stream drops, after which we fall back to polling.
+        """
+        auth = self.get_auth()
+        url = location.protocol + "//" + location.hostname + ":" + location.port
+        url = url.rstrip(":") + "/api/v1/events"
+        controller = window.AbortController()
+        headers = {"authtoken": auth.token if auth else ""}
+        init = dict(method="GET", headers=headers, signal=controller.signal)
+
+        # If we did not get a keepalive for a while, the stream is probably
+        # broken (or buffered by a proxy), so we abort it.
+        def watchdog():
+            if dt.now() - self._stream_last_time > 45:
+                controller.abort()
+
+        t0 = self._stream_last_time = dt.now()
+        interval = window.setInterval(watchdog, 5000)
+        try:
+            res = await window.fetch(url, init)
+            if res.status != 200 or not res.body:
+                raise RuntimeError("Could not subscribe: " + res.status)
+            reader = res.body.getReader()
+            decoder = window.TextDecoder()
+            buffer = ""
+            while True:
+                chunk = await reader.read()
+                if chunk.done:
+                    break
+                self._stream_last_time = dt.now()
+                buffer += decoder.decode(chunk.value, {"stream": True})
+                messages = buffer.split("\n\n")
+                buffer = messages.pop(-1)
+                for message in messages:
+                    if message.startswith("event: ready"):
+                        # We only trust the stream once we get data through it.
+                        # We pull because we may have missed changes.
+                        self._stream_state = "connected"
+                        self.sync_soon(0.1)
+                    elif message.startswith("event: changed"):
+                        self.sync_soon(0.1)
+        except Exception as err:
+            console.warn(str(err))
+        finally:
+            window.clearInterval(interval)
+        # Fall back to polling. Retry later if the stream did not last long.
+        self._stream_state = ""
+        if dt.now() - t0 < 10:
+            self._stream_retry_time = dt.now() + 60
+        self.sync_soon(1)
 
     async def _force_reset(self):
         # Set the reset flag at the server. Intended for testing.
@@ -820,7 +968,7 @@ class ConnectedDataStore(BaseDataStore):
         # Fetch and wait for response
         init = dict(
             method="PUT",
-            body=JSON.stringify(items.values()),
+            body=JSON.stringify(to_columns(items.values())),
             headers={"authtoken": authtoken},
         )
         try:
@@ -854,56 +1002,96 @@ class ConnectedDataStore(BaseDataStore):
                 self._set_state("warning")
                 console.warn(f"Server dropped a {kind}: {err}")
 
-    async def _pull(self, authtoken):
+    async def _pull(self, authtoken, wait=0):
 
-        # Build url
+        # Build url. We get the records in pages, so that a large response
+        # (e.g. after a reset) is processed incrementally. And in the
+        # columnar format, which is more compact.
         url = location.protocol + "//" + location.hostname + ":" + location.port
-        url = url.rstrip(":") + "/api/v1/updates?since=" + self._server_time
-
-        # Fetch and wait for response
-        init = dict(method="GET", headers={"authtoken": authtoken})
-        try:
-            res = await window.fetch(url, init)
-        except Exception as err:
-            res = dict(status=0, statusText=str(err), text=lambda: "")
-        self._pull_statuses.append(res.status)
-        self._pull_statuses = self._pull_statuses[-5:]
+        url = url.rstrip(":") + "/api/v1/updates?format=columns"
+        url += "&limit=" + self._pull_page_size
+        next_url = url + "&since=" + self._server_time
+        if wait > 0:
+            next_url += "&wait=" + wait
+
+        server_time = 0
+        etag = self._etag
+        while next_url:
+
+            # Fetch and wait for response. For the first page we send the
+            # ETag of our last pull, so the server can tell that nothing changed.
+            headers = {"authtoken": authtoken}
+            if server_time == 0 and self._etag:
+                headers["If-None-Match"] = self._etag
+            init = dict(method="GET", headers=headers)
+            try:
+                res = await window.fetch(next_url, init)
+            except Exception as err:
+                res = dict(status=0, statusText=str(err), text=lambda: "")
+            self._pull_statuses.append(res.status)
+            self._pull_statuses = self._pull_statuses[-5:]
+
+            # Process response
+            if res.status == 304:
+                return  # Not modified, so there's nothing new
+            elif res.status != 200:
+                console.warn(
+                    res.status + " (" + res.statusText + ") " + await res.text()
+                )
+                self._set_state("error")  # E.g. Wifi or server down, or 500
+                if res.status == 403:
+                    if (
+                        self._pull_statuses[-2] != 403
+                        and self._pull_statuses[-3] != 403
+                    ):
+                        # We do have internet, but token is invalid: renew and sync sooner
+                        await window.auth.renew_maybe()
+                        self.sync_soon(4)
+                return
 
-        # Process response
-        if res.status != 200:
-            console.warn(res.status + " (" + res.statusText + ") " + await res.text())
-            self._set_state("error")  # E.g. Wifi or server down, or 500
-            if res.status == 403:
-                if self._pull_statuses[-2] != 403 and self._pull_statuses[-3] != 403:
-                    # We do have internet, but token is invalid: renew and sync sooner
-                    await window.auth.renew_maybe()
-                    self.sync_soon(4)
-        else:
             ob = JSON.parse(await res.text())
-            if ob.server_time:
+            if not ob.server_time:
+                return
+            ob.records = from_columns(ob.records)
+            ob.settings = from_columns(ob.settings)
+            if server_time == 0:
+                # This is the first page
                 self._log_load("server", ob)
                 # Reset?
                 if ob.reset:
                     await self._clear_cache()
                     self.reset()
-                self._server_time = ob.server_time
-                # The odds of something going wrong here are tiny ...
-                # but if they happen, we're out of sync with the server :(
-                try:
-                    self.settings._put_received(*ob.settings)
-                except Exception as err:
-                    self._set_state("warning")
-                    window.alert(str(err))
-                try:
-                    self.records._put_received(*ob.records)
-                except Exception as err:
-                    self._set_state("warning")
-                    window.alert(str(err))
-
-                # Set state to ok if we got new items, and if there were no errors
-                if ob.settings or ob.records:
-                    if self.state != "warning":
-                        self._set_state("ok")
+                server_time = ob.server_time
+                # Early exits have no ETag; nothing changed, so keep ours
+                etag = res.headers.get("etag") or etag
+            # The odds of something going wrong here are tiny ...
+            # but if they happen, we're out of sync with the server :(
+            try:
+                self.settings._put_received(*ob.settings)
+            except Exception as err:
+                self._set_state("warning")
+                window.alert(str(err))
+            try:
+                self.records._put_received(*ob.records)
+            except Exception as err:
+                self._set_state("warning")
+                window.alert(str(err))
+
+            # Set state to ok if we got new items, and if there were no errors
+            if ob.settings or ob.records:
+                if self.state != "warning":
+                    self._set_state("ok")
+
+            # Is there another page? If so, draw what we have so far.
+            next_url = None
+            if ob.next:
+                next_url = url + "&cursor=" + window.encodeURIComponent(ob.next)
+                if window.canvas:
+                    window.canvas.update()
+
+        # Only now that we got all pages, we can move our server time forward
+        self._server_time = server_time
+        self._etag = etag
 
 
 class SandboxDataStore(BaseDataStore):
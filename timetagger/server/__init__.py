@@ -1,5 +1,8 @@
 # flake8: noqa
 
 from ._utils import asyncthis, asyncify
-from ._apiserver import api_handler, get_user_db, INDICES
+from ._apiserver import api_handler, get_user_db, configure_sqlite, INDICES
+from ._apiserver import configure_storage
+from ._metrics import metrics_handler
+from ._tracing import configure_tracing, traces_handler
 from ._assets import md2html, create_assets_from_dir
@@ -0,0 +1,134 @@
+"""
+Maintenance commands for the timetagger server. Usage:
+
+    python -m timetagger.server rebuild [user ...]
+    python -m timetagger.server compact [user ...] [--retention-days N] [--jobs N]
+    python -m timetagger.server backup BACKUP_DIR [user ...] [--jobs N] [--force]
+    python -m timetagger.server restore BACKUP_DIR user
+    python -m timetagger.server migrate [user ...]
+
+These can be run while the server is running.
+"""
+
+import os
+import sys
+import argparse
+
+from ._versions import SharedVersionTable
+from ._apiserver import version_registry
+from ._maintenance import get_all_users, rebuild, compact_many, migrate
+from ._backup import backup, restore
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m timetagger.server",
+        description="Maintenance commands for the timetagger server.",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+
+    sub = subparsers.add_parser(
+        "rebuild", help="rebuild the stats and tag index from the records"
+    )
+    sub.add_argument("users", nargs="*", help="the users to process (default all)")
+
+    sub = subparsers.add_parser(
+        "compact", help="purge old hidden records, and vacuum the databases"
+    )
+    sub.add_argument("users", nargs="*", help="the users to process (default all)")
+    sub.add_argument(
+        "--retention-days",
+        type=float,
+        default=90,
+        help="purge hidden records not modified in this many days (default 90)",
+    )
+    sub.add_argument(
+        "--no-vacuum", action="store_true", help="don't run VACUUM and ANALYZE"
+    )
+    sub.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="the number of processes to use (default the number of cpus)",
+    )
+    sub.add_argument(
+        "--version-table",
+        default=None,
+        help="the SharedVersionTable file of the server (if it uses one)",
+    )
+
+    sub = subparsers.add_parser(
+        "backup", help="make a consistent backup of the databases that changed"
+    )
+    sub.add_argument("backup_dir", help="the directory to store the backups in")
+    sub.add_argument("users", nargs="*", help="the users to process (default all)")
+    sub.add_argument(
+        "--jobs", type=int, default=4, help="the number of threads (default 4)"
+    )
+    sub.add_argument(
+        "--force", action="store_true", help="also backup unchanged databases"
+    )
+
+    sub = subparsers.add_parser("restore", help="restore a database from a backup")
+    sub.add_argument("backup_dir", help="the directory with the backups")
+    sub.add_argument("users", nargs=1, help="the user to restore")
+    sub.add_argument(
+        "--version-table",
+        default=None,
+        help="the SharedVersionTable file of the server (if it uses one)",
+    )
+
+    sub = subparsers.add_parser(
+        "migrate", help="move databases from the flat to the sharded dir layout"
+    )
+    sub.add_argument("users", nargs="*", help="the users to process (default all)")
+
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.error("a command is required")
+
+    users = args.users or get_all_users()
+    if args.command == "rebuild":
+        for user in users:
+            count = rebuild(user)
+            print(f"Rebuilt {user!r} ({count} records)")
+    elif args.command == "compact":
+        results = compact_many(
+            users,
+            args.retention_days,
+            not args.no_vacuum,
+            args.jobs,
+            args.version_table,
+        )
+        total = 0
+        for r in results:
+            reclaimed = r["size_before"] - r["size_after"]
+            total += reclaimed
+            print(
+                f"Compacted {r['user']!r}: purged {r['purged']} records, "
+                f"reclaimed {reclaimed / 1024:0.1f} KiB"
+            )
+        print(f"Reclaimed {total / 2 ** 20:0.2f} MiB in total")
+    elif args.command == "backup":
+        count = 0
+        for r in backup(users, args.backup_dir, args.jobs, args.force):
+            count += 1
+            print(f"Backed up {r['key']!r} ({r['size'] / 1024:0.1f} KiB)")
+        print(f"Backed up {count} of {len(users)} databases")
+    elif args.command == "restore":
+        if args.version_table:
+            version_registry.table = SharedVersionTable(args.version_table)
+        restore(users[0], args.backup_dir)
+        print(f"Restored {users[0]!r}")
+    elif args.command == "migrate":
+        count = 0
+        for user in users:
+            if migrate(user):
+                count += 1
+                print(f"Migrated {user!r}")
+        print(f"Migrated {count} of {len(users)} databases")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,12 +4,30 @@ This implements the API side of the server.
 
 import os
 import json
+import math
 import time
+import zlib
+import base64
+import asyncio
 import logging
 
-from itemdb import ItemDB
-
-from ._utils import asyncthis, user2filename
+from asgineer.utils import normalize_response
+
+from ._utils import asyncthis, scheduler, stat_cache, ROOT_USER_DIR
+from ._utils import user2filename  # noqa: F401 - used by the tests
+from ._scheduler import QueueFullError
+from ._dbpool import DBPool, SQLITE_PROFILES, check_pragmas
+from ._storage import FileStorage, SharedStorage
+from ._pgstorage import PostgresStorage
+from ._versions import VersionRegistry, ChangeNotifier
+from ._compression import choose_encoding, encode_response, compress_response
+from ._compression import ResponseCache
+from ._coalescer import WriteCoalescer
+from ._metrics import registry, timed, SIZE_BUCKETS
+from ._tracing import tracer, traced, span
+from ._stats import get_stats_deltas, get_bin_edges, get_tagz, add_overlap, BIN_SIZES
+from ._stats import STATS_BIN_SIZE, EXACT_BIN, MAX_AGGREGATE_DURATION, is_aggregated
+from ._stats import get_record_tags, get_tags_deltas, overlaps
 
 
 logger = logging.getLogger("asgineer")
@@ -67,11 +85,299 @@ INDICES = {
     "records": ("!key", "st", "t1", "t2"),
     "settings": ("!key", "st"),
     "userinfo": ("!key", "st"),
+    "stats": ("!key", "bin"),
+    "record_tags": ("!key", "tag"),
+    "tag_totals": ("!key",),
 }
 
+# The tables that are synced with the client. The other tables are
+# derived from the records, see _update_derived_tables().
+SYNCED_TABLES = "records", "settings", "userinfo"
+
+# Use the tag index to find records, if the tag has at most this many records
+MAX_TAG_LOOKUP = 1000
+
+# A version number for the schema. It changes when INDICES changes.
+SCHEMA_VERSION = zlib.crc32(json.dumps(INDICES, sort_keys=True).encode())
+
+
+@traced("ensure_schema")
+def ensure_schema(db):
+    """Make sure that the tables in the given db match INDICES. The
+    schema version is stored in the db, so that we only need to ensure
+    the tables when the db is new, or when INDICES has changed.
+    """
+    try:
+        ob = db.select_one("userinfo", "key == 'schema_version'")
+    except KeyError:
+        ob = None  # the userinfo table does not exist yet
+    if ob and ob["value"] == SCHEMA_VERSION:
+        return
+    with db:
+        for what in INDICES:
+            db.ensure_table(what, *INDICES[what])
+        # The derived tables may be missing or outdated in an older db
+        rebuild_derived_tables(db)
+        st = time.time()
+        db.put_one("userinfo", key="schema_version", st=st, mt=st, value=SCHEMA_VERSION)
+
+
+# The pool of open user databases. Steady-state polling of a user
+# re-uses the same sqlite connection instead of opening a new one.
+# Each database is initialized (once per process) with ensure_schema(),
+# so that the request handlers don't have to call ensure_table().
+# The sqlite pragmas can be set with configure_sqlite().
+db_pool = DBPool(
+    initializer=ensure_schema,
+    pragmas=SQLITE_PROFILES["production"],
+    stat_cache=stat_cache,
+)
+
+
+def configure_sqlite(profile="production", **pragmas):
+    """Configure the sqlite pragmas for the user databases. The profile
+    can be "production" (the default: WAL with synchronous=NORMAL),
+    "durable" (WAL with synchronous=FULL), or "compat" (sqlite's
+    defaults). Keyword arguments override individual pragmas, e.g.
+    ``configure_sqlite(mmap_size=0)``. Applies to connections opened
+    after this call.
+    """
+    if profile not in SQLITE_PROFILES:
+        raise ValueError(f"Invalid sqlite profile {profile!r}")
+    pragmas = check_pragmas({**SQLITE_PROFILES[profile], **pragmas})
+    pools = [db_pool]
+    if isinstance(storage, SharedStorage):
+        pools.append(storage.pool)
+    for pool in pools:
+        pool.pragmas = pragmas
+        pool.clear()
+
+
+# The storage backend, see configure_storage()
+storage = FileStorage(db_pool)
+
+
+def configure_storage(backend="files", filename=None, dsn=None, **kwargs):
+    """Configure how the user data is stored. The backend can be "files"
+    (the default: a sqlite database per user, in ROOT_USER_DIR),
+    "shared" (a single sqlite database for all users, at the given
+    filename, by default "_shared.db" in ROOT_USER_DIR), or "postgres"
+    (a PostgreSQL database at the given dsn, using asyncpg; the kwargs
+    are passed to PostgresStorage). Existing data is not converted.
+    Should be called before the server starts.
+    """
+    global storage
+    if backend == "files":
+        storage = FileStorage(db_pool)
+    elif backend == "shared":
+        filename = filename or os.path.join(ROOT_USER_DIR, "_shared.db")
+        storage = SharedStorage(
+            filename,
+            initializer=ensure_schema,
+            pragmas=db_pool.pragmas,
+            stat_cache=stat_cache,
+        )
+    elif backend == "postgres":
+        storage = PostgresStorage(dsn, indices=INDICES, **kwargs)
+    else:
+        raise ValueError(f"Invalid storage backend {backend!r}")
+
+
+def get_storage():
+    """Get the configured storage backend."""
+    return storage
+
+
+def _release_dbs():
+    # Called in the threads of the scheduler after each task, so that the
+    # dbs of idle threads can be closed when needed, see DBPool.release()
+    db_pool.release()
+    if isinstance(storage, SharedStorage):
+        storage.pool.release()
+
+
+scheduler.add_task_callback(_release_dbs)
+
+
+# The registry of the latest write per user. Writers bump it, so that polls
+# for which nothing has changed can exit early. To stay coherent when running
+# multiple processes, set version_registry.table to a SharedVersionTable.
+version_registry = VersionRegistry()
+
+# To wake up long-polling requests when new data is pushed
+change_notifier = ChangeNotifier()
+
+# The maximum time that a long-poll can take. Should be well below the
+# timeout of any proxies.
+MAX_WAIT = 30
+
+# The interval for keepalive messages on event streams, and the interval at
+# which an event stream checks the version registry (for writes by other
+# processes).
+EVENTS_KEEPALIVE = 15
+EVENTS_CHECK_INTERVAL = 5
+
+# The number of items per chunk in streaming responses
+STREAM_CHUNK_SIZE = 1000
+MAX_STATS_BINS = 1000
+
+# JSON responses at least this size (in bytes) are compressed, if the
+# client accepts it.
+API_MIN_COMPRESS_SIZE = 1024
+
+# Encoded responses with all items of a user (e.g. after a reset), so
+# that when many devices need these at once, they are produced only once.
+updates_cache = ResponseCache()
+
+
+# %% Metrics
+
+API_ROUTES = (
+    "",
+    "updates",
+    "events",
+    "records",
+    "settings",
+    "stats",
+    "tags",
+    "forcereset",
+)
+
+request_duration = registry.histogram(
+    "timetagger_request_duration_seconds",
+    "Time to produce an API response (excluding streaming).",
+    ["route", "method"],
+)
+requests_total = registry.counter(
+    "timetagger_requests_total",
+    "Number of API requests.",
+    ["route", "method", "status"],
+)
+response_size = registry.histogram(
+    "timetagger_response_size_bytes",
+    "Size of API response bodies, after compression.",
+    ["route"],
+    SIZE_BUCKETS,
+)
+db_duration = registry.histogram(
+    "timetagger_db_duration_seconds",
+    "Time spent in functions that access the database.",
+    ["func"],
+)
+encode_duration = registry.histogram(
+    "timetagger_encode_duration_seconds",
+    "Time spent encoding (and compressing) JSON responses.",
+    ["encoding"],
+)
+updates_total = registry.counter(
+    "timetagger_updates_total",
+    "Number of update checks, by how they were answered: early via the "
+    "version registry or mtime, not modified, from the cache, or by a query.",
+    ["result"],
+)
+pushed_items = registry.counter(
+    "timetagger_pushed_items_total",
+    "Number of pushed items that were accepted or failed.",
+    ["what", "result"],
+)
+push_size = registry.histogram(
+    "timetagger_push_size_items",
+    "Number of items per push.",
+    ["what"],
+    (1, 10, 100, 1000, 10_000),
+)
+scheduler_gauges = {
+    key: registry.gauge(f"timetagger_scheduler_{key}", f"Scheduler {key}.", ["lane"])
+    for key in ("waiting", "running", "completed", "rejected", "wait_time_total")
+}
+dbpool_gauges = {
+    key: registry.gauge(f"timetagger_dbpool_{key}", f"Database pool {key}.")
+    for key in ("open", "hits", "misses", "evictions", "expired")
+}
+
+
+def _collect_metrics():
+    for lane, stats in scheduler.get_stats().items():
+        for key, gauge in scheduler_gauges.items():
+            gauge.set(lane, value=stats[key])
+    stats = storage.get_stats()
+    for key, gauge in dbpool_gauges.items():
+        gauge.set(value=stats[key])
+
+
+registry.add_collector(_collect_metrics)
+
+
+# %% Handlers
+
 
 async def api_handler(request, apipath, user):
     """The main API request handler."""
+    t0 = time.perf_counter()
+    route = apipath if apipath in API_ROUTES else "other"
+    status = 500  # in case of an error
+    trace = tracer.start(f"{request.method} {route}", user)  # None if disabled
+
+    try:
+        try:
+            response = await _api_handler(request, apipath, user)
+            response = await _encode_response(request, response)
+        except QueueFullError:
+            # Backpressure: the client will try again later
+            response = 503, {"retry-after": "5"}, "The server is busy, try again later"
+        status, headers, body = response = normalize_response(response)
+        if isinstance(body, bytes):
+            response_size.observe(route, value=len(body))
+        return response
+    finally:
+        request_duration.observe(route, request.method, value=time.perf_counter() - t0)
+        requests_total.inc(route, request.method, status)
+        tracer.finish(trace, status)
+
+
+async def _encode_response(request, response):
+    status, headers, body = normalize_response(response)
+    if not isinstance(body, dict):
+        return response
+    encoding = choose_encoding(request.headers.get("accept-encoding", ""))
+    return await _encode_and_compress(response, encoding)
+
+
+async def _encode_and_compress(response, encoding):
+    # Encode a JSON response, and compress it if it's large. Compression
+    # is cpu-bound, so we do it in a thread. Small responses (e.g. polls
+    # without updates) are encoded inline, without a thread hop.
+    t0 = time.perf_counter()
+    with span("serialize"):
+        response = encode_response(response, "", API_MIN_COMPRESS_SIZE)
+    duration = time.perf_counter() - t0
+    if encoding and len(response[2]) >= API_MIN_COMPRESS_SIZE:
+        response, compress_duration = await asyncthis(
+            _compress_response_timed, response, encoding
+        )
+        duration += compress_duration
+    else:
+        encoding = ""
+    encode_duration.observe(encoding or "identity", value=duration)
+    return response
+
+
+def _compress_response_timed(response, encoding):
+    t0 = time.perf_counter()
+    with span("compress"):
+        response = compress_response(response, encoding, API_MIN_COMPRESS_SIZE)
+    return response, time.perf_counter() - t0
+
+
+def _encode_response_timed(response, encoding):
+    t0 = time.perf_counter()
+    with span("serialize"):
+        response = encode_response(response, encoding, API_MIN_COMPRESS_SIZE)
+    encode_duration.observe(encoding or "identity", value=time.perf_counter() - t0)
+    return response
+
+
+async def _api_handler(request, apipath, user):
 
     # Take care that our PUT (and DELETE) are idempotent (multiple
     # identical requests should have the same effect as a single request)
@@ -79,14 +385,28 @@ async def api_handler(request, apipath, user):
     # Upon an error, we just respond with an appropriate status code, and a
     # message in text/plain; we don't try to wrap the error in a dict.
 
+    # An async storage backend opens its connection pool on the event loop
+    if storage.is_async:
+        await storage.open()
+
     if not apipath:
         # Respond with "index" if this is the API root
         baseurl = f"{request.scheme}://{request.host}:{request.port}/api/v1/"
         return {
             "version": 1,
             "GET updates since the given time": baseurl + "updates?since=xx",
-            # "GET records.": baseurl + "records",
+            "GET updates, waiting for changes": baseurl + "updates?since=xx&wait=yy",
+            "GET updates in pages": baseurl + "updates?since=xx&limit=nn",
+            "GET next page of updates": baseurl + "updates?cursor=cc&limit=nn",
+            "GET streamed updates": baseurl + "updates?since=xx&stream=1",
+            "GET updates as columns": baseurl + "updates?since=xx&format=columns",
+            "GET stream of change events": baseurl + "events",
+            "GET records in a time range": baseurl + "records?timerange=t1-t2",
+            "GET records with tags": baseurl + "records?timerange=t1-t2&tags=a,b",
             "GET settings": baseurl + "settings",
+            "GET stats per tag combination": baseurl + "stats?t1=xx&t2=yy",
+            "GET stats per day/week/month": baseurl + "stats?t1=xx&t2=yy&bin=day",
+            "GET the number of records and total time per tag": baseurl + "tags",
             "PUT (add/update) records": baseurl + "records",
             "PUT (push/update) user settings": baseurl + "settings",
         }
@@ -97,11 +417,19 @@ async def api_handler(request, apipath, user):
         else:
             return 405, {}, "/api/v1/updates can only be used with GET"
 
+    elif apipath == "events":
+        if request.method == "GET":
+            return await events_handler(request, user)
+        else:
+            return 405, {}, "/api/v1/events can only be used with GET"
+
     elif apipath == "records":
         if request.method == "PUT":
             return await put_items_handler(request, user, "records")
+        elif request.method == "GET":
+            return await get_records_handler(request, user)
         else:
-            return 405, {}, "/api/v1/records can only be used with PUT"
+            return 405, {}, "/api/v1/records can only be used with PUT or GET"
 
     elif apipath == "settings":
         if request.method == "PUT":
@@ -111,6 +439,18 @@ async def api_handler(request, apipath, user):
         else:
             return 405, {}, "/api/v1/settings can only be used with PUT or GET"
 
+    elif apipath == "stats":
+        if request.method == "GET":
+            return await get_stats_handler(request, user)
+        else:
+            return 405, {}, "/api/v1/stats can only be used with GET"
+
+    elif apipath == "tags":
+        if request.method == "GET":
+            return await get_tags_handler(request, user)
+        else:
+            return 405, {}, "/api/v1/tags can only be used with GET"
+
     elif apipath == "forcereset":
         if request.method == "PUT":
             return await force_reset_handler(request, user)
@@ -121,62 +461,173 @@ async def api_handler(request, apipath, user):
         return 404, {}, "invalid API call"
 
 
+@traced("db_open")
 def get_user_db(user):
     """Open the user db and return the db and its mtime (which is -1 if the db did not yet exist)."""
-    # Get database name and its mtime
-    dbname = user2filename(user)
-    if os.path.isfile(dbname):
-        mtime = os.path.getmtime(dbname)
-    else:
-        mtime = -1
-    # Open the database, this creates it if it does not yet exist
-    db = ItemDB(dbname)
-    return db, mtime
+    return storage.get_user_db(user)
+
+
+def notify_write(user):
+    """Call after a write to the user db, so that the next get_user_db()
+    sees the new mtime (the mtime is cached for a short time).
+    """
+    storage.notify_write(user)
 
 
 async def force_reset_handler(request, user):
     """Set the reset_time to force a reset for each first next update."""
-    return await asyncthis(_force_reset, user)
+    if storage.is_async:
+        result = await _aforce_reset(user)
+    else:
+        result = await asyncthis(_force_reset, user, lane="write", key=user)
+    change_notifier.notify(user)
+    return result
 
 
+@timed(db_duration, "force_reset")
+@traced("query:force_reset")
 def _force_reset(user):
 
     db, mtime = get_user_db(user)
     st = time.time()
-    db.ensure_table("userinfo", *INDICES["userinfo"])
 
     with db:
-        db.put_one("userinfo", key="reset_time", st=st, mt=st, value=st)
+        set_reset_time(db, st)
+    notify_write(user)
+    version_registry.bump(user, st)
 
     return 200, {}, {"status": "ok"}
 
 
+def set_reset_time(db, st):
+    """Set the reset_time, so that clients that have not synced since,
+    will do a full reset. Must be called in a transaction. The caller
+    must bump the version registry after the transaction.
+    """
+    db.put("userinfo", _get_reset_time_item(st))
+
+
+def _get_reset_time_item(st):
+    """Get the userinfo item that holds the reset_time."""
+    return dict(key="reset_time", st=st, mt=st, value=st)
+
+
 async def get_updates_handler(request, user):
     """Coroutine to handle a GET updates request."""
-    # todo: it may be possible to keep track of db access in-process
-    # so that we can make this handler very fast when nothing has changed, but
-    # this fails (or becomes complex) when multiple processes are involved
-    # (e.g. live vs staging).
+    try:
+        limit = int(request.querydict.get("limit", 0))
+    except ValueError:
+        return 400, {}, "/api/v1/updates needs int ?limit argument"
+
+    format = request.querydict.get("format", "json")
+    if format not in ("json", "columns"):
+        return 400, {}, "/api/v1/updates needs ?format to be 'json' or 'columns'"
+
+    # Responses with all items of a user are cached in encoded form
+    encoding = choose_encoding(request.headers.get("accept-encoding", ""))
+    encode = format, encoding
+
+    # The client can send the ETag of its last response; if nothing has
+    # changed since, we respond with 304.
+    if_none_match = request.headers.get("if-none-match", "")
+
+    # Get the next page of a paginated response?
+    cursor = request.querydict.get("cursor", "")
+    if cursor:
+        try:
+            cursor = _decode_cursor(cursor)
+        except Exception:
+            return 400, {}, "/api/v1/updates got an invalid ?cursor argument"
+        if storage.is_async:
+            result = await _aget_updates_page(user, cursor, limit, encode)
+        else:
+            result = await asyncthis(_get_updates_page, user, cursor, limit, encode)
+        return _format_updates(result, format)
+
     try:
         since = float(request.querydict.get("since", ""))
     except ValueError:
         return 400, {}, "/api/v1/updates needs float ?since argument"
 
-    return await asyncthis(_get_updates, user, since)
+    # Stream the response? This ignores limit and wait.
+    if request.querydict.get("stream", "") in ("1", "true"):
+        if format != "json":
+            return 400, {}, "/api/v1/updates can only stream in json format"
+        result = await _get_updates_maybe_early(user, since, 0, True, None, "")
+        return _stream_response(user, result)
+
+    try:
+        wait = float(request.querydict.get("wait", 0))
+        if not math.isfinite(wait):
+            raise ValueError()
+    except ValueError:
+        return 400, {}, "/api/v1/updates needs float ?wait argument"
+    wait = max(0, min(wait, MAX_WAIT))
+
+    # Long-poll: if there are no updates, wait until there are, or until
+    # the wait time has passed. We check every few seconds, because
+    # another process may have written to the db.
+    deadline = time.time() + wait
+    while True:
+        result = await _get_updates_maybe_early(
+            user, since, limit, False, encode, if_none_match
+        )
+        remaining = deadline - time.time()
+        if remaining <= 0 or _has_updates(result):
+            return _format_updates(result, format)
+        await change_notifier.wait(user, min(remaining, 5))
+
+
+def _has_updates(response):
+    """Get whether a response of _get_updates() has anything new."""
+    status, headers, body = normalize_response(response)
+    if status == 304:
+        return False
+    elif not isinstance(body, dict):
+        return True  # an encoded response with all items
+    return bool(body["reset"] or body["records"] or body["settings"])
+
+
+async def _get_updates_maybe_early(user, since, limit, *args):
+    # Early exit based on the version registry, without touching the
+    # filesystem or database, and without going to a thread. The registry
+    # may not know of writes by other processes yet, so the client must
+    # not move past what we checked: the server_time is since, not now.
+    version = version_registry.get(user)
+    if version is not None and version + 0.2 < since:
+        updates_total.inc("registry")
+        return dict(
+            server_time=since,
+            reset=0,  # Not False; is used in the tests to know that we exited early
+            records=[],
+            settings=[],
+        )
+
+    if storage.is_async:
+        return await _aget_updates(user, since, limit, *args)
+    return await asyncthis(_get_updates, user, since, limit, *args)
 
 
-def _get_updates(user, since):
+@timed(db_duration, "get_updates")
+@traced("query:get_updates")
+def _get_updates(user, since, limit=0, stream=False, encode=None, if_none_match=""):
 
     db, mtime = get_user_db(user)
     server_time = time.time()
-    for what in ("records", "settings", "userinfo"):
-        db.ensure_table(what, *INDICES[what])
+
+    # The mtime is the latest write that we know of, so the next poll can
+    # use it to exit early.
+    if mtime > 0:
+        version_registry.bump(user, mtime)
 
     # Early exit - this is what will happen most of the time. Use a margin to
-    # account for limited resolution of getmtime.
+    # account for limited resolution of getmtime. The mtime is cached for a
+    # short time (writes by other processes are not seen yet), so the client
+    # must not move past what we checked: the server_time is since.
     if mtime + 0.2 < since:
+        updates_total.inc("mtime")
         return dict(
-            server_time=server_time,
+            server_time=since,
             reset=0,  # Not False; is used in the tests to know that we exited early
             records=[],
             settings=[],
@@ -189,29 +640,328 @@ def _get_updates(user, since):
     reset_time = float((ob or {}).get("value", -1))
     reset = since <= reset_time
 
+    # If the client has seen the current version of the data, it's up to date
+    etag = _get_etag(db, SYNCED_TABLES)
+    headers = {"etag": etag, "cache-control": "no-cache"}
+    if etag == if_none_match and not reset:
+        updates_total.inc("not_modified")
+        return 304, headers, b""
+
+    # If all items are requested, and an encoding is given, we may have
+    # the encoded response in the cache. It is keyed by the ETag.
+    cache_key, tag = _get_updates_cache_entry(user, since, limit, encode, reset, etag)
+    if cache_key:
+        response = updates_cache.get(cache_key, tag)
+        if response is not None:
+            updates_total.inc("cached")
+            return response
+
+    updates_total.inc("queried")
     if reset:
-        records = db.select_all("records")
         settings = db.select_all("settings")
     else:
         query = f"st >= {float(since)}"
-        records = db.select("records", query)
         settings = db.select("settings", query)
 
-    return dict(
+    # If a limit is given, the records are paginated; the client can
+    # get the rest using the cursor in "next". Settings are never paginated.
+    # When streaming, the records are selected later.
+    records_since = -1 if reset else since
+    if stream:
+        records = StreamedItems(records_since)
+    elif limit > 0:
+        query, args = _get_page_query(records_since, limit)
+        records, position = _split_page(db.select("records", query, *args), limit)
+        next = position and _encode_cursor(records_since, *position)
+    elif reset:
+        records = db.select_all("records")
+    else:
+        records = db.select("records", query)
+
+    result = dict(
         status="ok",
         server_time=server_time,
         reset=reset,
         records=records,
         settings=settings,
     )
+    if limit > 0:
+        result["next"] = next
+
+    if cache_key and (reset or records or settings):
+        return _encode_and_cache((200, headers, result), encode, cache_key, tag)
+    return 200, headers, result
+
+
+@timed(db_duration, "get_updates_page")
+@traced("query:get_updates_page")
+def _get_updates_page(user, cursor, limit, encode=None):
+    """Get the next page of records of a paginated updates response."""
+
+    db, mtime = get_user_db(user)
+    server_time = time.time()
+
+    # Pages of a response with all records may be in the cache
+    since, st, key = cursor
+    cache_key = None
+    if encode and since <= 0:
+        cache_key, tag = (user, cursor, limit, *encode), _get_etag(db, SYNCED_TABLES)
+        response = updates_cache.get(cache_key, tag)
+        if response is not None:
+            return response
+
+    query, args = _get_page_query(since, limit, (st, key))
+    records, position = _split_page(db.select("records", query, *args), limit)
+    next = position and _encode_cursor(since, *position)
+
+    result = dict(
+        status="ok",
+        server_time=server_time,
+        reset=False,
+        records=records,
+        settings=[],
+        next=next,
+    )
+
+    if cache_key:
+        return _encode_and_cache(result, encode, cache_key, tag)
+    return result
+
+
+def _get_etag(db, tables):
+    """Get an ETag for the given tables, based on the latest st and the
+    number of items. This is cheap, because of the indices on st.
+    """
+    latest = 0
+    for what in tables:
+        for item in db.select(what, "st > ? ORDER BY st DESC LIMIT 1", latest):
+            latest = item["st"]
+    count = sum(db.count_all(what) for what in tables)
+    return f'"{latest}-{count}"'
+
+
+def _get_updates_cache_entry(user, since, limit, encode, reset, etag):
+    """Get the key and tag for the cache of encoded updates responses,
+    or (None, None) if the response is not cached. Only responses with
+    all items are cached.
+    """
+    if encode and (reset or since <= 0):
+        return (user, limit, *encode), (reset, etag)
+    return None, None
+
+
+def _encode_and_cache(response, encode, cache_key, tag):
+    # Note that the cached response has a server_time from the moment it
+    # was produced. That's fine: nothing has changed since, or the tag
+    # would not have matched.
+    format, encoding = encode
+    response = _format_updates(response, format)
+    response = _encode_response_timed(response, encoding)
+    updates_cache.put(cache_key, tag, response)
+    return response
+
+
+def _format_updates(response, format):
+    """Convert the records and settings in the response to the given format."""
+    body = response[2] if isinstance(response, tuple) else response
+    if format == "columns" and isinstance(body, dict):
+        body["records"] = _to_columns(body["records"])
+        body["settings"] = _to_columns(body["settings"])
+    return response
+
+
+def _to_columns(items):
+    """Convert a list of items to the columnar format: a dict with a
+    list of values for each field. Fields that an item does not have
+    are null, and "missing" has the indices of these items per field
+    (null is also a valid value). Since the field names are not repeated
+    for each item, this is about half the size, and faster to parse.
+    """
+    fields = {}
+    for item in items:
+        fields.update(dict.fromkeys(item))
+    columns = {field: [item.get(field, None) for item in items] for field in fields}
+    missing = {}
+    for field in fields:
+        indices = [i for i, item in enumerate(items) if field not in item]
+        if indices:
+            missing[field] = indices
+    return {"count": len(items), "columns": columns, "missing": missing}
+
+
+def _from_columns(ob):
+    """Convert items in the columnar format to a list of items. Without
+    "missing" (older clients), null values are omitted.
+    """
+    count = ob.get("count", None)
+    columns = ob.get("columns", None)
+    missing = ob.get("missing", None)
+    if not isinstance(count, int) or not isinstance(columns, dict):
+        raise TypeError("Columnar items must have an int count and dict columns")
+    for values in columns.values():
+        if not isinstance(values, list) or len(values) != count:
+            raise TypeError(f"Columnar items must have {count} values per field")
+    if count and not columns:
+        raise TypeError("Columnar items must have at least one field")
+    if missing is not None:
+        if not isinstance(missing, dict):
+            raise TypeError("Columnar items must have a dict of missing fields")
+        for indices in missing.values():
+            if not isinstance(indices, list) or not all(
+                isinstance(i, int) and 0 <= i < count for i in indices
+            ):
+                raise TypeError("Columnar items must have a list of indices per field")
+
+    items = [{} for i in range(count)]
+    for field, values in columns.items():
+        if missing is None:
+            absent = [value is None for value in values]
+        else:
+            absent = [False] * count
+            for i in missing.get(field, ()):
+                absent[i] = True
+        for item, value, is_absent in zip(items, values, absent):
+            if not is_absent:
+                item[field] = value
+    return items
+
+
+def _get_page_query(since, limit, after=None):
+    """Get the query (and its args) to select items with st >= since,
+    sorted by (st, key), and starting after the given (st, key) position.
+    A limit of zero means no limit.
+    """
+    # The position is also used as lower bound for st, so that the
+    # index on st is used to skip the items of earlier pages.
+    query = "st >= ?"
+    args = [since]
+    if after is not None:
+        query = "st >= ? AND (st > ? OR key > ?)"
+        args = [max(since, after[0]), after[0], after[1]]
+    # Note that we select one more than the limit, to know whether there's more
+    query += " ORDER BY st, key LIMIT ?"
+    args.append(limit + 1 if limit > 0 else -1)
+    return query, args
+
+
+def _split_page(items, limit):
+    """Split the items of a page query. Returns the items, and the
+    position of the last item if there are more (or None).
+    """
+    if limit > 0 and len(items) > limit:
+        items = items[:limit]
+        return items, (items[-1]["st"], items[-1]["key"])
+    return items, None
+
+
+def _encode_cursor(since, st, key):
+    """Encode a position in the records in an opaque string."""
+    return base64.urlsafe_b64encode(json.dumps([since, st, key]).encode()).decode()
+
+
+def _decode_cursor(cursor):
+    """Decode a cursor produced by _encode_cursor()."""
+    since, st, key = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    return float(since), float(st), str(key)
+
+
+async def events_handler(request, user):
+    """Coroutine to handle a GET events request. Responds with a stream of
+    Server-Sent Events, notifying the client of new data.
+    """
+    headers = {
+        "content-type": "text/event-stream",
+        "cache-control": "no-cache",
+        "x-accel-buffering": "no",  # Tell nginx not to buffer the stream
+    }
+    return 200, headers, _event_stream(request, user)
+
+
+async def _event_stream(request, user):
+    # We send a "changed" event when data is pushed for this user in this
+    # process, or when we see that another process wrote to the db. The
+    # stream ends when the client disconnects.
+    event = change_notifier.subscribe(user)
+    try:
+        yield "event: ready\ndata: {}\n\n"
+        last_version = await _get_version(user)
+        last_send = time.time()
+        while True:
+            try:
+                changed = await _wait_for_change(request, event, EVENTS_CHECK_INTERVAL)
+            except IOError:  # incl. asgineer.DisconnectedError
+                break
+            event.clear()
+            version = await _get_version(user)
+            changed = changed or version > last_version
+            if changed:
+                data = json.dumps({"server_time": version or time.time()})
+                yield f"event: changed\ndata: {data}\n\n"
+                last_send = time.time()
+            elif time.time() - last_send >= EVENTS_KEEPALIVE:
+                yield ": keepalive\n\n"
+                last_send = time.time()
+            last_version = max(version, last_version)
+    finally:
+        change_notifier.unsubscribe(user, event)
+
+
+async def _get_version(user):
+    """Get the latest version of the user's data (0 if unknown), for an
+    event stream. The in-process version registry does not see writes by
+    other processes (and its entries expire), so then we also check the
+    mtime of the db.
+    """
+    version = version_registry.get(user) or 0
+    if version_registry.table is not None:
+        return version
+    try:
+        if storage.is_async:
+            db, mtime = await aget_user_db(user)
+        else:
+            mtime = await asyncthis(_get_mtime, user)
+    except QueueFullError:
+        return version  # check again later
+    return max(version, mtime)
+
+
+def _get_mtime(user):
+    db, mtime = get_user_db(user)
+    return mtime
+
+
+async def _wait_for_change(request, event, timeout):
+    """Wait until the event is set or the timeout has passed, while the
+    client is connected. Returns whether the event is set. Raises an
+    IOError when the client disconnects.
+    """
+
+    async def wake_on_event():
+        await event.wait()
+        await request.wakeup()
+
+    waker = asyncio.ensure_future(wake_on_event())
+    try:
+        await request.sleep_while_connected(timeout)
+    finally:
+        waker.cancel()
+    return event.is_set()
 
 
 async def get_items_handler(request, user, what):
     """Coroutine to handle a GET settings request."""
-    return await asyncthis(_get_items, user, what)
+    if_none_match = request.headers.get("if-none-match", "")
+    stream = request.querydict.get("stream", "") in ("1", "true")
+    if storage.is_async:
+        result = await _aget_items(user, what, stream, if_none_match)
+    else:
+        result = await asyncthis(_get_items, user, what, stream, if_none_match)
+    return _stream_response(user, result) if stream else result
 
 
-def _get_items(user, what):
+@timed(db_duration, "get_items")
+@traced("query:get_items")
+def _get_items(user, what, stream=False, if_none_match=""):
 
     db, mtime = get_user_db(user)
     server_time = time.time()
@@ -219,96 +969,759 @@ def _get_items(user, what):
     if mtime <= 0:
         return 200, {}, {"server_time": server_time, what: []}
 
-    db.ensure_table(what, *INDICES[what])
-    items = db.select_all(what)
-    return 200, {}, {"status": "ok", "server_time": server_time, what: items}
+    etag = _get_etag(db, [what])
+    headers = {"etag": etag, "cache-control": "no-cache"}
+    if etag == if_none_match:
+        return 304, headers, b""
+
+    items = StreamedItems(-1) if stream else db.select_all(what)
+    return 200, headers, {"status": "ok", "server_time": server_time, what: items}
+
+
+class StreamedItems:
+    """Placeholder in a result, for items with st >= since that are
+    streamed by _stream_response().
+    """
+
+    def __init__(self, since):
+        self.since = since
+
+
+def _stream_response(user, result):
+    """Turn a result that contains a StreamedItems object into a
+    streaming response. Other results are returned as-is.
+    """
+    status, headers, body = normalize_response(result)
+    if not isinstance(body, dict):
+        return result
+    for what, value in body.items():
+        if isinstance(value, StreamedItems):
+            body = {key: val for key, val in body.items() if key != what}
+            headers = {**headers, "content-type": "application/json"}
+            return status, headers, _stream_items(user, body, what, value.since)
+    return result
+
+
+async def _stream_items(user, head, what, since):
+    # Produce the JSON incrementally: the head dict, with the items
+    # added under the key 'what'. The items are selected in chunks,
+    # each in a short query in a thread. This way memory stays flat,
+    # and we don't hold back writers with a long-running read.
+    head = json.dumps(head)
+    yield head[:-1] + (", " if len(head) > 2 else "") + json.dumps(what) + ": ["
+    sep = ""
+    position = None
+    while True:
+        args = user, what, since, STREAM_CHUNK_SIZE, position
+        if storage.is_async:
+            items, position = await _aget_items_chunk(*args)
+        else:
+            items, position = await asyncthis(_get_items_chunk, *args)
+        if items:
+            yield sep + json.dumps(items)[1:-1]
+            sep = ", "
+        if position is None:
+            break
+    yield "]}"
+
+
+@timed(db_duration, "get_items_chunk")
+@traced("query:get_items_chunk")
+def _get_items_chunk(user, what, since, limit, after):
+    db, mtime = get_user_db(user)
+    query, args = _get_page_query(since, limit, after)
+    return _split_page(db.select(what, query, *args), limit)
+
+
+async def get_stats_handler(request, user):
+    """Coroutine to handle a GET stats request."""
+    try:
+        t1 = float(request.querydict.get("t1", ""))
+        t2 = float(request.querydict.get("t2", ""))
+    except ValueError:
+        return 400, {}, "/api/v1/stats needs float ?t1 and ?t2 arguments"
+    if not t1 < t2:
+        return 400, {}, "/api/v1/stats needs t1 < t2"
+
+    bin = request.querydict.get("bin", "")
+    if bin and bin not in BIN_SIZES:
+        return 400, {}, "/api/v1/stats needs ?bin to be 'day', 'week' or 'month'"
+    if bin and (t2 - t1) / BIN_SIZES[bin] > MAX_STATS_BINS:
+        return 400, {}, f"/api/v1/stats can produce at most {MAX_STATS_BINS} bins"
+
+    # The timezone offset in minutes (east of UTC), to determine the bins
+    try:
+        tz = int(request.querydict.get("tz", 0))
+    except ValueError:
+        return 400, {}, "/api/v1/stats needs int ?tz argument"
+    if abs(tz) > 24 * 60:
+        return 400, {}, "/api/v1/stats needs ?tz to be at most a day"
+
+    return await asyncthis(_get_stats, user, t1, t2, bin, tz)
+
+
+@timed(db_duration, "get_stats")
+@traced("query:get_stats")
+def _get_stats(user, t1, t2, bin, tz):
+
+    db, mtime = get_user_db(user)
+    server_time = time.time()
+
+    bins = []
+    edges = get_bin_edges(t1, t2, bin, tz)
+    for bin_t1, bin_t2 in zip(edges[:-1], edges[1:]):
+        stats = {}
+        # The whole hours in the bin are obtained from the aggregates
+        h1 = -(-bin_t1 // STATS_BIN_SIZE) * STATS_BIN_SIZE
+        h2 = bin_t2 // STATS_BIN_SIZE * STATS_BIN_SIZE
+        if h1 < h2:
+            for item in db.select("stats", "bin >= ? AND bin < ?", h1, h2):
+                stats[item["tagz"]] = stats.get(item["tagz"], 0) + item["t"]
+        else:
+            h1 = h2 = bin_t2
+        # The remaining parts at the edges are obtained from the records
+        for range_t1, range_t2 in [(bin_t1, h1), (h2, bin_t2)]:
+            if range_t1 < range_t2:
+                _add_stats_from_records(db, stats, range_t1, range_t2)
+        bins.append(dict(t1=bin_t1, t2=bin_t2, stats=stats))
+
+    # Records that are not aggregated. Running records count until now,
+    # like in the client.
+    for item in db.select("stats", "bin == ?", EXACT_BIN):
+        t1, t2 = item["t1"], item["t2"]
+        t2 = max(t2, server_time) if t1 == t2 else t2
+        for b in bins:
+            add_overlap(b["stats"], item["tagz"], t1, t2, b["t1"], b["t2"])
+
+    # Drop the aggregates that were cancelled out by edits
+    for b in bins:
+        b["stats"] = {tagz: t for tagz, t in b["stats"].items() if t > 0}
+
+    return {"status": "ok", "server_time": server_time, "bins": bins}
+
+
+def _add_stats_from_records(db, stats, t1, t2):
+    # Aggregated records are at most MAX_AGGREGATE_DURATION long, so we
+    # can use the index on t1 for a narrow range query.
+    query = "t1 < ? AND t1 >= ? AND t2 > ?"
+    for record in db.select("records", query, t2, t1 - MAX_AGGREGATE_DURATION, t1):
+        if not is_aggregated(record):
+            continue  # these are added separately
+        tagz = get_tagz(record)
+        if tagz is not None:
+            add_overlap(stats, tagz, record["t1"], record["t2"], t1, t2)
+
+
+def _update_stats(db, old_records, new_records):
+    """Update the aggregates for the given records that have been replaced.
+    Must be called in a transaction.
+    """
+    deltas, exact = get_stats_deltas(old_records, new_records)
+    cur_items = _select_by_keys(db, "stats", deltas.keys())
+    to_put, to_delete = _get_stats_changes(deltas, exact, cur_items)
+    if to_put:
+        db.put("stats", *to_put)
+    _delete_by_keys(db, "stats", to_delete)
+
+
+def _get_stats_changes(deltas, exact, cur_items):
+    """Apply the deltas and exact items of get_stats_deltas() to the
+    current stats items. Returns the items to put and the keys to delete.
+    """
+    to_put, to_delete = [], []
+    for key, (bin, tagz, delta) in deltas.items():
+        item = cur_items.get(key, None) or dict(key=key, bin=bin, tagz=tagz, t=0)
+        item["t"] += delta
+        if item["t"] > 0:
+            to_put.append(item)
+        elif key in cur_items:
+            to_delete.append(key)
+    for key, item in exact.items():
+        if item is None:
+            to_delete.append(key)
+        else:
+            to_put.append(dict(key=key, **item))
+    return to_put, to_delete
+
+
+def _update_record_tags(db, old_records, new_records):
+    """Update the tag index for the given records that have been replaced.
+    Must be called in a transaction.
+    """
+    items, totals = get_tags_deltas(old_records, new_records)
+    cur_totals = _select_by_keys(db, "tag_totals", totals.keys())
+    changes = _get_record_tags_changes(items, totals, cur_totals)
+    to_put, to_delete, tag_totals, totals_to_delete = changes
+
+    if to_put:
+        db.put("record_tags", *to_put)
+    if tag_totals:
+        db.put("tag_totals", *tag_totals)
+    _delete_by_keys(db, "record_tags", to_delete)
+    _delete_by_keys(db, "tag_totals", totals_to_delete)
+
+
+def _get_record_tags_changes(items, totals, cur_totals):
+    """Apply the items and totals of get_tags_deltas() to the current
+    tag totals. Returns the record_tags items to put and the keys to
+    delete, and the same for the tag_totals.
+    """
+    to_put = [dict(key=key, **item) for key, item in items.items() if item]
+    to_delete = [key for key, item in items.items() if not item]
+    for tag, item in cur_totals.items():
+        totals[tag][0] += item["count"]
+        totals[tag][1] += item["t"]
+    tag_totals = [dict(key=tag, count=c, t=t) for tag, (c, t) in totals.items() if c]
+    totals_to_delete = [tag for tag, (c, t) in totals.items() if not c]
+    return to_put, to_delete, tag_totals, totals_to_delete
+
+
+def _update_derived_tables(db, old_records, new_records):
+    """Update the tables that are derived from the records (the stats
+    and the tag index). Must be called in a transaction.
+    """
+    _update_stats(db, old_records, new_records)
+    _update_record_tags(db, old_records, new_records)
+
+
+def rebuild_derived_tables(db):
+    """Rebuild the tables that are derived from the records. Must be
+    called in a transaction.
+    """
+    for what in ("stats", "record_tags", "tag_totals"):
+        _delete_by_keys(db, what, None)
+    records = {record["key"]: record for record in db.select_all("records")}
+    _update_derived_tables(db, {}, records)
+
+
+async def get_records_handler(request, user):
+    """Coroutine to handle a GET records request."""
+    try:
+        t1, t2 = [float(t) for t in request.querydict.get("timerange", "").split("-")]
+    except ValueError:
+        return 400, {}, "/api/v1/records needs ?timerange=t1-t2 argument"
+    if not t1 < t2:
+        return 400, {}, "/api/v1/records needs a timerange with t1 < t2"
+
+    # Only records that have all of the given tags (e.g. "tag1,#tag2")
+    tags = request.querydict.get("tags", "")
+    tags = ["#" + tag.lstrip("#").lower() for tag in tags.split(",") if tag]
+
+    format = request.querydict.get("format", "json")
+    if format not in ("json", "columns"):
+        return 400, {}, "/api/v1/records needs ?format to be 'json' or 'columns'"
+
+    result = await asyncthis(_get_records, user, t1, t2, tags)
+    if format == "columns":
+        result["records"] = _to_columns(result["records"])
+    return result
+
+
+@timed(db_duration, "get_records")
+@traced("query:get_records")
+def _get_records(user, t1, t2, tags):
+
+    db, mtime = get_user_db(user)
+    server_time = time.time()
+
+    # If tags are given, we may be able to use the tag index
+    records = _select_records_by_tags(db, tags) if tags else None
+
+    if records is None:
+        # Select the records that overlap with the time range. Records that
+        # are aggregated in the stats are at most MAX_AGGREGATE_DURATION long,
+        # so we can use the index on t1 for a narrow range query.
+        query = "t1 < ? AND t1 >= ? AND t2 > ?"
+        records = db.select("records", query, t2, t1 - MAX_AGGREGATE_DURATION, t1)
+        records = [r for r in records if is_aggregated(r)]
+        # The other records (running, very long, or with t1 > t2) are
+        # listed as-is in the stats table (except the hidden ones).
+        keys = [
+            item["key"][len("record/") :]
+            for item in db.select("stats", "bin == ?", EXACT_BIN)
+            if overlaps(item, t1, t2, server_time)
+        ]
+        records.extend(_select_by_keys(db, "records", keys).values())
+
+    # Hidden records have no tags; they are deleted for all practical purposes
+    selected = []
+    tags = set(tags)
+    for record in records:
+        record_tags = get_record_tags(record)
+        if record_tags and tags.issubset(record_tags):
+            if overlaps(record, t1, t2, server_time):
+                selected.append(record)
+    records = sorted(selected, key=lambda r: min(r["t1"], r["t2"]))
+
+    return {"status": "ok", "server_time": server_time, "records": records}
+
+
+def _select_records_by_tags(db, tags):
+    """Select the records that have the least common of the given tags,
+    using the tag index. Returns None if that would select too many.
+    """
+    totals = _select_by_keys(db, "tag_totals", tags)
+    if len(totals) < len(set(tags)):
+        return []  # a tag without records
+    tag = min(totals.keys(), key=lambda tag: totals[tag]["count"])
+    if totals[tag]["count"] > MAX_TAG_LOOKUP:
+        return None
+    keys = [item["record"] for item in db.select("record_tags", "tag == ?", tag)]
+    return list(_select_by_keys(db, "records", keys).values())
+
+
+async def get_tags_handler(request, user):
+    """Coroutine to handle a GET tags request."""
+    return await asyncthis(_get_tags, user)
+
+
+@timed(db_duration, "get_tags")
+@traced("query:get_tags")
+def _get_tags(user):
+    db, mtime = get_user_db(user)
+    server_time = time.time()
+    tags = {item["key"]: item for item in db.select_all("tag_totals")}
+    tags = {tag: dict(count=item["count"], t=item["t"]) for tag, item in tags.items()}
+    return {"status": "ok", "server_time": server_time, "tags": tags}
 
 
 async def put_items_handler(request, user, what):
     """Coroutine to handle a PUT records/settings request."""
     # Download items
     items = await request.get_json(10 * 2 ** 20)  # 10 MiB limit
+    if isinstance(items, dict):
+        items = _from_columns(items)
     if not isinstance(items, list):
         raise TypeError(f"List of {what}'s' must be a list")
 
-    # Apply
-    return await asyncthis(_push_items, user, what, items)
+    # Apply. Pushes for the same user that arrive at about the same time
+    # are applied together.
+    result = await write_coalescer.submit(user, (what, items))
+    change_notifier.notify(user)
+    return result
 
 
-def _push_items(user, what, items):
+async def _push_many_async(user, pushes):
+    # Writes for the same user are done one at a time
+    if storage.is_async:
+        return await _apush_many(user, pushes)
+    return await asyncthis(_push_many, user, pushes, lane="write", key=user)
 
-    db, mtime = get_user_db(user)
-    server_time = time.time()
-    db.ensure_table(what, *INDICES[what])
-    db.ensure_table("userinfo", *INDICES["userinfo"])
 
-    req = REQS[what]
-    spec = SPECS[what]
+# Applies pushes for the same user in one transaction (group commit)
+write_coalescer = WriteCoalescer(_push_many_async)
 
-    accepted = []  # keys of accepted items (but might have mt < current)
-    fail = []  # keys of corrupt items
-    errors = []  # error messages, matching up with fail
-    errors2 = []  # error messages for items that did not even have a key
+
+@timed(db_duration, "push_many")
+@traced("query:push_many")
+def _push_many(user, pushes):
+    """Apply a list of (what, items) pushes in a single transaction.
+    Returns a response for each push.
+    """
+
+    db, mtime = get_user_db(user)
+    server_time = time.time()
+    responses = []
+    latest_st = 0
 
     with db:
         ob = db.select_one("userinfo", "key == 'reset_time'")
         reset_time = float((ob or {}).get("value", -1))
 
-        for item in items:
+        for what, items in pushes:
 
-            # First check minimal requirement.
-            if not (isinstance(item, dict) and isinstance(item.get("key", None), str)):
-                errors2.append("Got item that is not a dict with str 'key' field.")
-                continue
+            # The keys of the items that we may need to look up
+            keys = {item["key"] for item in items if _has_key(item)}
 
-            # Get current item (or None). We will ALWAYS update the item's st
-            # (except when cur_item is None and incoming is corrupt).
-            # This helps guarantee consistency between server and client.
-            cur_item = db.select_one(what, "key == ?", item["key"])
+            # Get the current items in bulk, and merge in memory
+            cur_items = _select_by_keys(db, what, keys)
+            old_items = cur_items.copy()  # cur_items is updated in-place
+            to_put, body = _merge_items(what, items, cur_items, reset_time, server_time)
 
-            # Validate and copy the item (only copy fields that we know)
-            try:
-                item = {
-                    key: func(item[key]) for key, func in spec.items() if key in item
-                }
-                if req.difference(item.keys()):
-                    raise ValueError(
-                        f"A {what} is missing required fields: {req.difference(item.keys())}"
-                    )
-                if item["mt"] < reset_time:
-                    raise ValueError("Item was modified after a reset")
-            except Exception as err:
-                # Item is corrupt - mark it as failed
-                fail.append(item["key"])
-                errors.append(str(err))
-                # Re-put the current item if there was one, otherwise ignore
-                if cur_item is not None:
-                    item = cur_item
-                else:
-                    continue
-            else:
-                accepted.append(item["key"])
+            # Store them!
+            db.put(what, *to_put)
+            if what == "records":
+                new_items = {item["key"]: item for item in to_put}
+                _update_derived_tables(db, old_items, new_items)
+            responses.append((200, {}, body))
+            push_size.observe(what, value=len(items))
+            pushed_items.inc(what, "accepted", amount=len(body["accepted"]))
+            pushed_items.inc(what, "failed", amount=len(items) - len(body["accepted"]))
+            latest_st = max([latest_st] + [item["st"] for item in to_put])
+
+    # Let polls know that there's something new
+    notify_write(user)
+    if latest_st:
+        version_registry.bump(user, latest_st)
 
-            # Reput the current item if its mt is larger than the incoming item.
-            if cur_item is not None and cur_item["mt"] > item["mt"]:
-                item = cur_item
+    return responses
 
-            # Ensure that st is never equal, so that we can guarantee
-            # eventual consistency. It also means that the exact value
-            # of mt is less important and we can allow it to be int.
+
+def _has_key(item):
+    return isinstance(item, dict) and isinstance(item.get("key", None), str)
+
+
+def _select_by_keys(db, what, keys, chunk_size=500):
+    """Get a dict with the items for the given keys, using chunked
+    IN-queries (sqlite limits the number of variables in a query).
+    """
+    cur_items = {}
+    for query, chunk in _iter_key_queries(keys, chunk_size):
+        for item in db.select(what, query, *chunk):
+            cur_items[item["key"]] = item
+    return cur_items
+
+
+def _delete_by_keys(db, what, keys, chunk_size=500):
+    """Delete the items with the given keys (or all items if keys is None).
+    Must be called in a transaction.
+    """
+    if keys is None:
+        db.delete(what, "1 = 1")
+        return
+    for query, chunk in _iter_key_queries(keys, chunk_size):
+        db.delete(what, query, *chunk)
+
+
+def _iter_key_queries(keys, chunk_size):
+    """Yield (query, chunk) tuples to select the given keys in chunks."""
+    keys = list(keys)
+    for i in range(0, len(keys), chunk_size):
+        chunk = keys[i : i + chunk_size]
+        yield "key IN (" + ", ".join("?" for _ in chunk) + ")", chunk
+
+
+def _merge_items(what, items, cur_items, reset_time, server_time):
+    """Merge the incoming items with the current items (a dict that is
+    updated in-place). Returns a list of items to store, and the body
+    for the response.
+    """
+
+    req = REQS[what]
+    spec = SPECS[what]
+
+    to_put = {}  # the items to store, by key
+    accepted = []  # keys of accepted items (but might have mt < current)
+    fail = []  # keys of corrupt items
+    errors = []  # error messages, matching up with fail
+    errors2 = []  # error messages for items that did not even have a key
+
+    for item in items:
+
+        # First check minimal requirement.
+        if not _has_key(item):
+            errors2.append("Got item that is not a dict with str 'key' field.")
+            continue
+
+        # Get current item (or None). We will ALWAYS update the item's st
+        # (except when cur_item is None and incoming is corrupt).
+        # This helps guarantee consistency between server and client.
+        cur_item = cur_items.get(item["key"], None)
+
+        # Validate and copy the item (only copy fields that we know)
+        try:
+            item = {key: func(item[key]) for key, func in spec.items() if key in item}
+            if req.difference(item.keys()):
+                raise ValueError(
+                    f"A {what} is missing required fields: {req.difference(item.keys())}"
+                )
+            if item["mt"] < reset_time:
+                raise ValueError("Item was modified after a reset")
+        except Exception as err:
+            # Item is corrupt - mark it as failed
+            fail.append(item["key"])
+            errors.append(str(err))
+            # Re-put the current item if there was one, otherwise ignore
             if cur_item is not None:
-                item["st"] = max(server_time, cur_item["st"] + 0.0001)
+                item = cur_item.copy()
             else:
-                item["st"] = server_time
+                continue
+        else:
+            accepted.append(item["key"])
 
-            # Store it!
-            db.put(what, item)
+        # Reput the current item if its mt is larger than the incoming item.
+        if cur_item is not None and cur_item["mt"] > item["mt"]:
+            item = cur_item.copy()
+
+        # Ensure that st is never equal, so that we can guarantee
+        # eventual consistency. It also means that the exact value
+        # of mt is less important and we can allow it to be int.
+        if cur_item is not None:
+            item["st"] = max(server_time, cur_item["st"] + 0.0001)
+        else:
+            item["st"] = server_time
+
+        # Store it! The same key may occur again in this batch.
+        to_put[item["key"]] = cur_items[item["key"]] = item
 
-    # Done
     body = {
         "status": ("fail" if fail else "ok"),
         "accepted": accepted,
         "fail": fail,
         "errors": errors + errors2,
     }
-    return 200, {}, body
+    return list(to_put.values()), body
+
+
+# %% Async versions of the queries, for async storage backends
+#
+# With an async storage backend (storage.is_async), the handlers for
+# updates, pushes and settings use these instead of the functions above,
+# so that they run on the event loop instead of in a thread. Other
+# requests use the sync functions, see _pgstorage.SyncUserDB.
+
+
+@traced("db_open")
+async def aget_user_db(user):
+    """Get the async user db and its mtime (-1 if the user has no data)."""
+    return await storage.get_async_user_db(user)
+
+
+@timed(db_duration, "force_reset")
+@traced("query:force_reset")
+async def _aforce_reset(user):
+
+    db, mtime = await aget_user_db(user)
+    st = time.time()
+
+    async with db.transaction():
+        await db.put("userinfo", _get_reset_time_item(st))
+    notify_write(user)
+    version_registry.bump(user, st)
+
+    return 200, {}, {"status": "ok"}
+
+
+@timed(db_duration, "get_updates")
+@traced("query:get_updates")
+async def _aget_updates(
+    user, since, limit=0, stream=False, encode=None, if_none_match=""
+):
+    # Like _get_updates()
+
+    db, mtime = await aget_user_db(user)
+    server_time = time.time()
+
+    if mtime > 0:
+        version_registry.bump(user, mtime)
+
+    if mtime + 0.2 < since:
+        updates_total.inc("mtime")
+        return dict(
+            server_time=since,
+            reset=0,  # Not False; is used in the tests to know that we exited early
+            records=[],
+            settings=[],
+        )
+
+    ob = await db.select_one("userinfo", "key == 'reset_time'")
+    reset_time = float((ob or {}).get("value", -1))
+    reset = since <= reset_time
+
+    etag = await _aget_etag(db, SYNCED_TABLES)
+    headers = {"etag": etag, "cache-control": "no-cache"}
+    if etag == if_none_match and not reset:
+        updates_total.inc("not_modified")
+        return 304, headers, b""
+
+    cache_key, tag = _get_updates_cache_entry(user, since, limit, encode, reset, etag)
+    if cache_key:
+        response = updates_cache.get(cache_key, tag)
+        if response is not None:
+            updates_total.inc("cached")
+            return response
+
+    updates_total.inc("queried")
+    if reset:
+        settings = await db.select_all("settings")
+    else:
+        query = f"st >= {float(since)}"
+        settings = await db.select("settings", query)
+
+    records_since = -1 if reset else since
+    if stream:
+        records = StreamedItems(records_since)
+    elif limit > 0:
+        query, args = _get_page_query(records_since, limit)
+        records = await db.select("records", query, *args)
+        records, position = _split_page(records, limit)
+        next = position and _encode_cursor(records_since, *position)
+    elif reset:
+        records = await db.select_all("records")
+    else:
+        records = await db.select("records", query)
+
+    result = dict(
+        status="ok",
+        server_time=server_time,
+        reset=reset,
+        records=records,
+        settings=settings,
+    )
+    if limit > 0:
+        result["next"] = next
+
+    if cache_key and (reset or records or settings):
+        response = (200, headers, result)
+        return await _aencode_and_cache(response, encode, cache_key, tag)
+    return 200, headers, result
+
+
+@timed(db_duration, "get_updates_page")
+@traced("query:get_updates_page")
+async def _aget_updates_page(user, cursor, limit, encode=None):
+
+    db, mtime = await aget_user_db(user)
+    server_time = time.time()
+
+    since, st, key = cursor
+    cache_key = None
+    if encode and since <= 0:
+        cache_key = user, cursor, limit, *encode
+        tag = await _aget_etag(db, SYNCED_TABLES)
+        response = updates_cache.get(cache_key, tag)
+        if response is not None:
+            return response
+
+    query, args = _get_page_query(since, limit, (st, key))
+    records, position = _split_page(await db.select("records", query, *args), limit)
+    next = position and _encode_cursor(since, *position)
+
+    result = dict(
+        status="ok",
+        server_time=server_time,
+        reset=False,
+        records=records,
+        settings=[],
+        next=next,
+    )
+
+    if cache_key:
+        return await _aencode_and_cache(result, encode, cache_key, tag)
+    return result
+
+
+async def _aencode_and_cache(response, encode, cache_key, tag):
+    # Like _encode_and_cache(), but we're on the event loop, so large
+    # responses are compressed in a thread.
+    format, encoding = encode
+    response = _format_updates(response, format)
+    response = await _encode_and_compress(response, encoding)
+    updates_cache.put(cache_key, tag, response)
+    return response
+
+
+async def _aget_etag(db, tables):
+    latest = 0
+    count = 0
+    for what in tables:
+        for item in await db.select(what, "st > ? ORDER BY st DESC LIMIT 1", latest):
+            latest = item["st"]
+        count += await db.count_all(what)
+    return f'"{latest}-{count}"'
+
+
+@timed(db_duration, "get_items")
+@traced("query:get_items")
+async def _aget_items(user, what, stream=False, if_none_match=""):
+
+    db, mtime = await aget_user_db(user)
+    server_time = time.time()
+
+    if mtime <= 0:
+        return 200, {}, {"server_time": server_time, what: []}
+
+    etag = await _aget_etag(db, [what])
+    headers = {"etag": etag, "cache-control": "no-cache"}
+    if etag == if_none_match:
+        return 304, headers, b""
+
+    items = StreamedItems(-1) if stream else await db.select_all(what)
+    return 200, headers, {"status": "ok", "server_time": server_time, what: items}
+
+
+@timed(db_duration, "get_items_chunk")
+@traced("query:get_items_chunk")
+async def _aget_items_chunk(user, what, since, limit, after):
+    db, mtime = await aget_user_db(user)
+    query, args = _get_page_query(since, limit, after)
+    return _split_page(await db.select(what, query, *args), limit)
+
+
+@timed(db_duration, "push_many")
+@traced("query:push_many")
+async def _apush_many(user, pushes):
+    # Like _push_many(). The transaction locks the user (also between
+    # processes), so that writes for the same user are done one at a time.
+
+    db, mtime = await aget_user_db(user)
+    responses = []
+    latest_st = 0
+
+    async with db.transaction():
+        server_time = time.time()
+        ob = await db.select_one("userinfo", "key == 'reset_time'")
+        reset_time = float((ob or {}).get("value", -1))
+
+        for what, items in pushes:
+            keys = {item["key"] for item in items if _has_key(item)}
+            cur_items = await _aselect_by_keys(db, what, keys)
+            old_items = cur_items.copy()  # cur_items is updated in-place
+            to_put, body = _merge_items(what, items, cur_items, reset_time, server_time)
+
+            await db.put(what, *to_put)
+            if what == "records":
+                new_items = {item["key"]: item for item in to_put}
+                await _aupdate_derived_tables(db, old_items, new_items)
+            responses.append((200, {}, body))
+            push_size.observe(what, value=len(items))
+            pushed_items.inc(what, "accepted", amount=len(body["accepted"]))
+            pushed_items.inc(what, "failed", amount=len(items) - len(body["accepted"]))
+            latest_st = max([latest_st] + [item["st"] for item in to_put])
+
+    notify_write(user)
+    if latest_st:
+        version_registry.bump(user, latest_st)
+
+    return responses
+
+
+async def _aupdate_derived_tables(db, old_records, new_records):
+    await _aupdate_stats(db, old_records, new_records)
+    await _aupdate_record_tags(db, old_records, new_records)
+
+
+async def _aupdate_stats(db, old_records, new_records):
+    deltas, exact = get_stats_deltas(old_records, new_records)
+    cur_items = await _aselect_by_keys(db, "stats", deltas.keys())
+    to_put, to_delete = _get_stats_changes(deltas, exact, cur_items)
+    if to_put:
+        await db.put("stats", *to_put)
+    await _adelete_by_keys(db, "stats", to_delete)
+
+
+async def _aupdate_record_tags(db, old_records, new_records):
+    items, totals = get_tags_deltas(old_records, new_records)
+    cur_totals = await _aselect_by_keys(db, "tag_totals", totals.keys())
+    changes = _get_record_tags_changes(items, totals, cur_totals)
+    to_put, to_delete, tag_totals, totals_to_delete = changes
+
+    if to_put:
+        await db.put("record_tags", *to_put)
+    if tag_totals:
+        await db.put("tag_totals", *tag_totals)
+    await _adelete_by_keys(db, "record_tags", to_delete)
+    await _adelete_by_keys(db, "tag_totals", totals_to_delete)
+
+
+async def _aselect_by_keys(db, what, keys, chunk_size=500):
+    cur_items = {}
+    for query, chunk in _iter_key_queries(keys, chunk_size):
+        for item in await db.select(what, query, *chunk):
+            cur_items[item["key"]] = item
+    return cur_items
+
+
+async def _adelete_by_keys(db, what, keys, chunk_size=500):
+    for query, chunk in _iter_key_queries(keys, chunk_size):
+        await db.delete(what, query, *chunk)
@@ -0,0 +1,164 @@
+"""
+Online backups of the user databases, using sqlite's backup API, so
+that each snapshot is consistent, and writers are not blocked.
+"""
+
+import os
+import time
+import sqlite3
+import concurrent.futures
+
+from itemdb import ItemDB
+
+from ._utils import user2filename, get_user_filenames
+from ._apiserver import get_user_db, set_reset_time, version_registry, db_pool
+from ._apiserver import notify_write
+
+
+# The name of the database in the backup dir that records the backups
+MANIFEST_NAME = "_backups.db"
+
+
+def _get_mtime(filename):
+    # The mtime of a database, including the WAL, or -1 if it does not exist
+    mtime = -1
+    for fname in (filename, filename + "-wal"):
+        try:
+            mtime = max(mtime, os.stat(fname).st_mtime)
+        except FileNotFoundError:
+            pass
+    return mtime
+
+
+def snapshot(src_filename, dst_filename, pages=256, sleep=0.005):
+    """Make a consistent copy of a sqlite database, while it may be in
+    use. The copy is made in steps of the given number of pages, with a
+    sleep in between, to limit the I/O load. The copy is written to a
+    temporary file, which then replaces dst_filename.
+    """
+    tmp_filename = dst_filename + ".tmp"
+    src = sqlite3.connect(src_filename, isolation_level=None)
+    try:
+        # In WAL mode, a read transaction pins a snapshot of the db without
+        # blocking writers, so the backup does not restart when there are
+        # writes in between the steps. In rollback mode it would block
+        # writers, so then we let sqlite restart the backup if needed.
+        wal = src.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        if wal:
+            src.execute("BEGIN")
+            src.execute("SELECT count(*) FROM sqlite_master").fetchone()
+        dst = sqlite3.connect(tmp_filename)
+        try:
+            src.backup(dst, pages=pages, progress=lambda *args: time.sleep(sleep))
+        finally:
+            dst.close()
+        if wal:
+            src.execute("COMMIT")
+    except Exception:
+        if os.path.isfile(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    finally:
+        src.close()
+    os.replace(tmp_filename, dst_filename)
+
+
+def backup_user(user, backup_dir, last_mtime=-1, pages=256, sleep=0.005):
+    """Backup the database of the given user to backup_dir, unless it has
+    not been modified since last_mtime. Returns a dict with the result,
+    or None if the backup was skipped.
+    """
+    filename = user2filename(user)
+    mtime = _get_mtime(filename)
+    if mtime < 0 or mtime <= last_mtime:
+        return None
+    t0 = time.perf_counter()
+    # The backup dir uses the sharded layout too
+    dst_filename = get_user_filenames(user, backup_dir)[0]
+    os.makedirs(os.path.dirname(dst_filename), exist_ok=True)
+    snapshot(filename, dst_filename, pages, sleep)
+    return dict(
+        key=user,
+        time=time.time(),
+        mtime=mtime,
+        size=os.path.getsize(dst_filename),
+        duration=time.perf_counter() - t0,
+    )
+
+
+def backup(users, backup_dir, jobs=4, force=False, pages=256, sleep=0.005):
+    """Backup the databases of the given users to backup_dir, using a
+    pool of the given number of threads. Databases that have not been
+    modified since their last backup are skipped, unless force is True.
+    The time of the last backup of each user is recorded in the backup
+    dir (see get_last_backup()). Yields a dict for each user that was
+    backed up, in order of completion.
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    manifest = ItemDB(os.path.join(backup_dir, MANIFEST_NAME))
+    manifest.ensure_table("backups", "!key")
+    last_mtimes = {}
+    if not force:
+        last_mtimes = {ob["key"]: ob["mtime"] for ob in manifest.select_all("backups")}
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = [
+            executor.submit(
+                backup_user,
+                user,
+                backup_dir,
+                last_mtimes.get(user, -1),
+                pages,
+                sleep,
+            )
+            for user in users
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            if result is not None:
+                with manifest:
+                    manifest.put("backups", result)
+                yield result
+
+
+def get_last_backup(backup_dir, user):
+    """Get a dict with the time, mtime and size of the last backup of
+    the given user, or None.
+    """
+    filename = os.path.join(backup_dir, MANIFEST_NAME)
+    if not os.path.isfile(filename):
+        return None
+    manifest = ItemDB(filename)
+    manifest.ensure_table("backups", "!key")
+    return manifest.select_one("backups", "key == ?", user)
+
+
+def restore(user, backup_dir):
+    """Restore the database of the given user from backup_dir. This can
+    be done while the server is running. The reset_time is set, so that
+    clients do a full reset.
+    """
+    filename = user2filename(user)
+    # Backups made before the sharded layout are in the flat layout
+    for src_filename in get_user_filenames(user, backup_dir):
+        if os.path.isfile(src_filename):
+            break
+    else:
+        raise FileNotFoundError(f"No backup for {user!r} in {backup_dir}")
+
+    # Copy into the live database, so that open connections see it too
+    db, mtime = get_user_db(user)
+    src = sqlite3.connect(src_filename)
+    try:
+        src.backup(db._conn)
+    finally:
+        src.close()
+
+    # Re-initialize (the backup may have an older schema), and reset clients
+    db_pool.invalidate(filename)
+    db, mtime = get_user_db(user)
+    st = time.time()
+    with db:
+        set_reset_time(db, st)
+    notify_write(user)
+    version_registry.bump(user, st)
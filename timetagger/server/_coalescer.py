@@ -0,0 +1,94 @@
+"""
+Coalescing of writes, so that writes for the same user that arrive at
+about the same time are applied in a single transaction.
+"""
+
+import asyncio
+
+from ._scheduler import QueueFullError
+
+
+class WriteCoalescer:
+    """Combines requests for the same key into one call to ``func``,
+    e.g. to commit them in a single transaction (group commit). This
+    reduces the number of fsyncs.
+
+    A request is flushed right away (with the requests that are submitted
+    in the same iteration of the event loop) if no call for its key is in
+    flight. Otherwise it waits for that call, and the requests that come
+    in meanwhile are combined, up to ``max_batch``.
+
+    The ``func`` must be a coroutine function that accepts a key and a
+    list of requests, and returns a list with a result for each request.
+    If it raises an error for a batch of multiple requests, each request
+    is retried on its own, so that a bad request cannot fail the others.
+    A QueueFullError (the server is busy) is not retried.
+    """
+
+    def __init__(self, func, max_batch=50):
+        self._func = func
+        self.max_batch = int(max_batch)
+        self._pending = {}  # key -> list of (request, future)
+        self._flushes = {}  # key -> the task of the latest flush
+
+    async def submit(self, key, request):
+        """Submit a request, and await its result."""
+        loop = asyncio.get_event_loop()
+        batch = self._pending.get(key, None)
+        if batch is None:
+            batch = self._pending[key] = []
+            previous = self._flushes.get(key, None)
+            task = loop.create_task(self._flush(key, batch, previous))
+            self._flushes[key] = task
+            task.add_done_callback(lambda task: self._forget(key, task))
+        future = loop.create_future()
+        batch.append((request, future))
+        if len(batch) >= self.max_batch:
+            self._pending.pop(key, None)  # later requests go in a new batch
+        return await future
+
+    def _forget(self, key, task):
+        if self._flushes.get(key, None) is task:
+            self._flushes.pop(key)
+
+    async def _flush(self, key, batch, previous):
+        if previous is not None:
+            await asyncio.wait([previous])
+        if self._pending.get(key, None) is batch:
+            self._pending.pop(key)
+
+        requests = [request for request, future in batch]
+        try:
+            results = await self._func(key, requests)
+        except QueueFullError as err:
+            # Retrying would only add to the load
+            for request, future in batch:
+                _resolve(future, None, err)
+            return
+        except Exception as err:
+            if len(batch) == 1:
+                _resolve(batch[0][1], None, err)
+                return
+            results = None
+
+        if results is None:
+            # Apply the requests one by one, to isolate the error
+            for request, future in batch:
+                try:
+                    result = (await self._func(key, [request]))[0]
+                except Exception as err:
+                    _resolve(future, None, err)
+                else:
+                    _resolve(future, result)
+        else:
+            for (request, future), result in zip(batch, results):
+                _resolve(future, result)
+
+
+def _resolve(future, result, err=None):
+    if future.done():
+        return  # e.g. cancelled
+    elif err is not None:
+        future.set_exception(err)
+    else:
+        future.set_result(result)
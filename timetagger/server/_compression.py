@@ -0,0 +1,108 @@
+"""
+Compression of API responses, and a cache for encoded responses that
+are expensive to produce.
+"""
+
+import gzip
+import json
+import threading
+from collections import OrderedDict
+
+from asgineer.utils import normalize_response
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+
+def choose_encoding(accept_encoding):
+    """Select the content-encoding to use, given the value of the
+    accept-encoding header. Returns "br", "gzip" or "".
+    """
+    accepted = {part.split(";")[0].strip() for part in accept_encoding.split(",")}
+    if brotli is not None and "br" in accepted:
+        return "br"
+    elif "gzip" in accepted:
+        return "gzip"
+    return ""
+
+
+def compress(data, encoding):
+    """Compress the given bytes with the given encoding."""
+    if encoding == "br":
+        return brotli.compress(data, quality=5)
+    elif encoding == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    return data
+
+
+def encode_response(response, encoding, min_size):
+    """Turn a response with a dict body into a response with a bytes
+    body, compressed with the given encoding if it is at least
+    ``min_size`` bytes. Other responses are returned as-is.
+    """
+    status, headers, body = normalize_response(response)
+    if not isinstance(body, dict):
+        return response
+    body = json.dumps(body).encode()
+    headers.setdefault("content-type", "application/json")
+    return compress_response((status, headers, body), encoding, min_size)
+
+
+def compress_response(response, encoding, min_size):
+    """Compress the bytes body of a (status, headers, body) response
+    with the given encoding, if it is at least ``min_size`` bytes.
+    """
+    status, headers, body = response
+    if encoding and len(body) >= min_size:
+        body = compress(body, encoding)
+        headers["content-encoding"] = encoding
+        headers["vary"] = "accept-encoding"
+    return status, headers, body
+
+
+class ResponseCache:
+    """A thread-safe LRU cache for encoded responses. Each entry has a
+    tag, e.g. a version of the data it was produced from. An entry is
+    only used if its tag matches. The total size of the bodies is
+    limited to ``max_size`` bytes.
+    """
+
+    def __init__(self, max_size=64 * 2 ** 20):
+        self.max_size = int(max_size)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (tag, response)
+        self._size = 0
+
+    def get(self, key, tag):
+        """Get the response for the given key, or None if there is no
+        entry, or its tag does not match.
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None or entry[0] != tag:
+                return None
+            self._entries.move_to_end(key)
+        status, headers, body = entry[1]
+        return status, headers.copy(), body
+
+    def put(self, key, tag, response):
+        """Store a (status, headers, body) response with the given tag."""
+        size = len(response[2])
+        if size > self.max_size // 4:
+            return  # too big, would push out everything else
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old[1][2])
+            self._entries[key] = tag, response
+            self._size += size
+            while self._size > self.max_size:
+                _, (_, old_response) = self._entries.popitem(last=False)
+                self._size -= len(old_response[2])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
@@ -0,0 +1,311 @@
+"""
+A pool of open user databases, so that we don't have to open a new
+sqlite connection for every request.
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from itemdb import ItemDB
+
+
+# Profiles of pragmas that are applied when a database is opened
+SQLITE_PROFILES = {
+    # Sqlite's defaults: a rollback journal, and a full sync on each commit
+    "compat": dict(journal_mode="DELETE", synchronous="FULL"),
+    # WAL, so that readers and writers don't block each other, and only
+    # sync at checkpoints. A power loss may lose the last commits, but
+    # cannot corrupt the database.
+    "production": dict(
+        journal_mode="WAL",
+        synchronous="NORMAL",
+        mmap_size=2 ** 24,
+        cache_size=-1000,
+        temp_store="MEMORY",
+    ),
+    # WAL, with a sync on each commit
+    "durable": dict(
+        journal_mode="WAL",
+        synchronous="FULL",
+        cache_size=-1000,
+        temp_store="MEMORY",
+    ),
+}
+
+
+def check_pragmas(pragmas):
+    """Check that the given dict of pragmas is valid. Returns a copy."""
+    for key, value in pragmas.items():
+        if not (isinstance(key, str) and key.isidentifier()):
+            raise ValueError(f"Invalid pragma name: {key!r}")
+        if not (isinstance(value, int) or (isinstance(value, str) and value.isalpha())):
+            raise ValueError(f"Invalid value for pragma {key}: {value!r}")
+    return dict(pragmas)
+
+
+class PooledItemDB(ItemDB):
+    """The ItemDB that the pool opens. Its delete() does not close the
+    cursor of the transaction (as ItemDB.delete() does), so that other
+    operations can follow it in the same transaction.
+    """
+
+    def delete(self, table_name, query, *save_args):
+        self.get_indices(table_name)  # Fail with KeyError for invalid table name
+        if self._cur is None:
+            raise IOError("Can only use delete() within a transaction.")
+        self._cur.execute(f"DELETE FROM {table_name} WHERE {query}", save_args)
+
+
+class ThreadCache:
+    """The open dbs of a single thread, for DBPool."""
+
+    def __init__(self, epoch):
+        self.entries = OrderedDict()  # dbname -> (db, generation, last_used)
+        self.epoch = epoch
+        self.busy = False  # whether the thread may be using its dbs
+        self.registered = False
+        self.lock = threading.Lock()
+
+
+class DBPool:
+    """A bounded pool of open ItemDB instances, with LRU eviction.
+
+    The pool is thread-affine: each thread (e.g. each thread of the
+    scheduler used by ``asyncthis()``) has its own set of open databases.
+    This way a connection (and its transaction state) is never shared
+    between threads. Databases that have not been used for
+    ``idle_timeout`` seconds are closed.
+
+    A thread that is done with its databases (e.g. at the end of a task)
+    should call ``release()``. Then other threads can close its databases
+    that have expired, or that exceed the process-wide ``max_open``
+    limit (each connection uses about three file descriptors), also when
+    that thread does not call ``get()`` again for a long time. The
+    scheduler does this for the work done via ``asyncthis()``.
+
+    If a database file has been removed, the pool notices on the next
+    call to ``get()`` and all threads will re-open the database.
+
+    The optional ``initializer`` is called with a freshly opened db,
+    once per database file (not once per connection), e.g. to create
+    the tables. The optional ``pragmas`` (a dict) are applied to each
+    new connection, see ``SQLITE_PROFILES``.
+
+    The optional ``stat_cache`` (a ``_utils.StatCache``) is used to get
+    the mtime of the database files. Writers must then call
+    ``notify_write()`` after each commit.
+    """
+
+    # The interval at which release() closes the expired dbs of idle threads
+    sweep_interval = 10
+
+    def __init__(
+        self,
+        max_per_thread=64,
+        idle_timeout=300,
+        initializer=None,
+        pragmas=None,
+        stat_cache=None,
+        max_open=256,
+    ):
+        self.max_per_thread = int(max_per_thread)
+        self.max_open = int(max_open)
+        self.idle_timeout = float(idle_timeout)
+        self.pragmas = check_pragmas(pragmas or {})
+        self._initializer = initializer
+        self._stat_cache = stat_cache
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._caches = set()  # the ThreadCache objects that have open dbs
+        self._last_sweep = time.monotonic()
+        self._generations = {}  # dbname -> int, bumped on invalidation
+        self._initialized = {}  # dbname -> generation at initialization
+        self._generation_count = 0
+        self._epoch = 0  # bumped on clear()
+        self._counts = dict(hits=0, misses=0, evictions=0, expired=0, open=0)
+
+    def _count(self, name, delta=1):
+        with self._lock:
+            self._counts[name] += delta
+
+    def _get_thread_cache(self):
+        """Get the ThreadCache of the current thread."""
+        cache = getattr(self._local, "cache", None)
+        if cache is None:
+            cache = self._local.cache = ThreadCache(self._epoch)
+        return cache
+
+    def _close(self, entry):
+        entry[0].close()
+        self._count("open", -1)
+
+    def _close_stale(self, cache, now):
+        """Close the dbs of the given cache that are from before a clear(),
+        or that have been idle too long. Must hold the lock of the cache.
+        """
+        entries = cache.entries
+        if cache.epoch != self._epoch:
+            while entries:
+                self._close(entries.popitem(last=False)[1])
+            cache.epoch = self._epoch
+        for name, entry in list(entries.items()):
+            if now - entry[2] <= self.idle_timeout:
+                break  # all entries after this are more recent
+            self._close(entries.pop(name))
+            self._count("expired")
+
+    def _evict(self, cache, max_open):
+        """Close the least recently used dbs of the given cache, while it
+        has more than max_per_thread, or the process has more than the
+        given max_open. Must hold the lock of the cache.
+        """
+        entries = cache.entries
+        while len(entries) > self.max_per_thread or (
+            entries and self._counts["open"] > max_open
+        ):
+            self._close(entries.popitem(last=False)[1])
+            self._count("evictions")
+
+    def get(self, dbname):
+        """Get an open ItemDB for the given filename, and its mtime
+        (which is -1 if the db did not yet exist).
+        """
+        # Stat the file. We need the mtime anyway, and it tells us if
+        # the file has been removed.
+        stat = self._stat
+        result = stat(dbname)
+        if result is None:
+            mtime = -1
+            self.invalidate(dbname)
+            os.makedirs(os.path.dirname(dbname) or ".", exist_ok=True)
+        else:
+            mtime = result.st_mtime
+            # In WAL mode, writes go to the -wal file until a checkpoint
+            result = stat(dbname + "-wal")
+            if result is not None:
+                mtime = max(mtime, result.st_mtime)
+
+        cache = self._get_thread_cache()
+        now = time.monotonic()
+        generation = self._generations.get(dbname, 0)
+
+        with cache.lock:
+            # From now on, other threads leave our dbs alone
+            cache.busy = True
+            if not cache.registered:
+                with self._lock:
+                    self._caches.add(cache)
+                cache.registered = True
+            self._close_stale(cache, now)
+            db = self._get(cache, dbname, mtime, generation)
+            cache.entries[dbname] = db, generation, now
+            # Close our least recently used dbs, if we have too many. The
+            # process-wide limit is not applied here, because the thread
+            # may still be using its other dbs.
+            self._evict(cache, float("inf"))
+
+        # If the process has too many open, close those of idle threads
+        if self._counts["open"] > self.max_open:
+            self._sweep(now)
+
+        return db, mtime
+
+    def _get(self, cache, dbname, mtime, generation):
+        # Get a db from the cache, or open a new one
+        entry = cache.entries.pop(dbname, None)
+        if entry is not None and entry[1] == generation:
+            self._count("hits")
+            return entry[0]
+        if entry is not None:
+            self._close(entry)
+        db = PooledItemDB(dbname)  # creates the file if it does not yet exist
+        if mtime < 0:
+            self.notify_write(dbname)
+        try:
+            for key, value in self.pragmas.items():
+                db._conn.execute(f"PRAGMA {key} = {value}")
+        except Exception:
+            db.close()
+            raise
+        if self._initializer and self._initialized.get(dbname) != generation:
+            try:
+                self._initializer(db)
+            except Exception:
+                db.close()
+                raise
+            self._initialized[dbname] = generation
+        self._count("misses")
+        self._count("open")
+        return db
+
+    def release(self):
+        """Call when the current thread is done using the dbs that it got
+        from get(), so that other threads may close them when needed.
+        """
+        cache = getattr(self._local, "cache", None)
+        if cache is not None:
+            with cache.lock:
+                cache.busy = False
+        now = time.monotonic()
+        if now - self._last_sweep > self.sweep_interval:
+            self._sweep(now)
+
+    def _sweep(self, now):
+        """Close the stale dbs of idle threads, and their least recently
+        used dbs while the process has too many open.
+        """
+        with self._lock:
+            self._last_sweep = now
+            caches = list(self._caches)
+        for cache in caches:
+            # Skip threads that are using their dbs (or are about to)
+            if not cache.lock.acquire(blocking=False):
+                continue
+            try:
+                if cache.busy:
+                    continue
+                self._close_stale(cache, now)
+                self._evict(cache, self.max_open)
+                if not cache.entries:
+                    with self._lock:
+                        self._caches.discard(cache)
+                    cache.registered = False
+            finally:
+                cache.lock.release()
+
+    def _stat(self, filename):
+        if self._stat_cache is not None:
+            return self._stat_cache.stat(filename)
+        try:
+            return os.stat(filename)
+        except FileNotFoundError:
+            return None
+
+    def notify_write(self, dbname):
+        """Notify that the given database has been written to (or created
+        or removed), so that the next get() sees the new mtime.
+        """
+        if self._stat_cache is not None:
+            self._stat_cache.invalidate(dbname, dbname + "-wal")
+
+    def invalidate(self, dbname):
+        """Make all threads re-open the given database on next use."""
+        with self._lock:
+            self._generation_count += 1
+            self._generations[dbname] = self._generation_count
+
+    def clear(self):
+        """Close all databases. Busy threads close theirs on next use."""
+        with self._lock:
+            self._epoch += 1
+        cache = self._get_thread_cache()
+        with cache.lock:
+            cache.busy = False
+        self._sweep(time.monotonic())
+
+    def get_stats(self):
+        """Get a dict with counters: hits, misses, evictions, expired, open."""
+        with self._lock:
+            return self._counts.copy()
@@ -0,0 +1,144 @@
+"""
+Maintenance of the user databases. These functions can be used from
+the command line, see __main__.py.
+"""
+
+import os
+import time
+import sqlite3
+import multiprocessing
+import concurrent.futures
+
+from ._utils import get_user_filenames, stat_cache
+from ._versions import SharedVersionTable
+from ._apiserver import get_user_db, rebuild_derived_tables, set_reset_time
+from ._apiserver import version_registry, notify_write, get_storage, _delete_by_keys
+from ._backup import snapshot
+
+
+def get_all_users():
+    """Get a sorted list of the users that have a database."""
+    return get_storage().get_users()
+
+
+def get_db_size(user):
+    """Get the size of the user's database in bytes (including the WAL)."""
+    return get_storage().get_size(user)
+
+
+def rebuild(user):
+    """Rebuild the tables that are derived from the records (the stats
+    and the tag index) of the given user. Returns the number of records.
+    """
+    db, mtime = get_user_db(user)
+    with db:
+        rebuild_derived_tables(db)
+        count = db.count_all("records")
+    notify_write(user)
+    return count
+
+
+def compact(user, retention_days=90, vacuum=True):
+    """Purge the hidden (i.e. deleted) records of the given user that
+    have not been modified in the given number of days. If records were
+    purged, the reset_time is set (like a force-reset), so that clients
+    drop them too. Then runs VACUUM and ANALYZE (if vacuum is True).
+    Returns a dict with the number of purged records, and the size of
+    the database before and after.
+    """
+    size_before = get_db_size(user)
+    db, mtime = get_user_db(user)
+    cutoff = time.time() - retention_days * 86400
+
+    # Hidden records are not in the derived tables, so these need no update
+    with db:
+        keys = [
+            record["key"]
+            for record in db.select("records", "st < ?", cutoff)
+            if record.get("ds", "").startswith("HIDDEN")
+        ]
+        if keys:
+            st = time.time()
+            _delete_by_keys(db, "records", keys)
+            set_reset_time(db, st)
+    if keys:
+        notify_write(user)
+        version_registry.bump(user, st)
+
+    if vacuum:
+        get_storage().vacuum(user)
+
+    return dict(
+        user=user,
+        purged=len(keys),
+        size_before=size_before,
+        size_after=get_db_size(user),
+    )
+
+
+def migrate(user):
+    """Move the database of the given user from the flat layout to the
+    sharded layout (see _utils.get_user_filenames()). This is safe to do
+    while the server is running: the db is locked for writing while it
+    is copied, and emptied before it is removed, so that a write that
+    was waiting for the lock fails instead of getting lost. Returns
+    True if the database was moved.
+    """
+    sharded, flat = get_user_filenames(user)
+    if not os.path.isfile(flat):
+        return False
+
+    if not os.path.isfile(sharded):
+        os.makedirs(os.path.dirname(sharded), exist_ok=True)
+        conn = sqlite3.connect(flat, isolation_level=None, timeout=60)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # The copy sees the last commit, which is final while we hold the lock
+            snapshot(flat, sharded, pages=-1, sleep=0)
+            # From here on, user2filename() resolves to the sharded db
+            tables = conn.execute(
+                "SELECT name FROM sqlite_master "
+                "WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+            ).fetchall()
+            for (table,) in tables:
+                conn.execute(f"DROP TABLE [{table}]")
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    # If the sharded db already exists, the flat one is stale
+    for fname in (flat, flat + "-wal", flat + "-shm"):
+        try:
+            os.remove(fname)
+        except FileNotFoundError:
+            pass
+    stat_cache.invalidate(sharded, sharded + "-wal", flat, flat + "-wal")
+    return True
+
+
+def _init_worker(version_table):
+    if version_table:
+        version_registry.table = SharedVersionTable(version_table)
+
+
+def compact_many(users, retention_days=90, vacuum=True, jobs=1, version_table=None):
+    """Compact the databases of the given users, using a pool of the
+    given number of processes. Yields the result of each compact() call,
+    in order of completion. If the server uses a SharedVersionTable,
+    its filename must be given, so that polling clients see the reset.
+    """
+    _init_worker(version_table)
+    if jobs <= 1:
+        for user in users:
+            yield compact(user, retention_days, vacuum)
+        return
+    # Spawn rather than fork, so that workers don't inherit open databases
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(
+        jobs, context, initializer=_init_worker, initargs=(version_table,)
+    ) as executor:
+        futures = [
+            executor.submit(compact, user, retention_days, vacuum) for user in users
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
@@ -0,0 +1,213 @@
+"""
+A minimal metrics registry that can be scraped by Prometheus.
+"""
+
+import time
+import inspect
+import threading
+
+
+# Default buckets for durations (in seconds) and sizes (in bytes)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+
+def _format_labels(names, values, extra=""):
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base class for metrics. A metric can have labels, each
+    combination of label values is a separate series.
+    """
+
+    type = ""
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._series = {}  # label values -> value
+
+    def _check_labels(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError(f"{self.name} needs labels {self.labels}")
+        return tuple(str(x) for x in labels)
+
+    def set(self, *labels, value):
+        """Set the value, e.g. from a collector."""
+        labels = self._check_labels(labels)
+        with self._lock:
+            self._series[labels] = value
+
+    def get(self, *labels):
+        with self._lock:
+            return self._series.get(self._check_labels(labels), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            series = sorted(self._series.items())
+        for labels, value in series:
+            lines.extend(self._render_series(labels, value))
+        return lines
+
+    def _render_series(self, labels, value):
+        labels = _format_labels(self.labels, labels)
+        return [f"{self.name}{labels} {_format_value(value)}"]
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        labels = self._check_labels(labels)
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that can go up and down."""
+
+    type = "gauge"
+
+
+class Histogram(Metric):
+    """Counts observations (e.g. durations or sizes) in buckets."""
+
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def set(self, *labels, value):
+        raise TypeError("Cannot set a histogram")
+
+    def observe(self, *labels, value):
+        labels = self._check_labels(labels)
+        with self._lock:
+            series = self._series.get(labels, None)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def get(self, *labels):
+        """Get the (sum, count) for the given labels."""
+        with self._lock:
+            series = self._series.get(self._check_labels(labels), None)
+            return (series[1], series[2]) if series else (0, 0)
+
+    def _render_series(self, labels, series):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, series[0]):
+            cumulative += count
+            le = 'le="' + _format_value(bound) + '"'
+            bucket_labels = _format_labels(self.labels, labels, le)
+            lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+        labels = _format_labels(self.labels, labels)
+        lines.append(f"{self.name}_sum{labels} {_format_value(series[1])}")
+        lines.append(f"{self.name}_count{labels} {series[2]}")
+        return lines
+
+
+class Registry:
+    """A collection of metrics that can be rendered in the Prometheus
+    text format. Collectors are functions that are called on each
+    render, to update metrics whose values are obtained elsewhere.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def _add(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already exists")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def add_collector(self, func):
+        self._collectors.append(func)
+
+    def render(self):
+        """Get the metrics in the Prometheus text format."""
+        for func in self._collectors:
+            func()
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def timed(histogram, *labels):
+    """Decorator to observe the duration of each call to a function
+    (or coroutine function).
+    """
+
+    def decorator(func):
+        def timed_wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(*labels, value=time.perf_counter() - t0)
+
+        async def async_timed_wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(*labels, value=time.perf_counter() - t0)
+
+        wrapper = timed_wrapper
+        if inspect.iscoroutinefunction(func):
+            wrapper = async_timed_wrapper
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+    return decorator
+
+
+# The registry for the metrics of the server
+registry = Registry()
+
+
+async def metrics_handler(request):
+    """Coroutine to handle a GET metrics request."""
+    if request.method != "GET":
+        return 405, {}, "/metrics can only be used with GET"
+    headers = {"content-type": "text/plain; version=0.0.4; charset=utf-8"}
+    return 200, headers, registry.render()
@@ -0,0 +1,378 @@
+"""
+A storage backend for PostgreSQL (or a compatible database), using the
+asyncpg driver and its connection pool. The asyncpg package is an
+optional dependency (``pip install timetagger[postgres]``).
+
+Like with SharedStorage, the data of all users is in the same tables,
+which have a "_user" column that is the first part of each index. The
+schema is created when the pool is opened; there is no per-user
+initialization.
+
+This backend is async: the API server handles updates, pushes and the
+settings with the async versions of its queries, on the event loop,
+using AsyncUserDB. The less frequent queries (stats, tags, records in
+a time range) and the maintenance functions use the same code as for
+the other backends, in a thread, via SyncUserDB, which runs the
+queries on the event loop and waits for the result.
+"""
+
+import re
+import time
+import json
+import asyncio
+import itertools
+import contextlib
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None  # optional dependency
+
+from ._storage import Storage, _split_query
+
+json_encode = json.JSONEncoder(ensure_ascii=True).encode
+json_decode = json.JSONDecoder().decode
+
+# The types of the index columns; the others are DOUBLE PRECISION
+COLUMN_TYPES = {"key": "TEXT", "tag": "TEXT"}
+
+UPSERT_USER = (
+    "INSERT INTO _users (_user, mtime) VALUES ($1, $2) "
+    "ON CONFLICT (_user) DO UPDATE SET mtime = excluded.mtime"
+)
+
+
+def _translate(query, first):
+    """Translate a query in the (sqlite) dialect of ItemDB to PostgreSQL:
+    numbered placeholders (starting at the given number), and "=" instead
+    of "==".
+    """
+    counter = itertools.count(first)
+    query = re.sub(r"\?", lambda m: f"${next(counter)}", query)
+    return query.replace("==", "=")
+
+
+class PostgresStorage(Storage):
+    """Store the data of all users in a PostgreSQL database. The tables
+    are created from the given indices (a dict like INDICES in
+    _apiserver.py); each table must have exactly one unique index.
+
+    The pool is created on the event loop of the server, on first use,
+    with ``asyncpg.create_pool(dsn, **pool_kwargs)``, or by calling the
+    given ``create_pool`` function (e.g. to use another driver with the
+    same API).
+    """
+
+    name = "postgres"
+    is_async = True
+
+    def __init__(self, dsn=None, indices=None, create_pool=None, **pool_kwargs):
+        if create_pool is None and asyncpg is None:
+            raise ImportError("The postgres storage backend needs asyncpg")
+        self.dsn = dsn
+        self.pool = None
+        self._create_pool = create_pool
+        self._pool_kwargs = pool_kwargs
+        self._loop = None
+        self._pool_task = None
+        self.columns = {}  # table -> list of index columns, the unique one first
+        for table, table_indices in (indices or {}).items():
+            unique_keys = [x[1:] for x in table_indices if x.startswith("!")]
+            if len(unique_keys) != 1:
+                raise ValueError(f"Table {table} must have one unique index.")
+            keys = [x for x in table_indices if not x.startswith("!")]
+            self.columns[table] = unique_keys + keys
+
+    async def open(self):
+        """Get the pool, creating it (and the tables) if needed. The pool
+        belongs to the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._pool_task = loop.create_task(self._open_pool())
+        return await self._pool_task
+
+    async def _open_pool(self):
+        if self._create_pool is not None:
+            pool = self._create_pool()
+        else:
+            pool = asyncpg.create_pool(self.dsn, **self._pool_kwargs)
+        pool = await pool
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await self._init_schema(conn)
+        self.pool = pool
+        return pool
+
+    async def _init_schema(self, conn):
+        await conn.execute(
+            "CREATE TABLE IF NOT EXISTS _users "
+            "(_user TEXT NOT NULL PRIMARY KEY, mtime DOUBLE PRECISION NOT NULL)"
+        )
+        for table, columns in self.columns.items():
+            unique_key, *keys = columns
+            text = f"CREATE TABLE IF NOT EXISTS {table} "
+            text += f"(_user TEXT NOT NULL, _ob TEXT NOT NULL, {unique_key} "
+            text += COLUMN_TYPES.get(unique_key, "DOUBLE PRECISION") + " NOT NULL"
+            for key in keys:
+                text += f", {key} " + COLUMN_TYPES.get(key, "DOUBLE PRECISION")
+            text += f", PRIMARY KEY (_user, {unique_key}))"
+            await conn.execute(text)
+            for key in keys:
+                await conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS idx_{table}_{key} "
+                    f"ON {table} (_user, {key})"
+                )
+
+    async def get_async_user_db(self, user):
+        """Get the AsyncUserDB for the given user, and its mtime (which
+        is -1 if the user has no data yet).
+        """
+        pool = await self.open()
+        async with pool.acquire() as conn:
+            mtime = await conn.fetchval(
+                "SELECT mtime FROM _users WHERE _user = $1", user
+            )
+        return AsyncUserDB(self, user), (-1 if mtime is None else mtime)
+
+    def _run(self, coro):
+        """Run the given coroutine on the event loop of the pool, from
+        another thread, and wait for the result.
+        """
+        loop = self._loop
+        if loop is None or not loop.is_running():
+            coro.close()
+            raise RuntimeError("The postgres storage must be opened on a running loop")
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is loop:
+            coro.close()
+            raise RuntimeError("Cannot block the event loop, use get_async_user_db()")
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    def get_user_db(self, user):
+        adb, mtime = self._run(self.get_async_user_db(user))
+        return SyncUserDB(adb, self._run), mtime
+
+    def invalidate(self, user):
+        pass  # the schema is shared by all users
+
+    def get_users(self):
+        return self._run(self._get_users())
+
+    async def _get_users(self):
+        pool = await self.open()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch("SELECT _user FROM _users ORDER BY _user")
+        return [row[0] for row in rows]
+
+    def get_size(self, user):
+        return self._run(self._get_size(user))
+
+    async def _get_size(self, user):
+        pool = await self.open()
+        size = 0
+        async with pool.acquire() as conn:
+            for table in self.columns:
+                size += await conn.fetchval(
+                    f"SELECT COALESCE(SUM(LENGTH(_ob)), 0) FROM {table} "
+                    f"WHERE _user = $1",
+                    user,
+                )
+        return int(size)
+
+    def clear(self):
+        pass  # the connections are managed by the pool of the driver
+
+    def get_stats(self):
+        size = self.pool.get_size() if self.pool is not None else 0
+        return dict(open=size, hits=0, misses=0, evictions=0, expired=0)
+
+
+class AsyncUserDB:
+    """The view on a PostgresStorage for a single user, with an async
+    version of the API of an ItemDB. Writes must be done within
+    ``async with db.transaction():``. Queries may end with ORDER BY and
+    LIMIT clauses.
+    """
+
+    def __init__(self, storage, user):
+        self._storage = storage
+        self._user = user
+        self._conn = None  # the connection of the current transaction
+        self._written = False
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        """Context manager for a transaction. Writers of the same user
+        are serialized by locking the user's row in the _users table,
+        which also holds the mtime.
+        """
+        if self._conn is not None:
+            raise IOError("Already in a transaction")
+        pool = await self._storage.open()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(UPSERT_USER, self._user, time.time())
+                self._conn = conn
+                self._written = False
+                try:
+                    yield self
+                    if self._written:
+                        await conn.execute(UPSERT_USER, self._user, time.time())
+                finally:
+                    self._conn = None
+
+    def _get_columns(self, table_name):
+        try:
+            return self._storage.columns[table_name]
+        except KeyError:
+            raise KeyError(f"Table {table_name} does not exist.") from None
+
+    @contextlib.asynccontextmanager
+    async def _connection(self):
+        if self._conn is not None:
+            yield self._conn
+        else:
+            pool = await self._storage.open()
+            async with pool.acquire() as conn:
+                yield conn
+
+    async def count_all(self, table_name):
+        """Get the total number of items in the given table."""
+        self._get_columns(table_name)
+        async with self._connection() as conn:
+            return await conn.fetchval(
+                f"SELECT COUNT(*) FROM {table_name} WHERE _user = $1", self._user
+            )
+
+    async def select_all(self, table_name):
+        """Get all items in the given table."""
+        self._get_columns(table_name)
+        async with self._connection() as conn:
+            rows = await conn.fetch(
+                f"SELECT _ob FROM {table_name} WHERE _user = $1", self._user
+            )
+        return [json_decode(row[0]) for row in rows]
+
+    async def select(self, table_name, query, *args):
+        """Get the items in the given table that match the given query."""
+        self._get_columns(table_name)
+        condition, tail = _split_query(query)
+        # A negative limit means no limit in sqlite, but is an error in PostgreSQL
+        if re.search(r"\bLIMIT\s+\?\s*$", tail, re.IGNORECASE) and args[-1] < 0:
+            tail = tail[: tail.upper().rindex("LIMIT")]
+            args = args[:-1]
+        text = f"SELECT _ob FROM {table_name} WHERE _user = $1 AND ({condition}) {tail}"
+        async with self._connection() as conn:
+            rows = await conn.fetch(_translate(text, 2), self._user, *args)
+        return [json_decode(row[0]) for row in rows]
+
+    async def select_one(self, table_name, query, *args):
+        """Get the first item in the given table that match the given query."""
+        items = await self.select(table_name, query, *args)
+        return items[0] if items else None
+
+    async def put(self, table_name, *items):
+        """Put one or more items into the given table. Must be called
+        within a transaction.
+        """
+        if self._conn is None:
+            raise IOError("Can only use put() within a transaction.")
+        columns = self._get_columns(table_name)
+        rows = []
+        for item in items:
+            if not isinstance(item, dict):
+                raise TypeError("Expecing each item to be a dict")
+            if columns[0] not in item:
+                raise IndexError(f"Item does not have required field {columns[0]!r}")
+            values = [item.get(key, None) for key in columns]
+            rows.append([self._user, json_encode(item)] + values)
+        if not rows:
+            return
+        names = ", ".join(columns)
+        placeholders = ", ".join(f"${i + 3}" for i in range(len(columns)))
+        setters = ", ".join(f"{key} = excluded.{key}" for key in ["_ob"] + columns)
+        await self._conn.executemany(
+            f"INSERT INTO {table_name} (_user, _ob, {names}) "
+            f"VALUES ($1, $2, {placeholders}) "
+            f"ON CONFLICT (_user, {columns[0]}) DO UPDATE SET {setters}",
+            rows,
+        )
+        self._written = True
+
+    async def put_one(self, table_name, **item):
+        """Put an item into the given table using kwargs."""
+        await self.put(table_name, item)
+
+    async def delete(self, table_name, query, *args):
+        """Delete the items that match the given query from the given
+        table. Must be called within a transaction.
+        """
+        self._get_columns(table_name)
+        if self._conn is None:
+            raise IOError("Can only use delete() within a transaction.")
+        text = f"DELETE FROM {table_name} WHERE _user = $1 AND ({query})"
+        await self._conn.execute(_translate(text, 2), self._user, *args)
+        self._written = True
+
+
+class SyncUserDB:
+    """A blocking version of an AsyncUserDB, with the API of an ItemDB,
+    to use the sync code of the API server (in a thread). Each call
+    runs the query on the event loop and waits for the result.
+    """
+
+    def __init__(self, adb, run):
+        self._adb = adb
+        self._user = adb._user
+        self._run = run
+        self._transaction = None
+
+    def __enter__(self):
+        if self._transaction is not None:
+            raise IOError("Already in a transaction")
+        transaction = self._adb.transaction()
+        self._run(transaction.__aenter__())
+        self._transaction = transaction
+        return self
+
+    def __exit__(self, type, value, traceback):
+        transaction, self._transaction = self._transaction, None
+        self._run(transaction.__aexit__(type, value, traceback))
+
+    def close(self):
+        pass  # the connections are owned by the pool
+
+    def ensure_table(self, table_name, *indices):
+        """Check that the given table exists with the given indices (the
+        tables are created when the pool is opened).
+        """
+        columns = self._adb._get_columns(table_name)
+        if set(x.lstrip("!") for x in indices).difference(columns):
+            raise IndexError(f"Cannot add indices to table {table_name}.")
+        return self
+
+    def count_all(self, table_name):
+        return self._run(self._adb.count_all(table_name))
+
+    def select_all(self, table_name):
+        return self._run(self._adb.select_all(table_name))
+
+    def select(self, table_name, query, *args):
+        return self._run(self._adb.select(table_name, query, *args))
+
+    def select_one(self, table_name, query, *args):
+        return self._run(self._adb.select_one(table_name, query, *args))
+
+    def put(self, table_name, *items):
+        return self._run(self._adb.put(table_name, *items))
+
+    def put_one(self, table_name, **item):
+        return self._run(self._adb.put_one(table_name, **item))
+
+    def delete(self, table_name, query, *args):
+        return self._run(self._adb.delete(table_name, query, *args))
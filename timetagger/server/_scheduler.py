@@ -0,0 +1,150 @@
+"""
+Scheduling of blocking work (like querying a sqlite database) in threads.
+"""
+
+import os
+import time
+import asyncio
+import threading
+import contextvars
+import concurrent.futures
+
+from ._tracing import record_span
+
+
+class QueueFullError(Exception):
+    """Raised when a lane of the scheduler has too many waiting tasks."""
+
+
+class Lane:
+    """A lane of the scheduler: a thread pool with a bounded queue."""
+
+    def __init__(self, name, max_workers, max_queue, task_callbacks=()):
+        self.name = name
+        self.task_callbacks = task_callbacks
+        self.max_workers = int(max_workers)
+        self.max_queue = int(max_queue)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="asyncify-" + name
+        )
+        self._lock = threading.Lock()
+        self._keylocks = {}  # key -> [asyncio.Lock, count]
+        self._counts = dict(
+            waiting=0,
+            running=0,
+            completed=0,
+            rejected=0,
+            wait_time_total=0.0,
+            wait_time_max=0.0,
+        )
+
+    async def run(self, key, func, *args):
+        """Run the given function in a thread of this lane. Functions
+        with the same key (that is not None) are run one at a time.
+        """
+        with self._lock:
+            if self._counts["waiting"] >= self.max_queue:
+                self._counts["rejected"] += 1
+                raise QueueFullError(f"The {self.name} queue is full")
+            self._counts["waiting"] += 1
+
+        loop = asyncio.get_event_loop()
+        task = [time.perf_counter(), False]  # submit time, started
+        # Run in a copy of the current context, so that e.g. tracing works
+        call = contextvars.copy_context().run
+        try:
+            if key is None:
+                return await loop.run_in_executor(
+                    self.executor, call, self._call, task, func, *args
+                )
+            keylock = self._keylocks.setdefault(key, [asyncio.Lock(), 0])
+            keylock[1] += 1
+            try:
+                async with keylock[0]:
+                    return await loop.run_in_executor(
+                        self.executor, call, self._call, task, func, *args
+                    )
+            finally:
+                keylock[1] -= 1
+                if keylock[1] == 0:
+                    self._keylocks.pop(key, None)
+        finally:
+            # If the task did not start (e.g. because it was cancelled)
+            self._mark_started(task)
+
+    def _mark_started(self, task):
+        # Whoever gets here first decrements the waiting count
+        with self._lock:
+            if not task[1]:
+                task[1] = True
+                self._counts["waiting"] -= 1
+
+    def _call(self, task, func, *args):
+        wait_time = time.perf_counter() - task[0]
+        self._mark_started(task)
+        record_span("queue_wait:" + self.name, task[0], wait_time)
+        with self._lock:
+            counts = self._counts
+            counts["running"] += 1
+            counts["wait_time_total"] += wait_time
+            counts["wait_time_max"] = max(counts["wait_time_max"], wait_time)
+        try:
+            return func(*args)
+        finally:
+            for callback in self.task_callbacks:
+                callback()
+            with self._lock:
+                self._counts["running"] -= 1
+                self._counts["completed"] += 1
+
+    def get_stats(self):
+        with self._lock:
+            return self._counts.copy()
+
+
+class Scheduler:
+    """Runs blocking functions in threads, in separate lanes, so that
+    e.g. slow writes (like a bulk import) cannot starve cheap reads.
+
+    Each lane has its own thread pool. The number of tasks waiting in a
+    lane is bounded by ``max_queue``; when it's full, ``QueueFullError``
+    is raised, so that the server can respond with 503. Tasks with the
+    same key (e.g. the writes of one user) are run one at a time, so
+    that they don't contend for the sqlite write lock.
+    """
+
+    def __init__(self, lanes):
+        self._lanes = {}
+        self._task_callbacks = []
+        for name, (max_workers, max_queue) in lanes.items():
+            lane = Lane(name, max_workers, max_queue, self._task_callbacks)
+            self._lanes[name] = lane
+
+    def get_lane(self, name):
+        return self._lanes[name]
+
+    def add_task_callback(self, callback):
+        """Add a function that is called in the thread after each task,
+        e.g. to release thread-local resources. It must not raise.
+        """
+        self._task_callbacks.append(callback)
+
+    async def run(self, lane, key, func, *args):
+        """Run the given function in a thread of the given lane, and
+        await the result.
+        """
+        return await self._lanes[lane].run(key, func, *args)
+
+    def get_stats(self):
+        """Get a dict with for each lane a dict of counters: waiting,
+        running, completed, rejected, wait_time_total, and wait_time_max.
+        """
+        return {name: lane.get_stats() for name, lane in self._lanes.items()}
+
+
+def get_default_lanes():
+    """Get the default lanes: a read lane with as many workers as the
+    default of ThreadPoolExecutor, and a smaller write lane.
+    """
+    max_read_workers = min(32, (os.cpu_count() or 1) + 4)
+    return {"read": (max_read_workers, 1000), "write": (4, 200)}
@@ -0,0 +1,192 @@
+"""
+Aggregated stats: the time spent per tag combination. The aggregates
+are stored per hour in the user's database, and updated incrementally
+when records are pushed, so that stats can be produced without going
+over all records. Similarly, an index of the records per tag is kept.
+"""
+
+import datetime
+
+
+# The size of the aggregate bins (in seconds). This is an hour, so that
+# bins of days and weeks can be composed from it for most timezones.
+STATS_BIN_SIZE = 3600
+
+# Records that are running (t1 == t2), or that are longer than this
+# (e.g. because of a typo), are not aggregated but stored as-is.
+MAX_AGGREGATE_DURATION = 7 * 86400
+
+# The aggregate bin used for these records
+EXACT_BIN = -1
+
+# The bins that can be requested, with their (minimum) size in seconds
+BIN_SIZES = {"day": 86400, "week": 7 * 86400, "month": 28 * 86400}
+
+
+def _is_valid_tag_charcode(cc):
+    # Matches utils.is_valid_tag_charcode() in the client
+    return (
+        (47 < cc < 58)  # numeric (0-9)
+        or (64 < cc < 91)  # upper alpha (A-Z)
+        or (96 < cc < 123)  # lower alpha (a-z)
+        or cc in (45, 47, 95)  # - / _
+        or cc > 127  # non-ascii
+    )
+
+
+def get_tags_from_string(s):
+    """Get a sorted list of (lowercase) tags from a string. This matches
+    the tags of utils.get_tags_and_parts_from_string() in the client.
+    """
+    tags = set()
+    tag_start = -1
+    for i in range(len(s) + 1):
+        cc = ord(s[i]) if i < len(s) else 35
+        if tag_start < 0:
+            if cc == 35:  # hash symbol (#)
+                tag_start = i
+        elif not _is_valid_tag_charcode(cc):
+            if i - tag_start > 1:  # dont count the # symbol
+                tags.add(s[tag_start:i].lower())
+            tag_start = i if cc == 35 else -1
+    return sorted(tags)
+
+
+def get_tagz(record):
+    """Get the tag combination of a record as a string, like the keys
+    of RecordStore.get_stats() in the client. Returns None for hidden
+    records, which do not count in the stats.
+    """
+    ds = record.get("ds", "")
+    if ds.startswith("HIDDEN"):
+        return None
+    return " ".join(get_tags_from_string(ds)) or "#untagged"
+
+
+def get_record_tags(record):
+    """Get a list of the tags of a record. Records without tags have
+    the tag "#untagged". Returns an empty list for hidden records.
+    """
+    tagz = get_tagz(record)
+    return tagz.split(" ") if tagz else []
+
+
+def overlaps(record, t1, t2, now):
+    """Get whether the record overlaps with the time range t1-t2.
+    Running records are considered to run until now.
+    """
+    r_t1, r_t2 = sorted((record["t1"], record["t2"]))
+    if r_t1 == r_t2:
+        r_t2 = max(r_t2, now)
+    return r_t1 < t2 and r_t2 > t1
+
+
+def is_aggregated(record):
+    """Get whether the given record is included in the aggregate bins,
+    as opposed to being stored as-is in the EXACT_BIN.
+    """
+    return 0 < record["t2"] - record["t1"] <= MAX_AGGREGATE_DURATION
+
+
+def iter_record_stats(record):
+    """Yield (bin, tagz, seconds) for the aggregate bins that the given
+    (aggregated) record overlaps with.
+    """
+    tagz = get_tagz(record)
+    if tagz is None:
+        return
+    t1, t2 = record["t1"], record["t2"]
+    bin = t1 - t1 % STATS_BIN_SIZE
+    while bin < t2:
+        yield bin, tagz, min(t2, bin + STATS_BIN_SIZE) - max(t1, bin)
+        bin += STATS_BIN_SIZE
+
+
+def get_stats_deltas(old_records, new_records):
+    """Get how the aggregates change when the given records are replaced.
+    The arguments are dicts that map keys to records (old_records only
+    contains the records that existed). Returns a dict that maps
+    aggregate keys to (bin, tagz, delta), and a dict that maps the keys
+    of records that are not aggregated to their new item (or None).
+    """
+    deltas = {}
+    exact = {}
+    for key, new_record in new_records.items():
+        old_record = old_records.get(key, None)
+        for record, sign in ((old_record, -1), (new_record, 1)):
+            if record is None:
+                continue
+            elif not is_aggregated(record):
+                item = None
+                tagz = get_tagz(record) if sign > 0 else None
+                if tagz is not None:
+                    t1, t2 = sorted((record["t1"], record["t2"]))
+                    item = dict(bin=EXACT_BIN, tagz=tagz, t1=t1, t2=t2)
+                exact["record/" + key] = item
+                continue
+            for bin, tagz, t in iter_record_stats(record):
+                stats_key = f"{bin}/{tagz}"
+                delta = deltas.get(stats_key, (bin, tagz, 0))[2] + sign * t
+                deltas[stats_key] = bin, tagz, delta
+    return deltas, exact
+
+
+def get_tags_deltas(old_records, new_records):
+    """Get how the tag index changes when the given records are replaced.
+    Returns a dict that maps keys of the record_tags table to their new
+    item (or None), and a dict that maps tags to [delta_count, delta_t].
+    """
+    items = {}
+    totals = {}
+    for key, new_record in new_records.items():
+        old_record = old_records.get(key, None)
+        for record, sign in ((old_record, -1), (new_record, 1)):
+            if record is None:
+                continue
+            t = max(0, record["t2"] - record["t1"])
+            for tag in get_record_tags(record):
+                item_key = f"{tag} {key}"  # tags don't contain spaces
+                items[item_key] = None
+                if sign > 0:
+                    items[item_key] = dict(tag=tag, record=key, t=t)
+                total = totals.setdefault(tag, [0, 0])
+                total[0] += sign
+                total[1] += sign * t
+    return items, totals
+
+
+def get_bin_edges(t1, t2, bin="", tz=0):
+    """Get the edges of the bins between t1 and t2, for bins of a "day",
+    "week" (starting on monday), or "month", using a fixed timezone
+    offset (in minutes east of UTC). Without a bin, returns [t1, t2].
+    """
+    if not bin:
+        return [t1, t2]
+    offset = tz * 60
+    edges = [t1]
+    if bin == "month":
+        tzinfo = datetime.timezone(datetime.timedelta(seconds=offset))
+        d = datetime.datetime.fromtimestamp(t1, tzinfo)
+        year, month = d.year, d.month
+        while True:
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+            t = datetime.datetime(year, month, 1, tzinfo=tzinfo).timestamp()
+            if t >= t2:
+                break
+            edges.append(t)
+    else:
+        size = BIN_SIZES[bin]
+        ref = 4 * 86400 - offset  # 1970-01-05 was a monday
+        t = t1 - (t1 - ref) % size + size
+        while t < t2:
+            edges.append(t)
+            t += size
+    edges.append(t2)
+    return edges
+
+
+def add_overlap(stats, tagz, t1, t2, range_t1, range_t2):
+    """Add the overlap of t1-t2 with the given range to the stats."""
+    t = min(t2, range_t2) - max(t1, range_t1)
+    if t > 0:
+        stats[tagz] = stats.get(tagz, 0) + t
@@ -0,0 +1,405 @@
+"""
+Storage backends for the user data. The API server gets the database
+of a user from the configured backend, see configure_storage() in
+_apiserver.py. The database that a backend returns has the API of an
+ItemDB (the subset that is used by the server), so that the request
+handlers don't need to know how the data is stored.
+
+* FileStorage: a sqlite database per user (the default).
+* SharedStorage: a single sqlite database for all users, in which each
+  table has a user column that is the first part of each index.
+* PostgresStorage (in _pgstorage.py): like SharedStorage, but in a
+  PostgreSQL database, with an async API.
+"""
+
+import os
+import re
+import time
+import json
+import sqlite3
+import threading
+
+from ._utils import user2filename, filename2user, iter_user_filenames
+from ._dbpool import DBPool
+
+json_encode = json.JSONEncoder(ensure_ascii=True).encode
+json_decode = json.JSONDecoder().decode
+
+
+class Storage:
+    """The interface of a storage backend."""
+
+    name = ""
+    is_async = False  # whether the API server should use get_async_user_db()
+
+    def get_user_db(self, user):
+        """Get the db for the given user, and its mtime (which is -1 if
+        the db did not yet exist). Must only be used in the calling thread.
+        """
+        raise NotImplementedError()
+
+    def notify_write(self, user):
+        """Call after a write to the user's db (outside the transaction)."""
+        pass
+
+    def invalidate(self, user):
+        """Make the user's db be re-initialized on next use."""
+        raise NotImplementedError()
+
+    def get_users(self):
+        """Get a sorted list of the users that have a database."""
+        raise NotImplementedError()
+
+    def get_size(self, user):
+        """Get the (approximate) size of the user's data in bytes."""
+        raise NotImplementedError()
+
+    def vacuum(self, user):
+        """Reclaim unused space (of the user's db, if possible)."""
+        pass
+
+    def clear(self):
+        """Close all databases."""
+        self.pool.clear()
+
+    def get_stats(self):
+        """Get a dict with the stats of the pool of open databases."""
+        return self.pool.get_stats()
+
+
+class FileStorage(Storage):
+    """Store the data of each user in a separate sqlite database, see
+    _utils.user2filename(). The databases are opened using the given
+    DBPool.
+    """
+
+    name = "files"
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def get_user_db(self, user):
+        # The pool creates the database if it does not yet exist
+        return self.pool.get(user2filename(user))
+
+    def notify_write(self, user):
+        self.pool.notify_write(user2filename(user))
+
+    def invalidate(self, user):
+        self.pool.invalidate(user2filename(user))
+
+    def get_users(self):
+        # During a migration, a user can be in both layouts
+        users = set(filename2user(filename) for filename in iter_user_filenames())
+        return sorted(users)
+
+    def get_size(self, user):
+        filename = user2filename(user)
+        size = 0
+        for fname in (filename, filename + "-wal"):
+            try:
+                size += os.path.getsize(fname)
+            except FileNotFoundError:
+                pass
+        return size
+
+    def vacuum(self, user):
+        db, mtime = self.get_user_db(user)
+        # Outside of a transaction. Checkpoint so that the db file shrinks.
+        db._conn.execute("VACUUM")
+        db._conn.execute("ANALYZE")
+        db._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.notify_write(user)
+
+
+class SharedStorage(Storage):
+    """Store the data of all users in a single sqlite database. This
+    means fewer open files, a shared page cache, and that queries over
+    all users are possible. The tables are like those of an ItemDB,
+    with an extra "_user" column. The (unique) indices are composite
+    indices that start with the user, so that the queries for a single
+    user remain fast.
+
+    The initializer is called once per user (per process) with the
+    user's db, like the initializer of DBPool. The last write time of
+    each user is stored in the "_users" table, to serve as the mtime.
+    """
+
+    name = "shared"
+
+    def __init__(self, filename, initializer=None, pragmas=None, stat_cache=None):
+        self.filename = filename
+        self.pool = DBPool(
+            initializer=self._init_db, pragmas=pragmas, stat_cache=stat_cache
+        )
+        self._initializer = initializer
+        self._initialized = set()
+        self._lock = threading.Lock()
+
+    def _init_db(self, db):
+        db._conn.execute(
+            "CREATE TABLE IF NOT EXISTS _users "
+            "(_user TEXT NOT NULL PRIMARY KEY, mtime REAL NOT NULL) WITHOUT ROWID"
+        )
+
+    def get_user_db(self, user):
+        db, _ = self.pool.get(self.filename)
+        ob = db._conn.execute(
+            "SELECT mtime FROM _users WHERE _user = ?", (user,)
+        ).fetchone()
+        mtime = ob[0] if ob else -1
+        user_db = UserDB(db, user)
+        if self._initializer and user not in self._initialized:
+            self._initializer(user_db)
+            with self._lock:
+                self._initialized.add(user)
+        return user_db, mtime
+
+    def invalidate(self, user):
+        with self._lock:
+            self._initialized.discard(user)
+
+    def get_users(self):
+        db, _ = self.pool.get(self.filename)
+        return [row[0] for row in db._conn.execute("SELECT _user FROM _users")]
+
+    def get_size(self, user):
+        db, _ = self.pool.get(self.filename)
+        size = 0
+        for table in db.get_table_names():
+            if table != "_users" and not table.startswith("sqlite_"):
+                size += db._conn.execute(
+                    f"SELECT TOTAL(LENGTH(_ob)) FROM {table} WHERE _user = ?", (user,)
+                ).fetchone()[0]
+        return int(size)
+
+
+def _split_query(query):
+    """Split a query into its condition, and a tail with ORDER BY and LIMIT."""
+    m = re.search(r"\b(ORDER\s+BY|LIMIT)\b", query, re.IGNORECASE)
+    if m is None:
+        return query, ""
+    return query[: m.start()], query[m.start() :]
+
+
+class UserDB:
+    """The view on a SharedStorage for a single user. It has the API
+    of an ItemDB, but all operations only apply to the items of the
+    user. Queries may end with ORDER BY and LIMIT clauses.
+    """
+
+    def __init__(self, db, user):
+        self._db = db  # the ItemDB of the shared database
+        self._conn = db._conn
+        self._user = user
+        self._cur = None
+        self._written = False
+
+    def __enter__(self):
+        if self._cur is not None:
+            raise IOError("Already in a transaction")
+        self._cur = self._conn.cursor()
+        self._cur.execute("BEGIN IMMEDIATE")
+        self._written = False
+        return self
+
+    def __exit__(self, type, value, traceback):
+        ok = not value
+        try:
+            if ok and self._written:
+                # The write time of the user serves as the mtime
+                ok = False
+                self._cur.execute(
+                    "INSERT OR REPLACE INTO _users (_user, mtime) VALUES (?, ?)",
+                    (self._user, time.time()),
+                )
+                ok = True
+        finally:
+            self._cur.close()
+            self._cur = None
+            if ok:
+                self._conn.commit()
+            else:
+                self._conn.rollback()
+                self._db._indices_per_table.clear()
+
+    def close(self):
+        pass  # the connection is owned by the pool
+
+    def get_indices(self, table_name):
+        """Get a set of index names for the given table. Names prefixed
+        with "!" are unique (per user). Raises KeyError if the table
+        does not exist.
+        """
+        indices = self._db.get_indices(table_name)
+        if "!_user" not in indices:
+            raise KeyError(f"Table {table_name} is not a table with users.")
+        return indices.difference({"!_user"})
+
+    def ensure_table(self, table_name, *indices):
+        """Ensure that the given table exists and has the given indices."""
+        if not all(isinstance(x, str) for x in indices):
+            raise TypeError("Indices must be str")
+        try:
+            missing_indices = set(indices).difference(self.get_indices(table_name))
+        except KeyError:
+            missing_indices = {"--table--"}
+        if missing_indices:
+            if self._cur:
+                self._ensure_table(table_name, indices, missing_indices)
+            else:
+                with self:
+                    self._ensure_table(table_name, indices, missing_indices)
+        return self
+
+    def _ensure_table(self, table_name, indices, missing_indices):
+        cur = self._cur
+        for fieldname in indices:
+            key = fieldname.lstrip("!")
+            if not key.isidentifier():
+                raise ValueError("Column names must be identifiers.")
+            elif key in ("_ob", "_user"):
+                raise IndexError(f"Column names cannot be {key!r} (name is reserved).")
+
+        # The unique keys are unique per user. With one unique key, the
+        # primary key is (user, key), and we omit the rowid.
+        unique_keys = sorted(x.lstrip("!") for x in indices if x.startswith("!"))
+        text = f"CREATE TABLE IF NOT EXISTS {table_name} "
+        text += "(_user TEXT NOT NULL, _ob TEXT NOT NULL"
+        for index_key in unique_keys:
+            text += f", {index_key} NOT NULL"
+        if len(unique_keys) == 1:
+            text += f", PRIMARY KEY (_user, {unique_keys[0]})) WITHOUT ROWID;"
+        else:
+            for index_key in unique_keys:
+                text += f", UNIQUE (_user, {index_key})"
+            text += ");"
+        cur.execute(text)
+
+        # Ensure the columns and (composite) indices
+        cur.execute(f"PRAGMA table_info('{table_name}');")
+        found_indices = {(x[3] * "!" + x[1]) for x in cur}
+        new_keys = []
+        for fieldname in sorted(indices):
+            index_key = fieldname.lstrip("!")
+            if fieldname in found_indices:
+                continue
+            elif fieldname.startswith("!"):
+                when = "after the table has been created"
+                raise IndexError(f"Cannot add unique index {fieldname!r} {when}.")
+            elif fieldname in {x.lstrip("!") for x in found_indices}:
+                raise IndexError(f"Given index {fieldname!r} should be unique.")
+            cur.execute(f"ALTER TABLE {table_name} ADD {index_key};")
+            cur.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_{table_name}_{index_key} "
+                f"ON {table_name} (_user, {index_key})"
+            )
+            new_keys.append(index_key)
+        self._db._indices_per_table.pop(table_name, None)
+
+        # Fill in the new columns, for the items of all users
+        if new_keys and "--table--" not in missing_indices:
+            pk = "_user, " + unique_keys[0] if unique_keys else "rowid"
+            rows = cur.execute(f"SELECT {pk}, _ob FROM {table_name}").fetchall()
+            setters = ", ".join(f"{key} = ?" for key in new_keys)
+            where = " AND ".join(f"{key} = ?" for key in pk.split(", "))
+            for *pk_values, ob in rows:
+                item = json_decode(ob)
+                values = [item.get(key, None) for key in new_keys]
+                cur.execute(
+                    f"UPDATE {table_name} SET {setters} WHERE {where}",
+                    values + pk_values,
+                )
+
+    def _execute(self, cur, text, args):
+        try:
+            cur.execute(text, args)
+        except sqlite3.OperationalError as err:
+            if "no such column" in str(err).lower():
+                raise IndexError(str(err)) from None
+            raise err
+
+    def count_all(self, table_name):
+        """Get the total number of items in the given table."""
+        self.get_indices(table_name)
+        cur = self._conn.cursor()
+        try:
+            cur.execute(
+                f"SELECT COUNT(*) FROM {table_name} WHERE _user = ?", (self._user,)
+            )
+            return cur.fetchone()[0]
+        finally:
+            cur.close()
+
+    def select_all(self, table_name):
+        """Get all items in the given table."""
+        self.get_indices(table_name)
+        cur = self._conn.cursor()
+        try:
+            cur.execute(f"SELECT _ob FROM {table_name} WHERE _user = ?", (self._user,))
+            return [json_decode(x[0]) for x in cur]
+        finally:
+            cur.close()
+
+    def select(self, table_name, query, *save_args):
+        """Get the items in the given table that match the given query."""
+        self.get_indices(table_name)
+        condition, tail = _split_query(query)
+        text = f"SELECT _ob FROM {table_name} WHERE _user = ? AND ({condition}) {tail}"
+        cur = self._conn.cursor()
+        try:
+            self._execute(cur, text, (self._user,) + save_args)
+            return [json_decode(x[0]) for x in cur]
+        finally:
+            cur.close()
+
+    def select_one(self, table_name, query, *args):
+        """Get the first item in the given table that match the given query."""
+        items = self.select(table_name, query, *args)
+        return items[0] if items else None
+
+    def put(self, table_name, *items):
+        """Put one or more items into the given table. Must be called
+        within a transaction.
+        """
+        cur = self._cur
+        if cur is None:
+            raise IOError("Can only use put() within a transaction.")
+        indices = self.get_indices(table_name)
+
+        for item in items:
+            if not isinstance(item, dict):
+                raise TypeError("Expecing each item to be a dict")
+            index_keys = "_user, _ob"
+            row_plac = "?, ?"
+            row_vals = [self._user, json_encode(item)]
+            for fieldname in indices:
+                index_key = fieldname.lstrip("!")
+                if index_key in item:
+                    index_keys += ", " + index_key
+                    row_plac += ", ?"
+                    row_vals.append(item[index_key])
+                elif fieldname.startswith("!"):
+                    raise IndexError(f"Item does not have required field {index_key!r}")
+            cur.execute(
+                f"INSERT OR REPLACE INTO {table_name} ({index_keys}) VALUES ({row_plac})",
+                row_vals,
+            )
+            self._written = True
+
+    def put_one(self, table_name, **item):
+        """Put an item into the given table using kwargs."""
+        self.put(table_name, item)
+
+    def delete(self, table_name, query, *save_args):
+        """Delete the items that match the given query from the given
+        table. Must be called within a transaction.
+        """
+        self.get_indices(table_name)
+        cur = self._cur
+        if cur is None:
+            raise IOError("Can only use delete() within a transaction.")
+        condition, tail = _split_query(query)
+        text = f"DELETE FROM {table_name} WHERE _user = ? AND ({condition}) {tail}"
+        self._execute(cur, text, (self._user,) + save_args)
+        self._written = True
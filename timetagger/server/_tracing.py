@@ -0,0 +1,194 @@
+"""
+Opt-in tracing of requests, to find out where the time of slow
+requests is spent.
+"""
+
+import time
+import random
+import inspect
+import logging
+import threading
+import contextvars
+import collections
+
+
+logger = logging.getLogger("asgineer")
+
+# The trace of the current request (None when not tracing). Contextvars
+# are copied to the threads of the scheduler, see _scheduler.Lane.run().
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """The timings of the spans of a single request."""
+
+    def __init__(self, name, user=""):
+        self.name = name
+        self.user = user
+        self.t0 = time.perf_counter()
+        self.time = time.time()
+        self.duration = 0
+        self.status = 0
+        self.spans = []  # (name, start, duration), start relative to t0
+
+    def add_span(self, name, start, duration):
+        # list.append is thread-safe
+        self.spans.append((name, start - self.t0, duration))
+
+    def to_dict(self):
+        return dict(
+            name=self.name,
+            user=self.user,
+            time=self.time,
+            duration=self.duration,
+            status=self.status,
+            spans=[
+                dict(name=name, start=start, duration=duration)
+                for name, start, duration in self.spans
+            ],
+        )
+
+    def summary(self):
+        """Get a one-line summary, with the total time spent per span name."""
+        totals = {}
+        for name, start, duration in self.spans:
+            totals[name] = totals.get(name, 0) + duration
+        breakdown = ", ".join(f"{name} {t:.3f}s" for name, t in totals.items())
+        text = f"{self.name} for {self.user!r} took {self.duration:.3f}s"
+        text += f" (status {self.status})"
+        return text + (f": {breakdown}" if breakdown else "")
+
+
+class Tracer:
+    """Creates traces for requests. Disabled by default. When enabled,
+    requests that take longer than ``slow_threshold`` seconds are logged
+    with their breakdown. Slow requests, and a fraction ``sample_rate``
+    of the other requests, are kept in a buffer that can be dumped.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.slow_threshold = 1.0
+        self.sample_rate = 0.01
+        self._lock = threading.Lock()
+        self._buffer = collections.deque(maxlen=100)
+
+    @property
+    def buffer_size(self):
+        return self._buffer.maxlen
+
+    def configure(
+        self, enabled=True, slow_threshold=1.0, sample_rate=0.01, buffer_size=100
+    ):
+        """Enable (or disable) tracing, and set its parameters."""
+        if not 0 <= sample_rate <= 1:
+            raise ValueError("The sample_rate must be between 0 and 1.")
+        with self._lock:
+            self.enabled = bool(enabled)
+            self.slow_threshold = float(slow_threshold)
+            self.sample_rate = float(sample_rate)
+            if buffer_size != self._buffer.maxlen:
+                self._buffer = collections.deque(self._buffer, maxlen=int(buffer_size))
+
+    def start(self, name, user=""):
+        """Start a trace for the current request. Returns None if tracing
+        is disabled.
+        """
+        if not self.enabled:
+            return None
+        trace = Trace(name, user)
+        trace.token = current_trace.set(trace)
+        return trace
+
+    def finish(self, trace, status):
+        """Finish the trace, log it if it's slow, and maybe keep it."""
+        if trace is None:
+            return
+        current_trace.reset(trace.token)
+        trace.duration = time.perf_counter() - trace.t0
+        trace.status = status
+        slow = trace.duration > self.slow_threshold
+        if slow:
+            logger.warning("Slow request: " + trace.summary())
+        if slow or random.random() < self.sample_rate:
+            with self._lock:
+                self._buffer.append(trace)
+
+    def dump(self, clear=False):
+        """Get the kept traces as a list of dicts, oldest first."""
+        with self._lock:
+            traces = list(self._buffer)
+            if clear:
+                self._buffer.clear()
+        return [trace.to_dict() for trace in traces]
+
+
+def record_span(name, start, duration):
+    """Add a span to the trace of the current request (if any)."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_span(name, start, duration)
+
+
+class span:
+    """Context manager to time a span of the current request."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        record_span(self.name, self.t0, time.perf_counter() - self.t0)
+
+
+def traced(name):
+    """Decorator to record each call to a function (or coroutine
+    function) as a span.
+    """
+
+    def decorator(func):
+        def traced_wrapper(*args, **kwargs):
+            if current_trace.get() is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+
+        async def async_traced_wrapper(*args, **kwargs):
+            if current_trace.get() is None:
+                return await func(*args, **kwargs)
+            with span(name):
+                return await func(*args, **kwargs)
+
+        wrapper = traced_wrapper
+        if inspect.iscoroutinefunction(func):
+            wrapper = async_traced_wrapper
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+    return decorator
+
+
+# The tracer for the requests of the server
+tracer = Tracer()
+
+
+def configure_tracing(
+    enabled=True, slow_threshold=1.0, sample_rate=0.01, buffer_size=100
+):
+    """Enable tracing of API requests. Requests slower than slow_threshold
+    (in seconds) are logged. Slow requests and a sample of the others are
+    kept in a buffer of the given size, see traces_handler().
+    """
+    tracer.configure(enabled, slow_threshold, sample_rate, buffer_size)
+
+
+async def traces_handler(request):
+    """Coroutine to handle a GET traces request, to dump the trace buffer."""
+    if request.method != "GET":
+        return 405, {}, "/traces can only be used with GET"
+    clear = request.querydict.get("clear", "") in ("1", "true")
+    return 200, {}, {"enabled": tracer.enabled, "traces": tracer.dump(clear)}
@@ -3,20 +3,86 @@ Misc utils.
 """
 
 import os
+import stat
+import time
 import asyncio
-import concurrent
+import hashlib
+import functools
+import threading
 import subprocess
+from collections import OrderedDict
 from base64 import urlsafe_b64encode as b64encode, urlsafe_b64decode as b64decode
 
+from ._scheduler import Scheduler, get_default_lanes
+
 
 ROOT_USER_DIR = os.path.expanduser("~/_timetagger/users")
 if not os.path.isdir(ROOT_USER_DIR):
     os.makedirs(ROOT_USER_DIR)
 
 
-executor = concurrent.futures.ThreadPoolExecutor(
-    max_workers=None, thread_name_prefix="asyncify"
-)
+# %% Stat cache
+
+
+class StatCache:
+    """A cache of os.stat() results, to save syscalls for files that
+    are looked at on each request. Entries expire after ``ttl`` seconds,
+    so changes by other processes are seen after at most that long.
+    Our own changes should call ``invalidate()``. Holds at most
+    ``max_size`` entries, evicting the least recently used.
+    """
+
+    def __init__(self, ttl=1, max_size=10_000):
+        self.ttl = float(ttl)
+        self.max_size = int(max_size)
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()  # filename -> (stat_result or None, expires)
+
+    def stat(self, filename):
+        """Get the (maybe cached) os.stat() result for the given
+        filename, or None if the file does not exist.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(filename, None)
+            if entry is not None and now < entry[1]:
+                self._cache.move_to_end(filename)
+                return entry[0]
+        try:
+            result = os.stat(filename)
+        except FileNotFoundError:
+            result = None
+        with self._lock:
+            self._cache[filename] = result, now + self.ttl
+            self._cache.move_to_end(filename)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return result
+
+    def isfile(self, filename):
+        """Get whether the given filename is an existing regular file."""
+        result = self.stat(filename)
+        return result is not None and stat.S_ISREG(result.st_mode)
+
+    def invalidate(self, *filenames):
+        """Forget the given filenames, so they are stat'ed on next use."""
+        with self._lock:
+            for filename in filenames:
+                self._cache.pop(filename, None)
+
+    def clear(self):
+        """Forget all filenames."""
+        with self._lock:
+            self._cache.clear()
+
+
+# The stat cache for the user databases. Writes to a db must invalidate
+# it, see DBPool.notify_write().
+stat_cache = StatCache()
+
+
+# The scheduler that runs the functions passed to asyncthis() and asyncify()
+scheduler = Scheduler(get_default_lanes())
 
 
 # %% Username stuff
@@ -24,8 +90,16 @@ executor = concurrent.futures.ThreadPoolExecutor(
 ok_chars = frozenset("-_abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789")
 
 
-def user2filename(user):
-    """Convert a user id (e.g. email address) to the corresponding absolute filename."""
+# The user databases are stored in subdirectories, based on a hash of
+# the user id (e.g. "users/3f/a2/name~encoded.db"), so that directories
+# don't get too large. Databases in the old flat layout (directly in
+# ROOT_USER_DIR) are still found, see migrate() in _maintenance.py.
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2  # hex chars per level, i.e. 256 subdirs per level
+
+
+def user2basename(user):
+    """Convert a user id (e.g. email address) to the corresponding filename (without dir)."""
     # The rules for characters in email addresses are quite complex,
     # but can at least contain !#$%&'*+-/=?^_`{|}~. Therefore we
     # agressively create a clean representation (for recognizability)
@@ -33,9 +107,40 @@ def user2filename(user):
 
     clean = "".join((c if c in ok_chars else "-") for c in user)
     encoded = b64encode(user.encode()).decode()
-    fname = clean + "~" + encoded + ".db"
+    return clean + "~" + encoded + ".db"
+
+
+def get_user_filenames(user, root=None):
+    """Get the filenames for the sharded and the flat layout, for the
+    given user, in the given root dir (default ROOT_USER_DIR).
+    """
+    return _get_user_filenames(user, ROOT_USER_DIR if root is None else root)
+
 
-    return os.path.join(ROOT_USER_DIR, fname)
+@functools.lru_cache(maxsize=10_000)
+def _get_user_filenames(user, root):
+    # Memoized, because this is needed for each request
+    fname = user2basename(user)
+    h = hashlib.sha256(user.encode()).hexdigest()
+    shards = [h[i * SHARD_WIDTH : (i + 1) * SHARD_WIDTH] for i in range(SHARD_LEVELS)]
+    return os.path.join(root, *shards, fname), os.path.join(root, fname)
+
+
+def user2filename(user):
+    """Convert a user id (e.g. email address) to the corresponding absolute filename."""
+    # Use the flat layout only if the db exists there, and was not migrated.
+    # A sharded db is never removed, so we can trust the stat cache if it
+    # says that it exists. Otherwise we stat it, because a migration in
+    # another process (e.g. the CLI) must be seen right away.
+    sharded, flat = get_user_filenames(user)
+    if stat_cache.isfile(sharded):
+        return sharded
+    elif os.path.isfile(sharded):
+        stat_cache.invalidate(sharded, sharded + "-wal")
+        return sharded
+    elif stat_cache.isfile(flat):
+        return flat
+    return sharded
 
 
 def filename2user(filename):
@@ -45,6 +150,26 @@ def filename2user(filename):
     return b64decode(encoded.encode()).decode()
 
 
+def iter_user_filenames(root=None):
+    """Yield the filenames of all user databases in the given root dir
+    (default ROOT_USER_DIR), in both the sharded and the flat layout.
+    """
+    root = ROOT_USER_DIR if root is None else root
+    dirs = [(root, 0)]
+    while dirs:
+        dir, level = dirs.pop()
+        try:
+            entries = list(os.scandir(dir))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.name.endswith(".db") and "~" in entry.name:
+                yield entry.path
+            elif level < SHARD_LEVELS and len(entry.name) == SHARD_WIDTH:
+                if entry.is_dir():
+                    dirs.append((entry.path, level + 1))
+
+
 # %% Async -> sync (mostly for testing)
 
 
@@ -77,19 +202,21 @@ def asyncify(func):
     """
 
     async def asyncify_wrapper(*args):
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(executor, func, *args)
+        return await scheduler.run("read", None, func, *args)
 
     asyncify_wrapper.__name__ = "asyncified_" + func.__name__
     return asyncify_wrapper
 
 
-async def asyncthis(func, *args):
+async def asyncthis(func, *args, lane="read", key=None):
     """Call given function in a separate thread and await the result. This
     is/returns a co-routine.
+
+    The function is run in the given lane of the scheduler ("read" or
+    "write"). Functions in the same lane with the same key (e.g. a user
+    id) are run one at a time. Raises QueueFullError if the lane is busy.
     """
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(executor, func, *args)
+    return await scheduler.run(lane, key, func, *args)
 
 
 # %% Other
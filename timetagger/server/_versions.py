@@ -0,0 +1,195 @@
+"""
+Keep track of the last time that each user database was written to,
+so that polls for which nothing has changed can be answered without
+touching the filesystem or the database. And allow waiting for changes.
+"""
+
+import os
+import time
+import mmap
+import struct
+import asyncio
+import threading
+from zlib import crc32
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - e.g. Windows
+    fcntl = None
+
+
+class VersionRegistry:
+    """Registry of the latest server time written for each user.
+
+    Writers call ``bump()`` after they commit. The version of a user is
+    ``None`` if it is not known, in which case the caller must consult
+    the database (and can then call ``bump()`` with the db's mtime).
+
+    By default the registry is in-process. Writes by other processes
+    are not seen, which is why entries expire after ``ttl`` seconds.
+    When a ``SharedVersionTable`` is set as ``table``, all processes
+    that use the same table stay coherent and entries don't expire.
+    """
+
+    def __init__(self, ttl=30, max_users=100_000, table=None):
+        self.ttl = float(ttl)
+        self.max_users = int(max_users)
+        self.table = table
+        self._lock = threading.Lock()
+        self._versions = OrderedDict()  # user -> (version, expire_time)
+
+    def get(self, user):
+        """Get the latest version (a server time) for the given user, or None."""
+        if self.table is not None:
+            return self.table.get(user)
+        try:
+            version, expires = self._versions[user]
+        except KeyError:
+            return None
+        if time.monotonic() > expires:
+            return None
+        return version
+
+    def bump(self, user, version):
+        """Register a new version for the given user. Versions never decrease."""
+        if self.table is not None:
+            return self.table.bump(user, version)
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            old = self._versions.pop(user, None)
+            if old is not None:
+                version = max(version, old[0])
+            self._versions[user] = version, expires
+            while len(self._versions) > self.max_users:
+                self._versions.popitem(last=False)
+
+    def clear(self):
+        """Forget all versions (of the in-process registry)."""
+        with self._lock:
+            self._versions.clear()
+
+
+class SharedVersionTable:
+    """A table of versions in a memory-mapped file, that can be shared
+    between processes (e.g. multiple uvicorn workers).
+
+    Users are hashed into a fixed number of slots, and a slot stores
+    the maximum version of all users that map to it. A collision thus
+    only makes a poll go to the database when that was not needed.
+    Reads are lock-free; writes use an exclusive file lock.
+
+    All processes that write to the user databases must use the same
+    table. Since versions in the table are trusted, the file should not
+    outlive a period in which that was not the case. Putting it in
+    e.g. ``/dev/shm`` makes sure it's cleared at each reboot.
+    """
+
+    _slot = struct.Struct("<dd")  # the version stored twice, to detect torn reads
+
+    def __init__(self, filename, nslots=2 ** 16):
+        if fcntl is None:  # pragma: no cover
+            raise RuntimeError("SharedVersionTable needs fcntl (i.e. a Unix system).")
+        self.filename = filename
+        self.nslots = int(nslots)
+        size = self.nslots * self._slot.size
+        self._fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                cursize = os.fstat(self._fd).st_size
+                if cursize == 0:
+                    os.ftruncate(self._fd, size)  # filled with zeros
+                elif cursize != size:
+                    raise ValueError(f"Version table {filename} has a different size.")
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._mm = mmap.mmap(self._fd, size)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def _offset(self, user):
+        return (crc32(user.encode()) % self.nslots) * self._slot.size
+
+    def get(self, user):
+        """Get the version for the given user, or None if unknown."""
+        v1, v2 = self._slot.unpack_from(self._mm, self._offset(user))
+        if v1 > 0 and v1 == v2:
+            return v1
+        return None
+
+    def bump(self, user, version):
+        """Register a new version for the given user. Versions never decrease."""
+        offset = self._offset(user)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            v1, v2 = self._slot.unpack_from(self._mm, offset)
+            version = max(version, v1, v2)
+            self._slot.pack_into(self._mm, offset, version, version)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        self._mm.close()
+        os.close(self._fd)
+
+
+class ChangeNotifier:
+    """Allows coroutines to wait until there is new data for a user.
+
+    This only works within a single process. The ``notify()`` method
+    must be called from the event loop, e.g. by a handler after it has
+    awaited a write.
+    """
+
+    def __init__(self):
+        self._waiters = {}  # user -> set of futures
+        self._subscribers = {}  # user -> set of asyncio.Event objects
+
+    async def wait(self, user, timeout):
+        """Wait until ``notify()`` is called for the given user, or until
+        the timeout expires. Returns True if notified.
+        """
+        future = asyncio.get_event_loop().create_future()
+        waiters = self._waiters.setdefault(user, set())
+        waiters.add(future)
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            waiters.discard(future)
+            if not waiters and self._waiters.get(user) is waiters:
+                self._waiters.pop(user)
+
+    def subscribe(self, user):
+        """Get an asyncio.Event that is set on each ``notify()`` for the
+        given user. Unlike ``wait()``, no notifications are missed while
+        the caller is busy. The caller should clear the event after it
+        woke up, and call ``unsubscribe()`` when done.
+        """
+        event = asyncio.Event()
+        self._subscribers.setdefault(user, set()).add(event)
+        return event
+
+    def unsubscribe(self, user, event):
+        """Remove a subscription obtained with ``subscribe()``."""
+        subscribers = self._subscribers.get(user, set())
+        subscribers.discard(event)
+        if not subscribers:
+            self._subscribers.pop(user, None)
+
+    def notify(self, user):
+        """Wake up all coroutines waiting for the given user."""
+        for future in self._waiters.pop(user, ()):
+            if not future.done():
+                future.set_result(None)
+        for event in self._subscribers.get(user, ()):
+            event.set()
+
+    def count(self):
+        """Get the number of waiting coroutines and subscriptions."""
+        n = sum(len(waiters) for waiters in self._waiters.values())
+        return n + sum(len(events) for events in self._subscribers.values())